@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 
-import os, sys, re, subprocess, traceback
+import os, sys, re, json, subprocess, traceback, time, shlex
+from multiprocessing.pool import ThreadPool
 
-from lib import help, engine, ui, cmd, config
+from lib import help, engine, ui, cmd, config, parallel, metrics, workers
+
+def _describe_age(seconds):
+    for unit, size in [('day', 86400), ('hour', 3600), ('minute', 60)]:
+        if seconds >= size:
+            n = int(seconds / size)
+            return '%d %s%s ago' % (n, unit, 's' if n > 1 else '')
+    return 'just now'
 
 def list(*args):
+    verbose = '--verbose' in args
+    args = [arg for arg in args if not arg.startswith('--')]
     show_all = False
     if args[0].lower() == 'all':
         show_all = True
@@ -13,12 +23,33 @@ def list(*args):
     which = args[0].lower()
     if 'branches'.startswith(which):
         by_branch_name = engine.get().get_branches().by_branch_name
+        stats = None
+        if verbose:
+            stats = eng.get_branch_stats()
+            now = time.time()
         branch_names = sorted(by_branch_name.keys())
         for branch_name in branch_names:
             component_names = sorted(by_branch_name[branch_name])
+            if ui.json_mode():
+                fields = {}
+                if stats:
+                    fields['stats'] = dict((c, stats.get(c, {}).get(branch_name)) for c in component_names)
+                ui.emit('branch', branch=branch_name, components=component_names, **fields)
+                continue
             ui.writec(branch_name.ljust(20) + ui.NORMTXT + ' (%s)\n' % ', '.join(component_names), ui.PARAM_COLOR)
+            if stats:
+                for component_name in component_names:
+                    s = stats.get(component_name, {}).get(branch_name)
+                    if s:
+                        ui.writec('    ' + component_name.ljust(16) + ui.NORMTXT
+                                  + ' %s ahead, %s behind develop; last commit %s\n'
+                                  % (str(s['ahead']).rjust(4), str(s['behind']).rjust(4),
+                                     _describe_age(now - s['committed'])), ui.PARAM_COLOR)
     elif 'components'.startswith(which):
         for b in eng.get_components():
+            if ui.json_mode():
+                ui.emit('component', component=b['name'], url=b['url'])
+                continue
             ui.writec(b['name'].ljust(20) + ui.NORMTXT + ' (%s)\n' % b['url'], ui.PARAM_COLOR)
     else:
         raise Exception('Expected "list [all] branches|components".')
@@ -26,6 +57,291 @@ def list(*args):
 def flow(*args):
     engine.get().flow(*args)
 
+def bundle(*args):
+    '''
+    Write a git bundle for every muxed component to a folder ("bundle create
+    <folder>"), or bootstrap the data folder from such bundles ("bundle load
+    <folder>").
+    '''
+    if len(args) != 2 or args[0] not in ['create', 'load']:
+        raise Exception('Expected "bundle create|load <folder>".')
+    eng = engine.get()
+    if args[0] == 'create':
+        failed = eng.create_bundles(args[1])
+    else:
+        failed = eng.load_bundles(args[1])
+    if failed:
+        return 1
+
+def snapshot(*args):
+    '''
+    Record the SHA of every branch in every component ("snapshot save
+    <name>"), put them back ("snapshot restore <name> [--force]"), or list
+    saved snapshots ("snapshot list").
+    '''
+    force = '--force' in args
+    args = [arg for arg in args if not arg.startswith('--')]
+    eng = engine.get()
+    if args == ['list']:
+        for name in eng.get_snapshot_names():
+            if ui.json_mode():
+                ui.emit('snapshot', name=name)
+            else:
+                ui.printc(name, ui.PARAM_COLOR)
+        return
+    if len(args) != 2 or args[0] not in ['save', 'restore']:
+        raise Exception('Expected "snapshot save|restore <name>" or "snapshot list".')
+    if args[0] == 'save':
+        failed = eng.save_snapshot(args[1])
+    else:
+        failed = eng.restore_snapshot(args[1], force)
+    if failed:
+        return 1
+
+def sync(*args):
+    '''
+    Fetch all components at once, and fast-forward every local branch that's
+    behind its upstream, without checking anything out.
+    '''
+    if engine.get().sync():
+        return 1
+
+def find(*args):
+    '''
+    Show the commits in every muxed component that mention a ticket ID (or
+    some other text in their subject, or the start of a SHA), and which
+    branches have them ("find [--update] <ticket|text>"). Answers come from
+    a local index that sync keeps up to date; --update rescans every
+    component first.
+    '''
+    update = '--update' in args
+    args = [x for x in args if x != '--update']
+    if len(args) != 1:
+        raise Exception('Expected "find [--update] <ticket|text>".')
+    commits = engine.get().find(args[0], update)
+    by_component = {}
+    by_branch = {}
+    for commit in commits:
+        by_component.setdefault(commit.component_name, []).append(commit)
+        for branch_name in commit.branches:
+            by_branch.setdefault(branch_name, set()).add(commit.component_name)
+    if ui.json_mode():
+        for commit in commits:
+            ui.emit('commit', component=commit.component_name, sha=commit.sha, author=commit.author,
+                    date=commit.date, subject=commit.subject, branches=commit.branches)
+        ui.emit('found', term=args[0], commits=len(commits), components=sorted(by_component.keys()),
+                branches=dict((b, sorted(c)) for b, c in by_branch.items()))
+        return
+    if not commits:
+        ui.eprintc('No commits mention "%s".' % args[0], ui.WARNING_COLOR)
+        return 1
+    for component_name in sorted(by_component.keys()):
+        ui.writec(component_name + '\n', ui.PARAM_COLOR)
+        for commit in by_component[component_name]:
+            ui.writec('    %s  %s  %s  %s\n' % (commit.sha[0:10], time.strftime('%Y-%m-%d', time.localtime(commit.date)),
+                                               commit.author, commit.subject))
+    ui.printc('\nOn branches:')
+    for branch_name in sorted(by_branch.keys()):
+        ui.writec('    ' + branch_name.ljust(20) + ui.NORMTXT + ' (%s)\n' % ', '.join(sorted(by_branch[branch_name])), ui.PARAM_COLOR)
+
+def shard(*args):
+    '''
+    Run a command (exec, sync or flow) with its components split among the
+    workers in the "workers" section of config, and show the merged results
+    ("shard [--rebalance] <command>"). See lib/workers.py.
+    '''
+    args = [x for x in args]
+    rebalance = bool(args) and args[0] == '--rebalance'
+    if rebalance:
+        args = args[1:]
+    this_cmd = cmd.find_command(args[0]) if args else None
+    if not this_cmd or this_cmd.verb not in workers.SHARDABLE_VERBS:
+        raise Exception('Expected "shard [--rebalance] %s ...".' % '|'.join(workers.SHARDABLE_VERBS))
+    argv = [this_cmd.verb] + args[1:]
+    if workers.run(argv, rebalance, [c['name'] for c in engine.get().get_components()]):
+        return 1
+
+def worker(*args):
+    '''
+    Serve "git mux shard": read a command and the components to run it on
+    from stdin (one line of JSON), run it, and report on stdout as JSON Lines.
+    '''
+    request = json.loads(sys.stdin.readline())
+    ui.set_json_mode()
+    argv = request['argv']
+    this_cmd = cmd.find_command(argv[0]) if argv else None
+    if not this_cmd or this_cmd.verb not in workers.SHARDABLE_VERBS:
+        raise Exception('Workers can\'t run "%s".' % ' '.join(argv))
+    if not request['components']:
+        return
+    return _run_batch_command(['--only', ','.join(request['components'])] + argv)
+
+def exec_(*args):
+    '''
+    Run an arbitrary command in every muxed component's folder at once
+    ("exec -- <command>"). A single argument is run by the shell, so it can
+    use pipes and &&. Output from each component is shown in component
+    order.
+    '''
+    args = [x for x in args]
+    if '--' in args:
+        args = args[args.index('--') + 1:]
+    if not args:
+        raise Exception('Expected "exec [--jobs N] -- <command>".')
+    if engine.get().exec_command(args):
+        return 1
+
+def _record_command(argv, seconds):
+    this_cmd = None
+    if argv:
+        this_cmd = cmd.find_command(argv[0])
+    metrics.observe('gitmux_command_duration_seconds', seconds, verb=this_cmd.verb if this_cmd else 'other')
+
+def _get_run_context():
+    # The current thread's component scope and --jobs override.
+    return engine.get_scope(), parallel.get_job_override()
+
+def _set_run_context(context):
+    engine.restore_scope(context[0])
+    parallel.set_job_count(context[1])
+
+def _run_batch_command(argv, context=None):
+    # Run one batch command and return its exit code. Commands report
+    # failure through return values, die() (sys.exit), or both. Each one
+    # starts from the batch's scope and --jobs (context, if it runs on
+    # another thread), which its own switches can override.
+    previous = _get_run_context()
+    if context:
+        _set_run_context(context)
+    start = time.time()
+    try:
+        err = dispatch(globals(), _parse_run_switches(argv))
+    except SystemExit as e:
+        err = e.code
+    except engine.MuxError as e:
+        # A bad selector, say; dispatch() reports the rest.
+        ui.eprintc(str(e), ui.ERROR_COLOR)
+        err = 1
+    finally:
+        _set_run_context(previous)
+    _record_command(argv, time.time() - start)
+    if err is None:
+        return 0
+    if not isinstance(err, int):
+        return 1
+    return err
+
+def _run_batch_command_captured(argv, context):
+    with ui.OutputCapture() as capture:
+        err = _run_batch_command(argv, context)
+    return err, capture
+
+def batch(*args):
+    '''
+    Run many mux commands, one per line, from a file (or stdin) against a
+    single engine, so startup, config parsing and branch scanning happen
+    once. Blank lines and lines starting with # are ignored. A line ending
+    in "&" runs alongside the commands around it, and its output is shown
+    when it finishes; a "wait" line (or any line without "&") waits for
+    such commands first.
+    '''
+    stop_on_error = '--stop-on-error' in args
+    paths = [arg for arg in args if not arg.startswith('--')]
+    if paths and paths[0] != '-':
+        with open(paths[0]) as f:
+            lines = f.readlines()
+    else:
+        lines = sys.stdin.readlines()
+
+    # Batches can run for a long time; let a scraper watch.
+    metrics.serve()
+    # Selectors and --jobs given before "batch" apply to every line.
+    context = _get_run_context()
+    pool = ThreadPool(parallel.get_job_count())
+    pending = []
+    statuses = []
+    def report_start(line_num, txt):
+        if ui.json_mode():
+            ui.emit('command_started', line=line_num, command=txt)
+        else:
+            ui.printc('\n> ' + txt, ui.CMD_COLOR)
+    def report_end(line_num, txt, err):
+        if ui.json_mode():
+            ui.emit('command_finished', line=line_num, command=txt, exit_code=err)
+        statuses.append((line_num, txt, err))
+    def finish_pending():
+        for line_num, txt, async_result in pending:
+            err, capture = parallel.wait(async_result)
+            report_start(line_num, txt)
+            capture.replay()
+            report_end(line_num, txt, err)
+        del pending[:]
+    def failed():
+        return [x for x in statuses if x[2]]
+
+    try:
+        for line_num, line in enumerate(lines, 1):
+            txt = line.strip()
+            if txt.startswith('git mux '):
+                txt = txt[8:].lstrip()
+            if not txt or txt.startswith('#'):
+                continue
+            in_background = txt.endswith('&')
+            if in_background:
+                txt = txt[:-1].rstrip()
+            if not in_background or txt == 'wait':
+                finish_pending()
+            if stop_on_error and failed():
+                break
+            if txt == 'wait':
+                continue
+            try:
+                argv = shlex.split(txt)
+            except ValueError as e:
+                # An unbalanced quote, say; this line fails, not the batch.
+                report_start(line_num, txt)
+                report_end(line_num, txt, _complain('Can\'t parse this line: %s.' % e))
+                continue
+            if not argv:
+                # Just "&", say.
+                report_start(line_num, txt)
+                report_end(line_num, txt, _complain('There\'s no command on this line.'))
+            elif 'batch' in [_get_verb(x) for x in argv[0].split(',')]:
+                report_start(line_num, txt)
+                report_end(line_num, txt, _complain('Batches can\'t be nested.'))
+            elif in_background:
+                pending.append((line_num, txt, pool.apply_async(_run_batch_command_captured, (argv, context))))
+            else:
+                report_start(line_num, txt)
+                report_end(line_num, txt, _run_batch_command(argv))
+        finish_pending()
+    finally:
+        pool.close()
+        pool.join()
+
+    # Summarize.
+    errors = failed()
+    if ui.json_mode():
+        ui.emit('batch_finished', commands=len(statuses), failed=len(errors))
+        return 1 if errors else 0
+    ui.printc('\nRan %d commands; %d failed.' % (len(statuses), len(errors)),
+              ui.ERROR_COLOR if errors else ui.SUCCESS_COLOR)
+    for line_num, txt, err in errors:
+        ui.eprintc('  line %d (exit code %s): %s' % (line_num, err, txt), ui.ERROR_COLOR)
+    if errors:
+        return 1
+
+def _get_verb(name):
+    # The verb that dispatch would run for a possibly abbreviated name.
+    this_cmd = cmd.find_command(name)
+    if this_cmd:
+        return this_cmd.verb
+    return name
+
+def _complain(problem):
+    ui.eprintc(problem, ui.ERROR_COLOR)
+    return 1
+
 _HELP_SWITCHES = ['?','help']
 def _parse_switches(args):
     bad = False
@@ -34,6 +350,9 @@ def _parse_switches(args):
     while i < len(args):
         arg = args[i]
         val = None
+        if arg == '--':
+            # The rest belongs to whatever command comes after it.
+            break
         if arg.startswith('--'):
             val = arg[2:]
         elif (i == 0 and arg.startswith('-')):
@@ -42,9 +361,13 @@ def _parse_switches(args):
             val = arg
         if val:
             args.remove(arg)
-            val = val.lower()
+            # Switch names are case-insensitive; values (--only=Foo*) aren't.
+            name, sep, value = val.partition('=')
+            val = name.lower() + sep + value
             if val in _HELP_SWITCHES:
                 show_help = True
+            elif val == 'json':
+                ui.set_json_mode(True)
             elif val == 'no-color':
                 ansi2.set_use_colors(False)
             elif val == 'auto-confirm':
@@ -65,6 +388,55 @@ def _parse_switches(args):
         sys.exit(1)
     return args
 
+_SCOPE_SWITCHES = ['--only', '--except']
+_JOBS_SWITCH = '--jobs'
+def _parse_run_switches(args):
+    '''
+    Pull --only and --except selectors and --jobs out of args. Limit the
+    engine to the components the selectors pick, and run up to --jobs
+    components at a time, for the rest of this thread's command. Without
+    them, the thread keeps whatever scope and job count it had. Anything
+    after "--" is left alone.
+    '''
+    only, exclude, rest = [], [], []
+    jobs = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--':
+            rest += args[i:]
+            break
+        name, eq, value = arg.partition('=')
+        if name in _SCOPE_SWITCHES or name == _JOBS_SWITCH:
+            if not eq:
+                i += 1
+                if i == len(args):
+                    if name == _JOBS_SWITCH:
+                        ui.eprintc('Expected a number after %s.' % name, ui.ERROR_COLOR)
+                    else:
+                        ui.eprintc('Expected a component, glob or group after %s.' % name, ui.ERROR_COLOR)
+                    sys.exit(1)
+                value = args[i]
+            if name == _JOBS_SWITCH:
+                if not value.isdigit() or not int(value):
+                    ui.eprintc('%s needs a positive number, not "%s".' % (name, value), ui.ERROR_COLOR)
+                    sys.exit(1)
+                jobs = int(value)
+            else:
+                terms = [x.strip() for x in value.split(',') if x.strip()]
+                if name == '--only':
+                    only += terms
+                else:
+                    exclude += terms
+        else:
+            rest.append(arg)
+        i += 1
+    if only or exclude:
+        engine.get().set_scope(only, exclude)
+    if jobs is not None:
+        parallel.set_job_count(jobs)
+    return rest
+
 def setup(*args):
     print('Run "python %s instead. Use --help for more info.' % os.path.join(config.BIN_FOLDER, 'setup.py'))
 
@@ -80,11 +452,7 @@ def dispatch(symbols, args):
 
     funcs = []
     for x in args[0].split(','):
-        this_cmd = cmd.find_command(x)
-        if this_cmd:
-            funcs.append(this_cmd.verb)
-        else:
-            funcs.append(x)
+        funcs.append(_get_verb(x))
     args = args[1:]
     if args:
         if args[0].startswith('lambda'):
@@ -93,7 +461,12 @@ def dispatch(symbols, args):
         # Look up the named function in our symbols and invoke it,
         # if found. Otherwise, display interactive menu.
         try:
-            if func in symbols:
+            # Verbs that are python keywords live in functions whose names
+            # end with an underscore. Names that start with one are helpers,
+            # not verbs.
+            if func not in symbols and func + '_' in symbols:
+                func += '_'
+            if func in symbols and not func.startswith('_'):
                 err = symbols[func](*args)
                 if err is None:
                     err = 0
@@ -110,6 +483,10 @@ def dispatch(symbols, args):
             # If one of the functions that we call invokes sys.exit(), accept
             # that function's judgment without comment.
             raise
+        except engine.MuxError as e:
+            # Something was wrong with the request; say what.
+            ui.eprintc(str(e), ui.ERROR_COLOR)
+            return 1
         except Exception:
             # Generally, trap all other errors and report them.
             ui.eprintc('%s' % traceback.format_exc(), ui.ERROR_COLOR)
@@ -119,8 +496,20 @@ if __name__ == '__main__':
     err = 0
     symbols = locals()
     args = _parse_switches(sys.argv[1:])
-    if not args:
-        help.show()
-    else:
-        err = dispatch(symbols, args)
+    start = time.time()
+    try:
+        args = _parse_run_switches(args)
+        if not args:
+            help.show()
+        else:
+            err = dispatch(symbols, args)
+    except SystemExit as e:
+        err = e.code
+    except engine.MuxError as e:
+        ui.eprintc(str(e), ui.ERROR_COLOR)
+        err = 1
+    _record_command(args, time.time() - start)
+    metrics.save()
+    if ui.json_mode():
+        ui.emit('exit', exit_code=err or 0, seconds=round(time.time() - start, 3))
     sys.exit(err)
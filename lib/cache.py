@@ -0,0 +1,232 @@
+'''
+Remember the results of expensive git computations between runs.
+
+Everything we cache is keyed by commit SHAs, so entries never go stale: if a
+branch moves, its SHA changes and we simply compute (and store) a new entry.
+They do pile up, though, so SHA-keyed caches are capped, and forget what was
+used least recently once they're full.
+'''
+
+import os, io, re, json, time, tempfile, threading
+
+import config, metrics
+
+_UNSAFE_KEY_CHARS_PAT = re.compile(r'[^-_.a-zA-Z0-9]')
+
+def _write_atomically(path, txt):
+    # Write to a temp file in the same folder, then rename over the target.
+    # Readers never see a partial file, and concurrent writers of the same
+    # key just race to install identical content.
+    folder = os.path.dirname(path)
+    handle, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+    try:
+        with io.open(handle, 'w', encoding='utf-8') as f:
+            f.write(txt)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+class FileCache:
+    '''
+    A folder of text blobs, one file per key. Suited to large values (like
+    diffs) that we don't want to load unless asked for.
+
+    Reading a value marks it used (its file's modification time). If
+    max_bytes is given, prune() removes the least recently used values
+    until the rest fit.
+    '''
+    def __init__(self, name, folder=None, max_bytes=None):
+        if folder is None:
+            folder = config.CACHE_FOLDER
+        self.name = name
+        self.folder = os.path.join(folder, name)
+        self.max_bytes = max_bytes
+    def _path(self, key):
+        return os.path.join(self.folder, _UNSAFE_KEY_CHARS_PAT.sub('_', key))
+    def _make_folder(self):
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # Another thread or process may have just created it.
+                if not os.path.isdir(self.folder):
+                    raise
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.isfile(path):
+            metrics.inc('gitmux_cache_requests', cache=self.name, result='miss')
+            return None
+        metrics.inc('gitmux_cache_requests', cache=self.name, result='hit')
+        _touch(path)
+        with io.open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    def open(self, key):
+        '''
+        Return a text file open on key's value, or None if there isn't one,
+        for values we'd rather not hold in memory all at once.
+        '''
+        path = self._path(key)
+        if not os.path.isfile(path):
+            metrics.inc('gitmux_cache_requests', cache=self.name, result='miss')
+            return None
+        metrics.inc('gitmux_cache_requests', cache=self.name, result='hit')
+        _touch(path)
+        return io.open(path, 'r', encoding='utf-8')
+    def put(self, key, txt):
+        self._make_folder()
+        if isinstance(txt, bytes):
+            txt = txt.decode('utf-8')
+        _write_atomically(self._path(key), txt)
+    def writer(self, key):
+        '''
+        Return a CacheWriter that stores key's value a piece at a time.
+        '''
+        self._make_folder()
+        return CacheWriter(self._path(key))
+    def prune(self):
+        '''
+        Remove the least recently used values until the rest take up no more
+        than max_bytes.
+        '''
+        if self.max_bytes is None or not os.path.isdir(self.folder):
+            return
+        files = []
+        for fname in os.listdir(self.folder):
+            if fname.startswith('.tmp-'):
+                continue
+            path = os.path.join(self.folder, fname)
+            try:
+                info = os.stat(path)
+            except OSError:
+                # Another process pruned it first.
+                continue
+            files.append((info.st_mtime, info.st_size, path))
+        total = sum(size for used, size, path in files)
+        for used, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        # Pruned out from under us; the read that follows will say so.
+        pass
+
+class CacheWriter:
+    '''
+    Build a FileCache value with write() calls. Readers see nothing until
+    commit(), which installs it the same way _write_atomically() does;
+    discard() throws it away.
+    '''
+    def __init__(self, path):
+        self.path = path
+        handle, self._tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        self._file = io.open(handle, 'w', encoding='utf-8')
+    def write(self, txt):
+        if isinstance(txt, bytes):
+            txt = txt.decode('utf-8')
+        self._file.write(txt)
+    def commit(self):
+        self._file.close()
+        os.rename(self._tmp, self.path)
+    def discard(self):
+        self._file.close()
+        os.remove(self._tmp)
+
+class JsonCache:
+    '''
+    A dict of small, JSON-friendly values persisted as a single file. Entries
+    are loaded on first use and written back by save(). Safe to share between
+    threads.
+
+    Entries in caches keyed by SHAs never go stale. For anything else, pass
+    ttl (in seconds), and get() will ignore entries older than that. Pass
+    max_entries to keep the file from growing without bound; save() keeps
+    only that many, dropping those used least recently.
+    '''
+    def __init__(self, name, folder=None, ttl=None, max_entries=None):
+        if folder is None:
+            folder = config.CACHE_FOLDER
+        self.name = name
+        self.folder = folder
+        self.path = os.path.join(folder, name + '.json')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+    def _read(self):
+        if os.path.isfile(self.path):
+            try:
+                with io.open(self.path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except ValueError:
+                # A damaged cache is no worse than an empty one.
+                pass
+        return {}
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+    def _wraps(self):
+        # Whether entries carry when they were saved and used, around
+        # their values.
+        return self.ttl is not None or self.max_entries is not None
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is not None and self._wraps():
+                if not isinstance(entry, dict) or 'value' not in entry:
+                    # Saved before this cache kept track; treat as missing.
+                    entry = None
+                elif self.ttl is not None and now - entry['saved'] > self.ttl:
+                    entry = None
+                elif self.max_entries is not None:
+                    entry['used'] = now
+                    self._dirty = True
+        metrics.inc('gitmux_cache_requests', cache=self.name, result='miss' if entry is None else 'hit')
+        if entry is None or not self._wraps():
+            return entry
+        return entry['value']
+    def put(self, key, value):
+        if self._wraps():
+            value = {'value': value, 'saved': time.time()}
+            if self.max_entries is not None:
+                value['used'] = value['saved']
+        with self._lock:
+            self._load()[key] = value
+            self._dirty = True
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # Another git-mux process may have saved entries since we loaded;
+            # keep theirs too.
+            entries = self._read()
+            entries.update(self._entries)
+            if self.max_entries is not None and len(entries) > self.max_entries:
+                by_use = sorted(entries.items(), key=lambda x: _get_used(x[1]), reverse=True)
+                entries = dict(by_use[0:self.max_entries])
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            txt = json.dumps(entries, indent=2, separators=(',', ': '), sort_keys=True)
+            if isinstance(txt, bytes):
+                txt = txt.decode('utf-8')
+            _write_atomically(self.path, txt)
+            self._entries = entries
+            self._dirty = False
+
+def _get_used(entry):
+    # When a JsonCache entry was last used; entries from before we kept
+    # track go first.
+    if isinstance(entry, dict):
+        return entry.get('used', 0)
+    return 0
@@ -15,6 +15,14 @@ class Command:
 _CMDS = [
     Command('list [all] b|c',        'List muxed (or all) branches/components.'),
     Command('flow type action name', 'Run git flow on my components.'),
+    Command('batch [file]',          'Run many commands (one per line) in one process.'),
+    Command('bundle create|load dir', 'Save components to bundles, or bootstrap from them.'),
+    Command('snapshot save|restore n', 'Record or restore the SHAs of all branches.'),
+    Command('exec -- command',       'Run any command in all components at once.'),
+    Command('sync',                  'Fetch everything; fast-forward branches that are behind.'),
+    Command('find ticket|text',      'Find commits by ticket ID or subject, with their branches.'),
+    Command('shard command',         'Run exec, sync or flow with components split among workers.'),
+    Command('worker',                'Run commands for "shard" (which starts workers itself).'),
     ]
 
 def _calc_abbrevs():
@@ -19,18 +19,39 @@ if BIN_FOLDER.endswith('/'):
     BIN_FOLDER = BIN_FOLDER[0:-1]
 
 GMUX_ROOT = os.path.abspath(os.path.join(BIN_FOLDER, '..')).replace('\\', '/')
+# Several roots can share one copy of the code (shard workers on one host,
+# say) by naming their own in the environment.
+if os.environ.get('GMUX_ROOT'):
+    GMUX_ROOT = os.path.abspath(os.path.expanduser(os.environ['GMUX_ROOT'])).replace('\\', '/')
 if GMUX_ROOT.endswith('/'):
     GMUX_ROOT = GMUX_ROOT[0:-1]
 
 DATA_FOLDER = os.path.join(GMUX_ROOT, 'data')
 CONFIG_FOLDER = os.path.join(GMUX_ROOT, 'etc')
+CACHE_FOLDER = os.path.join(DATA_FOLDER, '.git-mux-cache')
 CONFIG_FNAME = '%s.cfg' % APP_NAME
 SHARED_CONFIG_FNAME = 'shared.cfg'
 CONFIG_FQPATH = os.path.join(CONFIG_FOLDER, CONFIG_FNAME)
 MISC_SECTION = 'misc'
 SETUP_SUCCESS_DATE_KEY = 'successful setup date'
 SHARED_CONFIG_REPO_KEY = 'shared cfg repo'
+JOBS_KEY = 'jobs'
+GITFLOW_BACKEND_KEY = 'gitflow backend'
+AUDIT_CACHE_TTL_KEY = 'audit cache ttl'
+NETWORK_RETRIES_KEY = 'network retries'
+RETRY_BACKOFF_KEY = 'retry backoff'
+MIRROR_FOLDER_KEY = 'mirror folder'
+MIRROR_MAX_MB_KEY = 'mirror max mb'
+METRICS_FILE_KEY = 'metrics file'
+METRICS_PORT_KEY = 'metrics port'
+TICKET_PATTERN_KEY = 'ticket pattern'
 MUXED_COMPONENTS_SECTION = 'muxed components'
+NETWORK_TIMEOUTS_SECTION = 'network timeouts'
+COMPONENT_DEPENDENCIES_SECTION = 'component dependencies'
+COMPONENT_GROUPS_SECTION = 'component groups'
+WORKERS_SECTION = 'workers'
+MUXED_BRANCHES_SECTION = 'muxed branches'
+SELECTED_BRANCHES_KEY = 'selected'
 
 # Potential bug: if we're running as root, but we want the home drive for the non-
 # privileged user that temporarily elevated to root, this will not work. The setup
@@ -51,7 +72,7 @@ class MyConfigParser(ConfigParser.SafeConfigParser):
             path = CONFIG_FQPATH
         self.path = path
         if os.path.isfile(self.path):
-            print('Loading config from %s...' % self.path)
+            sys.stderr.write('Loading config from %s...\n' % self.path)
             self.read(self.path)
     def add_section_if_missing(self, section):
         if not self.has_section(section):
@@ -68,5 +89,21 @@ class MyConfigParser(ConfigParser.SafeConfigParser):
         return default
     def setup_has_succeeded(self):
         return bool(self.try_get(MISC_SECTION, SETUP_SUCCESS_DATE_KEY))
+    def get_shared_items(self, section):
+        '''
+        Return a dict of the items in a section that may be defined for the
+        whole team in the shared cfg repo's shared.cfg, and overridden (key by
+        key) in local config.
+        '''
+        items = {}
+        path = os.path.join(DATA_FOLDER, SHARED_CFG_REPO_NAME, SHARED_CONFIG_FNAME)
+        if os.path.isfile(path):
+            shared = ConfigParser.SafeConfigParser()
+            shared.read(path)
+            if shared.has_section(section):
+                items.update(dict(shared.items(section)))
+        if self.has_section(section):
+            items.update(dict(self.items(section)))
+        return items
 
 cfg = MyConfigParser()
\ No newline at end of file
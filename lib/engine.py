@@ -1,12 +1,14 @@
-import os, time, sys, re, inspect
+import os, time, sys, re, json, inspect, threading, errno, shutil, signal, fnmatch, subprocess, codecs, collections, tempfile, multiprocessing
+from multiprocessing.pool import ThreadPool
 
-import config, ui
+import config, ui, parallel, cache, gitflow, network, graph, mirror, metrics, schedule, index
 
 isWindows = sys.platform=="win32" or sys.platform=="cygwin"
 if not isWindows:
 	import fcntl
 
 _LOCAL_DATA_REPO = os.path.join(config.DATA_FOLDER, '.git-mux-data')
+_LOCK_FOLDER = os.path.join(config.DATA_FOLDER, '.git-mux-locks')
 _REPO_ROOT = config.DATA_FOLDER
 _PROTECTED_BRANCHES = ['master', 'develop']
 _COMPONENTS_FILE = 'components.json'
@@ -14,15 +16,300 @@ _SUPPRESS_GITFLOW_LINE_PAT = re.compile(r'^ +(init|version|support|git flow [a-z
 _VALID_BRANCH_TYPES_PAT = re.compile('^(?:feature|release|hotfix)$')
 _VALID_BRANCH_NAMES_PAT = re.compile('[a-z]+(?:[-a-z]*[a-z])?$')
 _SCRATCH_BRANCH_NAME = 'scratch'
+# Flow verbs whose handlers never touch the working tree. These can run in
+# all components at once. Some verbs qualify only with a particular switch.
+_CHECKOUT_FREE_FLOW_VERBS = ['diff']
+_CHECKOUT_FREE_FLOW_SWITCHES = {'start': '--fast'}
+# Flow verbs that only read refs and objects. They take shared locks, and they
+# don't wait for (or disturb) another git-mux run that's busy in a component.
+_READ_ONLY_FLOW_VERBS = ['list', 'diff']
+_DIFF_SUMMARY_SWITCHES = ['--stat', '--shortstat']
+# Flow verbs that merge (or rebase) in every component, and so get a
+# conflict preflight first; see Engine._preflight().
+_PREFLIGHT_FLOW_VERBS = ['finish', 'rebase']
+# Network verbs whose traffic we measure when metrics are on.
+_TRANSFER_VERBS = ['clone', 'fetch', 'pull', 'push']
+# How much git output we hold at once when streaming it, and how much of
+# stderr we keep for error reports.
+_STREAM_CHUNK_BYTES = 64 * 1024
+_STDERR_TAIL_BYTES = 16 * 1024
+
+class MuxError(Exception):
+    '''
+    Something wrong with what we were asked to do (bad arguments, a missing
+    snapshot, conflicts found before merging anything), as opposed to a
+    component that failed while doing it.
+    '''
 
 def die(problem):
-    ui.eprintc(problem, ui.ERROR_COLOR)
-    sys.exit(1)
+    raise MuxError(problem)
 
 try:
     import git as gitpython
 except:
-    die('Unable to import git support module. Please run "sudo easy_install gitpython" and retry.')
+    ui.eprintc('Unable to import git support module. Please run "sudo easy_install gitpython" and retry.', ui.ERROR_COLOR)
+    sys.exit(1)
+
+class _MuxGit(gitpython.Git):
+    '''
+    gitpython's Git, with a hook that sees every git process we run on
+    behalf of a component. Commands that talk to a remote get a deadline,
+    and are retried if they fail the way a flaky network makes them fail
+    (see network.py).
+    '''
+    def __init__(self, working_dir=None, component_name=None):
+        gitpython.Git.__init__(self, working_dir)
+        self.component_name = component_name
+    def execute(self, command, **kwargs):
+        verb = network.get_verb(command)
+        if verb == 'fetch' and command[-1] == 'origin' and not kwargs.get('as_process'):
+            return self._fetch_configured(command, **kwargs)
+        return self._execute_network_aware(command, verb, **kwargs)
+    def _fetch_configured(self, command, **kwargs):
+        # A fetch that uses the component's refspecs fails outright if origin
+        # no longer has a branch that one of them names exactly (someone
+        # finished it, say). Stop asking for such branches, and try again.
+        while True:
+            error, stderr = None, None
+            try:
+                result = self._execute_network_aware(command, 'fetch', **kwargs)
+                if kwargs.get('with_extended_output') and result[0]:
+                    stderr = result[2]
+            except gitpython.GitCommandError as e:
+                error, stderr = e, e.stderr
+            match = _MISSING_REMOTE_BRANCH_PAT.search(stderr or '')
+            if not match or not _drop_fetch_refspec(self, match.group(1)):
+                if error:
+                    raise error
+                return result
+            sys.stderr.write('%s is gone from origin in %s; no longer fetching it.\n' % (
+                match.group(1), self.component_name))
+    def _execute_network_aware(self, command, verb, **kwargs):
+        if verb not in network.NETWORK_VERBS or kwargs.get('as_process') or kwargs.get('output_stream'):
+            return self._execute_once(command, **kwargs)
+        if not metrics.enabled() or verb not in _TRANSFER_VERBS:
+            return self._execute_with_retries(command, verb, **kwargs)
+        # Nothing reports how many bytes crossed the wire, so count the
+        # objects that the remote-tracking refs gained (or, for a push,
+        # that the remote did).
+        before = set()
+        if verb != 'clone':
+            before = self._get_remote_tips()
+        result = self._execute_with_retries(command, verb, **kwargs)
+        if before is not None and (verb != 'clone' or command[-1] == '.'):
+            size = self._get_new_object_size(before)
+            if size:
+                metrics.inc('gitmux_pushed_bytes' if verb == 'push' else 'gitmux_fetched_bytes', size,
+                            component=self.component_name or '')
+        return result
+    def _execute_with_retries(self, command, verb, **kwargs):
+        timeout = None
+        if not isWindows:
+            timeout = network.get_timeout(self.component_name, verb)
+        retries = network.get_retry_count()
+        attempt = 0
+        while True:
+            start = time.time()
+            error, stderr = None, None
+            try:
+                result = self._execute_once(command, timeout=timeout, **kwargs)
+                if kwargs.get('with_extended_output') and result[0]:
+                    stderr = result[2]
+            except gitpython.GitCommandError as e:
+                error, stderr = e, e.stderr
+            timed_out = network.is_timeout(stderr)
+            transient = network.is_transient(stderr)
+            retry = transient and attempt < retries
+            network.stats.record(self.component_name, verb, time.time() - start, timed_out=timed_out,
+                                 retried=retry, failed=transient and not retry)
+            if timed_out:
+                metrics.inc('gitmux_git_timeouts', verb=verb, component=self.component_name or '')
+            if retry:
+                metrics.inc('gitmux_git_retries', verb=verb, component=self.component_name or '')
+            if not retry:
+                if error:
+                    raise error
+                return result
+            attempt += 1
+            delay = network.get_backoff(attempt)
+            sys.stderr.write('git %s in %s %s; retrying in %.1fs (%d of %d)...\n' % (
+                verb, self.component_name, 'timed out' if timed_out else 'failed', delay, attempt, retries))
+            if verb == 'clone':
+                self._remove_partial_clone(command[-1])
+            time.sleep(delay)
+    def _execute_once(self, command, timeout=None, **kwargs):
+        start = time.time()
+        metrics.inc('gitmux_git_commands', verb=network.get_verb(command) or '', component=self.component_name or '')
+        exit_code = None
+        try:
+            if timeout:
+                result = self._execute_with_deadline(command, timeout, **kwargs)
+            else:
+                result = gitpython.Git.execute(self, command, **kwargs)
+            if kwargs.get('with_extended_output'):
+                exit_code = result[0]
+            elif not kwargs.get('as_process'):
+                exit_code = 0
+            return result
+        except gitpython.GitCommandError as e:
+            exit_code = e.status
+            raise
+        finally:
+            if ui.json_mode():
+                ui.emit('git', component=self.component_name, args=command[1:],
+                        exit_code=exit_code, seconds=round(time.time() - start, 3))
+    def _execute_with_deadline(self, command, timeout, with_extended_output=False, with_exceptions=True, **kwargs):
+        # gitpython's kill_after_timeout only kills git and its immediate
+        # children, but "git pull" runs ssh as a grandchild, and a hung ssh
+        # holds our pipes open. So start git in a process group of its own,
+        # and kill the whole group when time runs out.
+        # Hold on to gitpython's wrapper; when it's collected, it kills the
+        # process and closes the pipes.
+        handle = gitpython.Git.execute(self, command, as_process=True, preexec_fn=os.setsid, **kwargs)
+        proc = handle.proc
+        killed = []
+        def kill():
+            killed.append(True)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        watchdog = threading.Timer(timeout, kill)
+        watchdog.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            watchdog.cancel()
+        exit_code = proc.returncode
+        # Match what gitpython hands back when it runs a command itself.
+        stdout = stdout.decode('utf-8', 'replace')
+        stderr = stderr.decode('utf-8', 'replace')
+        if stdout.endswith('\n'):
+            stdout = stdout[:-1]
+        if stderr.endswith('\n'):
+            stderr = stderr[:-1]
+        if killed:
+            stderr = 'Timeout: the command "%s" did not complete in %d secs.' % (' '.join(command), timeout)
+        if with_exceptions and exit_code:
+            raise gitpython.GitCommandError(command, exit_code, stderr, stdout)
+        if with_extended_output:
+            return exit_code, stdout, stderr
+        return stdout
+    def _get_remote_tips(self):
+        # The set of SHAs that remote-tracking refs point at, or None if
+        # we can't tell.
+        exit_code, stdout, stderr = self.for_each_ref('--format=%(objectname)', 'refs/remotes/',
+                                                      with_extended_output=True, with_exceptions=False)
+        if exit_code:
+            return None
+        return set(stdout.split())
+    def _get_new_object_size(self, before):
+        # How much disk the objects reachable from remote-tracking refs, but
+        # not from the SHAs in before, take up. Pack compression makes that
+        # a fair stand-in for what was sent.
+        with tempfile.TemporaryFile() as f:
+            f.write(''.join('^%s\n' % sha for sha in sorted(before)).encode('ascii'))
+            f.seek(0)
+            exit_code, stdout, stderr = self.rev_list('--objects', '--disk-usage', '--remotes', '--stdin', istream=f,
+                                                      with_extended_output=True, with_exceptions=False)
+        if exit_code or not stdout.strip().isdigit():
+            return 0
+        return int(stdout.strip())
+    def stream(self, verb, *args, **kwargs):
+        '''
+        Run "git <verb> <args>", handing its stdout to sink (ui.writec unless
+        given) a batch of whole lines at a time instead of collecting it all.
+        Returns (exit_code, bytes_streamed, stderr), where stderr is just the
+        last _STDERR_TAIL_BYTES git wrote there. We read no faster than sink
+        writes, so a slow terminal holds git back instead of filling memory.
+        Like the commands that execute() runs, it gets whatever deadline the
+        "network timeouts" config gives verb; if that runs out, git and
+        everything it started are killed.
+        '''
+        sink = kwargs.get('sink') or ui.writec
+        timeout = None
+        if not isWindows:
+            timeout = network.get_timeout(self.component_name, verb)
+        popen_kwargs = {}
+        if timeout:
+            # See _execute_with_deadline() for why git gets a process group.
+            popen_kwargs['preexec_fn'] = os.setsid
+        # Hold on to gitpython's wrapper; when it's collected, it kills the
+        # process and closes the pipes. (We call execute() ourselves, since
+        # gitpython would pass preexec_fn to git as a switch.)
+        command = [self.GIT_PYTHON_GIT_EXECUTABLE, verb] + list(args)
+        handle = self.execute(command, as_process=True, **popen_kwargs)
+        proc = handle.proc
+        killed = []
+        def kill():
+            killed.append(True)
+            try:
+                if timeout:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                else:
+                    proc.kill()
+            except OSError:
+                pass
+        watchdog = None
+        if timeout:
+            watchdog = threading.Timer(timeout, kill)
+            watchdog.start()
+        tail = collections.deque()
+        def read_stderr():
+            size = 0
+            for chunk in iter(lambda: proc.stderr.read(_STREAM_CHUNK_BYTES), b''):
+                tail.append(chunk)
+                size += len(chunk)
+                while size - len(tail[0]) >= _STDERR_TAIL_BYTES:
+                    size -= len(tail.popleft())
+        reader = threading.Thread(target=read_stderr)
+        reader.daemon = True
+        reader.start()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        streamed = 0
+        try:
+            lines, size = [], 0
+            for line in iter(lambda: proc.stdout.readline(_STREAM_CHUNK_BYTES), b''):
+                lines.append(line)
+                size += len(line)
+                if size >= _STREAM_CHUNK_BYTES:
+                    sink(decoder.decode(b''.join(lines)))
+                    streamed += size
+                    lines, size = [], 0
+            if lines:
+                sink(decoder.decode(b''.join(lines), True))
+                streamed += size
+        except:
+            kill()
+            raise
+        finally:
+            proc.stdout.close()
+            reader.join()
+            proc.stderr.close()
+            if watchdog:
+                watchdog.cancel()
+        exit_code = proc.wait()
+        stderr = b''.join(tail)[-_STDERR_TAIL_BYTES:].decode('utf-8', 'replace').rstrip('\n')
+        if killed:
+            stderr = 'Timeout: the command "git %s" did not complete in %d secs.' % (' '.join([verb] + list(args)), timeout)
+        return exit_code, streamed, stderr
+    def _remove_partial_clone(self, destination):
+        # A clone that we killed leaves a partial repo behind, and git won't
+        # clone into a folder that isn't empty. We only ever clone into a
+        # folder that we just created (or one that doesn't exist yet), so
+        # everything in it is ours to remove.
+        folder = os.path.join(self._working_dir or os.getcwd(), destination)
+        if not os.path.isdir(folder):
+            return
+        if os.path.abspath(folder) != os.path.abspath(self._working_dir or ''):
+            shutil.rmtree(folder)
+            return
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
 
 class Engine:
 
@@ -32,11 +319,14 @@ class Engine:
         self._folder = folder
         self._git = None
         self._branches = None
+        self._scanned = set()
         self._components = None
         self._last_update = 0
+        # Batch mode may run several commands against this engine at once.
+        self._lock = threading.RLock()
 
     def _find_component_by_name(self, name):
-        which = [x for x in self.get_components() if x['name'] == name]
+        which = [x for x in self._get_all_components() if x['name'] == name]
         if not which:
             raise Exception('Component "%s" is not recognized.' % (object_type, name))
         assert len(which) == 1
@@ -45,57 +335,183 @@ class Engine:
     # Define a class that holds branches indexed 2 ways -- by branch name,
     # and by the name of the component that has the branch.
     class Branches:
-        def __init__(self):
+        def __init__(self, lock=None):
             self.by_component_name = {}
             self.by_branch_name = {}
+            # Set on views made by restricted_to(); changes to a view are
+            # passed on to the full index.
+            self.parent = None
+            # Components are added and removed from many threads at once;
+            # a view shares its index's lock.
+            self._lock = lock or threading.RLock()
         def add(self, branch_name, component_name):
-            if component_name not in self.by_component_name:
-                self.by_component_name[component_name] = []
-            self.by_component_name[component_name].append(branch_name)
-            if branch_name not in self.by_branch_name:
-                self.by_branch_name[branch_name] = []
-            self.by_branch_name[branch_name].append(component_name)
+            with self._lock:
+                if component_name not in self.by_component_name:
+                    self.by_component_name[component_name] = []
+                self.by_component_name[component_name].append(branch_name)
+                if branch_name not in self.by_branch_name:
+                    self.by_branch_name[branch_name] = []
+                self.by_branch_name[branch_name].append(component_name)
+                if self.parent:
+                    self.parent.add(branch_name, component_name)
+        def remove(self, branch_name, component_name):
+            with self._lock:
+                if branch_name in self.by_component_name.get(component_name, []):
+                    self.by_component_name[component_name].remove(branch_name)
+                if component_name in self.by_branch_name.get(branch_name, []):
+                    self.by_branch_name[branch_name].remove(component_name)
+                    if not self.by_branch_name[branch_name]:
+                        del self.by_branch_name[branch_name]
+                if self.parent:
+                    self.parent.remove(branch_name, component_name)
+        def restricted_to(self, component_names):
+            with self._lock:
+                view = Engine.Branches(self._lock)
+                for component_name, branch_names in self.by_component_name.items():
+                    if component_name in component_names:
+                        for branch_name in branch_names:
+                            view.add(branch_name, component_name)
+                view.parent = self
+                return view
 
     def get_branches(self, filter_func=None):
-        if self._branches is None:
-
-            b = Engine.Branches()
+        # Components are scanned the first time a command in scope needs
+        # them, so components outside the scope cost nothing.
+        with self._lock:
+            if self._branches is None:
+                self._branches = Engine.Branches()
             for c in self.get_components():
                 component_name = c['name']
+                if component_name in self._scanned:
+                    metrics.inc('gitmux_cache_requests', cache='branch-index', result='hit')
+                    continue
+                metrics.inc('gitmux_cache_requests', cache='branch-index', result='miss')
                 git = self._get_git_instance_for_component(c['name'])
-                stdout = git.branch()
+                # Reading refs is safe even while another git-mux run works
+                # in this component, so we don't wait for its lock.
+                with ComponentLock(component_name, shared=True, wait=False) as lock:
+                    stdout = git.branch()
                 items = [x.strip() for x in stdout.strip().split('\n')]
+                if lock.acquired:
+                    local_branches = [x.lstrip('*').lstrip() for x in items]
+                    _sync_fetch_refspecs(component_name, git, local_branches)
                 scratch_found = False
+                active_branch = None
                 for item in items:
                     if item.startswith('*'):
                         item = item[1:].lstrip()
+                        active_branch = item
                     if item == _SCRATCH_BRANCH_NAME:
                         scratch_found = True
                     else:
-                        b.add(item, component_name)
+                        self._branches.add(item, component_name)
                 # As a precaution, we create a local branch named "scratch"
                 # in our git-mux-cache version of each component. This branch
                 # has no remote and is not based on anything. We leave
                 # this as the active branch after all our operations, in
                 # case our code misbehaves or someone accidentally issues a
                 # direct git command without carefully setting up context.
-                if not scratch_found:
-                    git.branch(_SCRATCH_BRANCH_NAME)
-                git.checkout(_SCRATCH_BRANCH_NAME)
+                # If another run is busy in the component, it will park the
+                # component on scratch itself when it's done.
+                if lock.acquired and active_branch != _SCRATCH_BRANCH_NAME:
+                    with ComponentLock(component_name):
+                        if not scratch_found:
+                            git.branch(_SCRATCH_BRANCH_NAME)
+                        git.checkout(_SCRATCH_BRANCH_NAME)
+                self._scanned.add(component_name)
 
-            self._branches = b
+            names = get_scope()
+            if names is None:
+                return self._branches
+            return self._branches.restricted_to(names)
 
-        return self._branches
+    def _get_all_components(self):
+        with self._lock:
+            if self._components is None:
+                c = []
+                for i in config.cfg.items(config.MUXED_COMPONENTS_SECTION):
+                    c.append({'name': i[0], 'url': i[1]})
+                c.sort(key=lambda x: x['name'])
+                self._components = c
+            return self._components
 
     def get_components(self):
-        if self._components is None:
-            c = []
-            for i in config.cfg.items(config.MUXED_COMPONENTS_SECTION):
-                c.append({'name': i[0], 'url': i[1]})
-            c.sort(key=lambda x: x['name'])
-            self._components = c
-            print('Engine._components = %s' % str(self._components))
-        return self._components
+        '''
+        Return the muxed components that the current command works on; see
+        set_scope().
+        '''
+        names = get_scope()
+        if names is None:
+            return self._get_all_components()
+        return [c for c in self._get_all_components() if c['name'] in names]
+
+    def set_scope(self, only=None, exclude=None):
+        '''
+        Limit the current thread's command to some components. only and
+        exclude are lists of terms; each term is the name of a group in the
+        "component groups" config section, or a glob that matches component
+        names. Passing neither removes any limit.
+        '''
+        if not only and not exclude:
+            _scope.names = None
+            return
+        everything = [c['name'] for c in self._get_all_components()]
+        groups = config.cfg.get_shared_items(config.COMPONENT_GROUPS_SECTION)
+        names = set(everything)
+        if only:
+            names = _select_components(only, everything, groups)
+        if exclude:
+            names -= _select_components(exclude, everything, groups)
+        _scope.names = names
+
+    def get_branch_stats(self):
+        '''
+        Describe how every muxed branch relates to develop. Returns a dict of
+        component name -> branch name -> stats, where stats is a dict with
+        "ahead" and "behind" commit counts, the "merge_base" SHA, and the
+        "committed" time (seconds since epoch) of the branch tip.
+
+        Counts are cached by the (branch SHA, develop SHA) pair, so only
+        branches that moved since the last call cost us any git work.
+        '''
+        # Scan branches up front; this parks every component on scratch.
+        self.get_branches()
+        gits = {}
+        for c in self.get_components():
+            gits[c['name']] = self._get_git_instance_for_component(c['name'])
+
+        def compute(component_name):
+            git = gits[component_name]
+            with ComponentLock(component_name, shared=True, wait=False):
+                tips = _get_branch_tips(git)
+            develop = _get_gitflow_branch(git, 'develop')
+            if develop not in tips:
+                return {}
+            develop_sha = tips[develop][0]
+            stats = {}
+            for branch_name, (sha, committed) in tips.items():
+                if branch_name in [develop, _SCRATCH_BRANCH_NAME]:
+                    continue
+                key = '%s-%s' % (sha, develop_sha)
+                entry = _branch_stats_cache.get(key)
+                if entry is None:
+                    counts = git.rev_list('--left-right', '--count', '%s...%s' % (develop_sha, sha)).split()
+                    entry = {'behind': int(counts[0]), 'ahead': int(counts[1]),
+                             'merge_base': git.merge_base(develop_sha, sha)}
+                    _branch_stats_cache.put(key, entry)
+                entry = dict(entry)
+                entry['committed'] = committed
+                stats[branch_name] = entry
+            return stats
+
+        outcomes = parallel.run_all(compute, sorted(gits.keys()))
+        _branch_stats_cache.save()
+        result = {}
+        for outcome in outcomes:
+            if outcome.error:
+                raise outcome.error
+            result[outcome.item] = outcome.result
+        return result
 
     def add_component_to_branch(self, component, branch):
         _find_by_name(self.get_components(), component, 'Component')
@@ -105,52 +521,433 @@ class Engine:
     def _get_git_instance_for_component(self, component_name):
         path = os.path.join(_REPO_ROOT, component_name)
         if not os.path.isdir(path):
-            # Lookup component by component_name in our internal table.
-            component = self._find_component_by_name(component_name)
-            os.makedirs(path)
-            sys.stderr.write('Fetching %s repo to %s for the first time...\n' % (component_name, path))
-            git = gitpython.Git(path)
-            git.clone(component['url'], '.')
-            sys.stderr.write('Making sure we have the master branch...\n')
-            if not 'master' in (x.strip().replace('* ', '') for x in git.branch().strip().split('\n')):
-              git.checkout('-t', 'origin/master')
-            sys.stderr.write('Calling git flow init...\n')
-            git.flow('init', '-d')
-            # git flow assumes you'll have only local copies of feature
-            # branches. We want to link ours to what's on the remote...
-            remote_branches = [x.strip() for x in git.branch('-a').strip().split('\n')]
-            remote_branches = [x[15:] for x in remote_branches if x.startswith('remotes/origin/') and '/' in x]
-            remote_branches = [x for x in remote_branches if _VALID_BRANCH_TYPES_PAT.match(x[0:x.find('/')])]
-            for rb in remote_branches:
-                sys.stderr.write('Checking out remote branch %s...\n' % rb)
-                git.checkout('-b', rb, 'origin/%s' % rb)
-
-            git.branch(_SCRATCH_BRANCH_NAME)
-        else:
-            sys.stderr.write('Using %s in %s.\n' % (component_name, path))
-            git = gitpython.Git(path)
+            git = self._create_component_repo(component_name, self._clone_component)
+            if git:
+                return git
+        sys.stderr.write('Using %s in %s.\n' % (component_name, path))
+        return _MuxGit(path, component_name)
+
+    def _create_component_repo(self, component_name, populate):
+        # Make a component's local repo by calling populate(component_name,
+        # path), holding the component's lock. Returns the new repo's git
+        # instance, or None if the repo already exists.
+        path = os.path.join(_REPO_ROOT, component_name)
+        with ComponentLock(component_name):
+            # Another git-mux run may have made it while we waited.
+            if os.path.isdir(path):
+                return None
+            try:
+                return populate(component_name, path)
+            except:
+                # Don't let a half-made repo pass for a real one next time.
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                raise
+
+    def _clone_component(self, component_name, path):
+        # Lookup component by component_name in our internal table.
+        component = self._find_component_by_name(component_name)
+        os.makedirs(path)
+        sys.stderr.write('Fetching %s repo to %s for the first time...\n' % (component_name, path))
+        git = _MuxGit(path, component_name)
+        # Clone just the default branch, then fetch the branches we mux.
+        # The refspecs we set for that stay behind, so every later fetch
+        # and pull asks origin for nothing else.
+        options = ['--single-branch', '--config', 'protocol.version=2']
+        refspecs = _get_fetch_refspecs(None, [])
+        m = None
+        if mirror.get_folder():
+            # Borrow objects from the host's mirror, then copy the ones we
+            # need (as --dissociate would), so this repo doesn't break if
+            # the mirror is evicted.
+            with mirror.Mirror(component['url'], _MuxGit(mirror.get_folder(), component_name)) as m:
+                if m:
+                    git.clone('--reference', m.path, *(options + [component['url'], '.']))
+                    _set_fetch_refspecs(git, refspecs)
+                    git.fetch('-q', 'origin')
+                    git.repack('-a', '-d', '-q')
+                    os.remove(os.path.join(path, '.git', 'objects', 'info', 'alternates'))
+        if not m:
+            git.clone(*(options + [component['url'], '.']))
+            _set_fetch_refspecs(git, refspecs)
+            git.fetch('-q', 'origin')
+        self._prepare_new_repo(git)
         return git
 
+    def _prepare_new_repo(self, git):
+        # Set up a freshly populated repo the way the rest of the engine
+        # expects: master checked out, git flow initialized, local branches
+        # tracking the remote's git-flow branches, and a scratch branch.
+        sys.stderr.write('Making sure we have the master branch...\n')
+        if not 'master' in (x.strip().replace('* ', '') for x in git.branch().strip().split('\n')):
+          git.checkout('-t', 'origin/master')
+        sys.stderr.write('Calling git flow init...\n')
+        gitflow.init(git)
+        # git flow assumes you'll have only local copies of feature
+        # branches. We want to link ours to what's on the remote...
+        remote_branches = [x.strip() for x in git.branch('-a').strip().split('\n')]
+        remote_branches = [x[15:] for x in remote_branches if x.startswith('remotes/origin/') and '/' in x]
+        remote_branches = [x for x in remote_branches if _VALID_BRANCH_TYPES_PAT.match(x[0:x.find('/')])]
+        for rb in remote_branches:
+            sys.stderr.write('Checking out remote branch %s...\n' % rb)
+            git.checkout('-b', rb, 'origin/%s' % rb)
+
+        git.branch(_SCRATCH_BRANCH_NAME)
+
+    def create_bundles(self, folder):
+        '''
+        Write a git bundle of origin's branches and the tags for every muxed
+        component into folder, plus a manifest of the refs in each. Returns
+        the number of components that failed.
+        '''
+        folder = os.path.abspath(folder)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        components = self.get_components()
+        gits = {}
+        for c in components:
+            gits[c['name']] = self._get_git_instance_for_component(c['name'])
+        def create(c):
+            git = gits[c['name']]
+            with ComponentLock(c['name'], shared=True):
+                refs = _get_bundle_refs(git)
+                if not refs:
+                    return (1, None, 'Nothing to bundle.'), None
+                fname = c['name'] + _BUNDLE_EXTENSION
+                exit_code, stdout, stderr = git.bundle('create', os.path.join(folder, fname), *sorted(refs.keys()),
+                                                       with_extended_output=True, with_exceptions=False)
+                if exit_code:
+                    return (exit_code, stdout, stderr), None
+            entry = {'url': c['url'], 'bundle': fname, 'refs': refs}
+            return (0, 'Bundled %d refs in %s.' % (len(refs), fname), None), entry
+        manifest = _read_bundle_manifest(folder) or {'components': {}}
+        failed = 0
+        for outcome in parallel.run_all(create, components):
+            component_name = outcome.item['name']
+            _report_component_start(component_name, 'bundle')
+            if outcome.error:
+                raise outcome.error
+            result, entry = outcome.result
+            _report_flow_result(component_name, result, 0)
+            if entry:
+                manifest['components'][component_name] = entry
+            else:
+                failed += 1
+        manifest['created'] = time.strftime('%Y-%m-%d %H:%M:%SZ', time.gmtime())
+        with open(os.path.join(folder, _BUNDLE_MANIFEST_FNAME), 'w') as f:
+            json.dump(manifest, f, indent=2, separators=(',', ': '), sort_keys=True)
+        return failed
+
+    def load_bundles(self, folder):
+        '''
+        Populate the data folder from bundles that create_bundles() wrote,
+        for every muxed component that isn't there yet. Only what changed
+        since the bundles were made comes over the network. Returns the
+        number of components that failed.
+        '''
+        folder = os.path.abspath(folder)
+        manifest = _read_bundle_manifest(folder)
+        if manifest is None:
+            die('%s has no bundle manifest (%s).' % (folder, _BUNDLE_MANIFEST_FNAME))
+        entries = manifest.get('components', {})
+        def load(c):
+            entry = entries.get(c['name'])
+            if not entry:
+                return 1, None, 'No bundle for this component in %s.' % folder
+            bundle_path = os.path.join(folder, entry['bundle'])
+            def populate(component_name, path):
+                return self._load_component_from_bundle(component_name, path, bundle_path)
+            start = time.time()
+            if self._create_component_repo(c['name'], populate) is None:
+                return 0, 'Already present; bundle not needed.', None
+            return 0, 'Loaded from %s in %.1fs.' % (entry['bundle'], time.time() - start), None
+        return _report_outcomes('bundle', parallel.run_all(load, self.get_components()))
+
+    def _load_component_from_bundle(self, component_name, path, bundle_path):
+        component = self._find_component_by_name(component_name)
+        os.makedirs(path)
+        sys.stderr.write('Loading %s repo into %s from %s...\n' % (component_name, path, bundle_path))
+        git = _MuxGit(path, component_name)
+        git.init('-q')
+        git.fetch('-q', bundle_path, 'refs/remotes/origin/*:refs/remotes/origin/*', 'refs/tags/*:refs/tags/*')
+        git.remote('add', 'origin', component['url'])
+        git.config('protocol.version', '2')
+        # git flow init hasn't run yet, so the repo has no names of its own.
+        _set_fetch_refspecs(git, _get_fetch_refspecs(None, []))
+        # The bundle may be days old; catch up with whatever changed since.
+        sys.stderr.write('Fetching what changed in %s since the bundle was made...\n' % component_name)
+        git.fetch('-q', '--tags', 'origin')
+        self._prepare_new_repo(git)
+        return git
+
+    def save_snapshot(self, name):
+        '''
+        Record the SHA of every local branch in every muxed component, under
+        name. Returns the number of components that failed.
+        '''
+        path = _get_snapshot_path(name)
+        self.get_branches()
+        components = self.get_components()
+        snapshot = {'name': name, 'components': {}}
+        def save(c):
+            git = self._get_git_instance_for_component(c['name'])
+            with ComponentLock(c['name'], shared=True):
+                tips = _get_branch_tips(git)
+            branches = dict((b, tip[0]) for b, tip in tips.items() if b != _SCRATCH_BRANCH_NAME)
+            snapshot['components'][c['name']] = {'url': c['url'], 'branches': branches}
+            return 0, 'Saved %d branches.' % len(branches), None
+        failed = _report_outcomes('snapshot', parallel.run_all(save, components))
+        if failed:
+            return failed
+        snapshot['created'] = time.strftime('%Y-%m-%d %H:%M:%SZ', time.gmtime())
+        if not os.path.isdir(_SNAPSHOT_FOLDER):
+            os.makedirs(_SNAPSHOT_FOLDER)
+        with open(path, 'w') as f:
+            json.dump(snapshot, f, indent=2, separators=(',', ': '), sort_keys=True)
+        sys.stderr.write('Saved snapshot %s to %s.\n' % (name, path))
+        return 0
+
+    def get_snapshot_names(self):
+        if not os.path.isdir(_SNAPSHOT_FOLDER):
+            return []
+        return sorted(x[:-5] for x in os.listdir(_SNAPSHOT_FOLDER) if x.endswith('.json'))
+
+    def restore_snapshot(self, name, force=False):
+        '''
+        Put every branch in a snapshot back at the SHA it had, creating
+        branches that are gone, and fetching only commits we don't have.
+        Branches that have moved since are left alone unless force is True.
+        Returns the number of components that failed.
+        '''
+        path = _get_snapshot_path(name)
+        if not os.path.isfile(path):
+            die('There is no snapshot named "%s".' % name)
+        with open(path) as f:
+            entries = json.load(f)['components']
+        self.get_branches()
+        def restore(c):
+            entry = entries.get(c['name'])
+            if entry is None:
+                return None, 'Not in this snapshot.', None
+            git = self._get_git_instance_for_component(c['name'])
+            with ComponentLock(c['name']):
+                return self._restore_component(c['name'], git, entry['branches'], force)
+        return _report_outcomes('snapshot', parallel.run_all(restore, self.get_components()))
+
+    def _restore_component(self, component_name, git, branches, force):
+        missing = [sha for sha in set(branches.values()) if not _has_commit(git, sha)]
+        if missing:
+            # Ask for just the commits we lack. Servers that won't hand out
+            # commits by SHA get an ordinary fetch instead.
+            exit_code, stdout, stderr = git.fetch('-q', 'origin', *missing, with_extended_output=True, with_exceptions=False)
+            if exit_code:
+                git.fetch('-q', 'origin')
+            lost = [sha for sha in missing if not _has_commit(git, sha)]
+            if lost:
+                return 1, None, 'Can\'t find %s on origin.' % ', '.join(sha[0:10] for sha in lost)
+        tips = _get_branch_tips(git)
+        current = git.rev_parse('--abbrev-ref', 'HEAD')
+        created, moved, skipped = [], [], []
+        for branch_name in sorted(branches.keys()):
+            sha = branches[branch_name]
+            tip = tips.get(branch_name)
+            if tip is None:
+                git.update_ref('refs/heads/%s' % branch_name, sha, '0' * 40)
+                self.get_branches().add(branch_name, component_name)
+                created.append(branch_name)
+            elif tip[0] != sha:
+                if not force:
+                    skipped.append(branch_name)
+                    continue
+                if branch_name == current:
+                    git.checkout(_SCRATCH_BRANCH_NAME)
+                    current = _SCRATCH_BRANCH_NAME
+                git.update_ref('refs/heads/%s' % branch_name, sha, tip[0])
+                moved.append(branch_name)
+        lines = ['%d branches already matched.' % (len(branches) - len(created) - len(moved) - len(skipped))]
+        if created:
+            lines.append('Created %s.' % ', '.join(created))
+        if moved:
+            lines.append('Moved %s.' % ', '.join(moved))
+        if skipped:
+            return 1, '\n'.join(lines), '%s moved since the snapshot; use --force to move them back.' % ', '.join(skipped)
+        return 0, '\n'.join(lines), None
+
+    def sync(self, state=None):
+        '''
+        Fetch every muxed component at once, then fast-forward each local
+        branch that is strictly behind its upstream by updating its ref
+        directly--no checkouts. Branches that have diverged from their
+        upstreams are reported and left alone. Returns the number of
+        components that failed.
+        '''
+        # Scanning branches parks every component on the scratch branch, so
+        # do it up front, one component at a time.
+        self.get_branches()
+        components = self.get_components()
+        gits = {}
+        for c in components:
+            gits[c['name']] = self._get_git_instance_for_component(c['name'])
+        if state is None:
+            state = _FlowState('sync')
+        diverged = []
+        def sync(c):
+            start = time.time()
+            result = (1, None, None)
+            try:
+                # Fetching only touches remote-tracking refs, so it needn't
+                # keep other runs out of the component while it waits on
+                # the network; only moving local branches does.
+                with ComponentLock(c['name'], shared=True):
+                    result = gits[c['name']].fetch('-q', '--prune', 'origin', with_extended_output=True, with_exceptions=False)
+                if result[0]:
+                    return result
+                with ComponentLock(c['name']):
+                    result, lost = _fast_forward_branches(gits[c['name']])
+                diverged.extend('%s %s' % (c['name'], branch_name) for branch_name in lost)
+                return result
+            finally:
+                state.record(c['name'], result, time.time() - start)
+        expected = schedule.history.predict(gits.keys(), 'sync')
+        start = time.time()
+        outcomes = parallel.run_all(sync, components, priority=_get_priority(expected))
+        failed = _report_outcomes('sync', outcomes, state.seconds)
+        _report_slowest(state.seconds)
+        _report_schedule(expected, state.seconds, time.time() - start)
+        for line in network.stats.get_report():
+            ui.eprintc(line, ui.WARNING_COLOR)
+        network.stats.save()
+        if diverged:
+            ui.eprintc('Diverged from upstream, so left alone: %s.' % ', '.join(sorted(diverged)), ui.WARNING_COLOR)
+        schedule.history.save()
+        # Keep "find" current with what we just fetched.
+        self.update_index([outcome.item for outcome in outcomes if not outcome.error])
+        return failed
+
+    def find(self, term, update=False):
+        '''
+        Return the index.Commits that mention term (a ticket ID, text in the
+        subject, or the start of a SHA), newest first. Answers come straight
+        from the commit index, which sync keeps up to date; components it
+        has never seen are indexed first. With update, every component is
+        rescanned first, to pick up commits made since the last sync.
+        '''
+        components = self.get_components()
+        commit_index = index.get()
+        if update:
+            self.update_index(components)
+        else:
+            self.update_index([c for c in components if not commit_index.get_tips(c['name'])])
+        def contains(component_name, sha, branches):
+            # The index only has the trunk's rows for older commits; ask git
+            # which other branches have those.
+            git = self._get_git_instance_for_component(component_name)
+            if not set(branches) & set(_get_trunk_branches(git)):
+                return []
+            stdout = git.for_each_ref('--contains', sha, '--format=%(refname)', 'refs/heads/', 'refs/remotes/')
+            names = [re.sub('^refs/(heads|remotes)/', '', x) for x in stdout.split('\n') if not x.endswith('/HEAD')]
+            return [x for x in names if x and x != _SCRATCH_BRANCH_NAME]
+        return commit_index.find(term, [c['name'] for c in components], contains)
+
+    def update_index(self, components):
+        '''
+        Bring the commit index up to date with these components' branches.
+        Returns how many commits were new to it.
+        '''
+        if not components:
+            return 0
+        commit_index = index.get()
+        old_tips = dict((c['name'], commit_index.get_tips(c['name'])) for c in components)
+        ticket_pat = index.get_ticket_pattern()
+        def scan(c):
+            git = self._get_git_instance_for_component(c['name'])
+            # Only refs and objects are read, so don't wait on a busy writer.
+            with ComponentLock(c['name'], shared=True, wait=False):
+                return index.scan(git, old_tips[c['name']], [_SCRATCH_BRANCH_NAME], ticket_pat, _get_trunk_branches(git))
+        start = time.time()
+        added = 0
+        for outcome in parallel.run_all(scan, components):
+            if outcome.error:
+                if not isinstance(outcome.error, gitpython.GitCommandError):
+                    raise outcome.error
+                ui.eprintc('Couldn\'t index %s: %s' % (outcome.item['name'], outcome.error), ui.WARNING_COLOR)
+                continue
+            added += commit_index.apply(outcome.item['name'], outcome.result)
+        if added:
+            sys.stderr.write('Indexed %d new commits in %.1fs.\n' % (added, time.time() - start))
+        return added
+
+    def exec_command(self, argv, state=None):
+        '''
+        Run argv in every muxed component's working tree, several at a time,
+        and report each component's output in order. A single-item argv is
+        run by the shell. Returns the number of components that failed.
+        '''
+        # Scanning branches parks every component on the scratch branch, so
+        # do it up front, one component at a time.
+        self.get_branches()
+        components = self.get_components()
+        gits = {}
+        for c in components:
+            gits[c['name']] = self._get_git_instance_for_component(c['name'])
+        streaming = ui.json_mode()
+        if state is None:
+            state = _FlowState('exec')
+        def run(c):
+            if streaming:
+                _report_component_start(c['name'], 'exec')
+            start = time.time()
+            with ComponentLock(c['name']):
+                result = _run_in_component(c['name'], gits[c['name']], argv)
+            seconds = time.time() - start
+            state.record(c['name'], result, seconds)
+            if streaming:
+                _report_exec_result(c['name'], result, seconds)
+            return result, seconds
+        expected = schedule.history.predict(gits.keys(), 'exec')
+        start = time.time()
+        outcomes = parallel.run_all(run, components, priority=_get_priority(expected))
+        for outcome in outcomes:
+            if not streaming:
+                _report_component_start(outcome.item['name'], 'exec')
+            if outcome.error:
+                raise outcome.error
+            if not streaming:
+                _report_exec_result(outcome.item['name'], *outcome.result)
+        _report_slowest(state.seconds)
+        _report_schedule(expected, state.seconds, time.time() - start)
+        schedule.history.save()
+        failed = [c['name'] for c in components if c['name'] in state.failed]
+        if ui.json_mode():
+            ui.emit('exec_finished', components=len(components), failed=failed)
+        elif failed:
+            ui.eprintc('Failed in %d of %d components: %s.' % (len(failed), len(components), ', '.join(failed)), ui.ERROR_COLOR)
+        return len(failed)
+
     def _flow_list(self, state, component_name, git, *args):
-        exit_code, stdout, stderr = git.flow(*args, with_extended_output=True, with_exceptions=False)
+        exit_code, stdout, stderr = gitflow.run(git, *args, sink=_get_stdout_sink())
         return exit_code, stdout, stderr
 
     def _flow_start(self, state, component_name, git, *args):
         named_args, branch_type, branch_name, full_branch_name = _parse_flow_args(*args)
 
-        if state.i == 0:
-            if not _VALID_BRANCH_NAMES_PAT.match(branch_name):
-                raise Exception('Branch names must consist entirely of lower-case letters and hyphens; "%s" is invalid.' % branch_name)
-            state.components_with_branch = self.get_branches().by_branch_name.get(full_branch_name)
-            if not state.components_with_branch:
-                state.components_with_branch = []
+        with state.lock:
+            if state.components_with_branch is None:
+                if not _VALID_BRANCH_NAMES_PAT.match(branch_name):
+                    raise Exception('Branch names must consist entirely of lower-case letters and hyphens; "%s" is invalid.' % branch_name)
+                state.components_with_branch = self.get_branches().by_branch_name.get(full_branch_name)
+                if not state.components_with_branch:
+                    state.components_with_branch = []
+
+        if '--fast' in args:
+            return self._fast_start(state, component_name, git, full_branch_name)
 
         if component_name in state.components_with_branch:
             exit_code, stdout, stderr = None, 'Branch %s already started.' % full_branch_name, None
             git.checkout(full_branch_name)
             git.pull('origin', full_branch_name)
         else:
-            exit_code, stdout, stderr = git.flow(*args, with_extended_output=True, with_exceptions=False)
+            exit_code, stdout, stderr = gitflow.run(git, *args)
             if not exit_code:
                 stdout = 'Branch %s started.' % full_branch_name
                 self.get_branches().add(full_branch_name, component_name)
@@ -168,6 +965,35 @@ class Engine:
 
         return exit_code, stdout, stderr
 
+    def _fast_start(self, state, component_name, git, full_branch_name):
+        # Most of the time, starting a branch everywhere doesn't need a working
+        # tree at all. Create the branch on the remote directly from origin's
+        # develop, then write the matching local refs ourselves. That's one
+        # fetch and one push per component, with no checkouts--so this runs
+        # in all components at once.
+        if component_name in state.components_with_branch:
+            git.push('--set-upstream', 'origin', full_branch_name)
+            return None, 'Branch %s already started.' % full_branch_name, None
+
+        develop = _get_gitflow_branch(git, 'develop')
+        exit_code, stdout, stderr = git.fetch('origin', develop, with_extended_output=True, with_exceptions=False)
+        if exit_code:
+            return exit_code, stdout, stderr
+        sha = git.rev_parse('refs/remotes/origin/%s' % develop)
+        exit_code, stdout, stderr = git.push('origin', '%s:refs/heads/%s' % (sha, full_branch_name),
+                                             with_extended_output=True, with_exceptions=False)
+        if exit_code:
+            return exit_code, stdout, stderr
+        # An all-zero old value makes update-ref refuse to clobber a branch
+        # that appeared since we scanned.
+        git.update_ref('refs/heads/%s' % full_branch_name, sha, '0' * 40)
+        git.update_ref('refs/remotes/origin/%s' % full_branch_name, sha)
+        # git won't track a remote branch that no fetch refspec asks for.
+        _sync_fetch_refspecs(component_name, git, _get_branch_tips(git).keys())
+        git.branch('--set-upstream-to=origin/%s' % full_branch_name, full_branch_name)
+        self.get_branches().add(full_branch_name, component_name)
+        return 0, 'Branch %s started at %s.' % (full_branch_name, sha[0:10]), None
+
     def _prep_for_existing_branch(self, state, *args):
         # Map args to "git flow" into variables. Remember them.
         state.named_args, state.branch_type, state.branch_name, state.full_branch_name = _parse_flow_args(*args)
@@ -178,28 +1004,48 @@ class Engine:
             raise Exception('Branch "%s" is not recognized.' % state.full_branch_name)
 
         # See which components use this branch.
-        if state.i == 0:
-            state.components_with_branch = branches.by_branch_name.get(state.full_branch_name)
-            if not state.components_with_branch:
-                state.components_with_branch = []
+        with state.lock:
+            if state.components_with_branch is None:
+                state.components_with_branch = branches.by_branch_name.get(state.full_branch_name)
+                if not state.components_with_branch:
+                    state.components_with_branch = []
 
     def _flow_finish(self, state, component_name, git, *args):
         self._prep_for_existing_branch(state, *args)
 
         if component_name in state.components_with_branch:
-            # Switch to the correct branch and run git flow's finish.
+            # Switch to the correct branch and run git flow's finish. It keeps
+            # the branch, whatever was asked; nothing should be deleted until
+            # the merge has reached origin.
             git.checkout(state.full_branch_name)
-            exit_code, stdout, stderr = git.flow(*args, with_extended_output=True, with_exceptions=False)
-            if not exit_code:
-                stdout = 'Branch %s finished.' % state.full_branch_name
-                # At this point, we've merged the feature branch into local's copy of "develop",
-                # and we've deleted the feature branch locally. We now need to delete the remote
-                # version as well, and then push local develop to remote.
-                # Git's quirky way to delete a remote branch is to push <nothing> (the empty string)
-                # to the branch you want to delete on origin...
-                git.push('origin', ':%s' % state.full_branch_name)
-                git.push() # Active branch = "develop"; push that as well.
-            return exit_code, stdout, stderr
+            keep = gitflow.has_flag(args, 'k')
+            finish_args = list(args) if keep else list(args) + ['-k']
+            # We report a one-line summary instead of what git flow says, so
+            # don't hold on to its stdout.
+            exit_code, stdout, stderr = gitflow.run(git, *finish_args, sink=_discard)
+            if exit_code:
+                return exit_code, stdout, stderr
+            # At this point, we've merged the branch into local's copy of
+            # "develop" (and for releases and hotfixes, "master", with a
+            # tag). Push those first; if origin won't take them, the branch
+            # stays put on both sides, so nothing is lost.
+            refs = [_get_gitflow_branch(git, 'develop')]
+            if state.branch_type != 'feature':
+                refs += [_get_gitflow_branch(git, 'master'),
+                         'refs/tags/%s' % gitflow.get_tag_name(git, state.branch_name)]
+            exit_code, stdout, stderr = git.push('origin', *refs, with_extended_output=True, with_exceptions=False)
+            if exit_code:
+                problem = 'Merged %s locally, but couldn\'t push the result; kept the branch.' % state.full_branch_name
+                return exit_code, None, '\n'.join([x for x in [stderr, problem] if x])
+            if not keep:
+                # It's merged, so forcing the delete only skips git's
+                # complaint that its upstream hasn't caught up.
+                git.branch('-D', state.full_branch_name)
+                self.get_branches().remove(state.full_branch_name, component_name)
+            # Git's quirky way to delete a remote branch is to push <nothing>
+            # (the empty string) to the branch you want to delete on origin...
+            git.push('origin', ':%s' % state.full_branch_name)
+            return 0, 'Branch %s finished.' % state.full_branch_name, None
         else:
             return None, None, None
 
@@ -219,7 +1065,7 @@ class Engine:
         if component_name in state.components_with_branch:
             git.checkout(state.full_branch_name)
             args.insert(2, remote)
-            exit_code, stdout, stderr = git.flow(*args, with_extended_output=True)
+            exit_code, stdout, stderr = gitflow.run(git, *args)
             return exit_code, stdout, stderr
 
     def _flow_push(self, state, component_name, git, *args):
@@ -239,21 +1085,59 @@ class Engine:
 
         if component_name in state.components_with_branch:
             git.checkout(state.full_branch_name)
-            exit_code, stdout, stderr = git.flow(*args, with_extended_output=True)
+            exit_code, stdout, stderr = gitflow.run(git, *args, sink=_get_stdout_sink())
             return exit_code, stdout, stderr
 
     def _flow_diff(self, state, component_name, git, *args):
         self._prep_for_existing_branch(state, *args)
 
         if component_name in state.components_with_branch:
-            git.checkout(state.full_branch_name)
-            exit_code, stdout, stderr = git.flow(*args, with_extended_output=True)
-            return exit_code, stdout, stderr
+            # Compare the branch tip to the point where it left develop, the
+            # same way "git flow diff" does--but straight from the object
+            # database, so we never have to check anything out.
+            head = git.rev_parse('refs/heads/%s' % state.full_branch_name)
+            base = git.merge_base(_get_gitflow_branch(git, 'develop'), head)
+            summary = [arg for arg in args if arg in _DIFF_SUMMARY_SWITCHES][0:1]
+            # A diff between two commits never changes, so reviewing an
+            # unchanged branch again is just a file read.
+            key = '%s-%s-%s' % (base, head, (summary + ['full'])[0].lstrip('-'))
+            # Diffs can be huge, so they go straight to the screen (and the
+            # cache) as they arrive, rather than being collected first. JSON
+            # consumers get the diff in the result's stdout, as they always
+            # have.
+            collected = []
+            out = _get_stdout_sink() or collected.append
+            cached = _diff_cache.open(key)
+            if cached is not None:
+                with cached:
+                    size, txt = 0, u''
+                    for txt in iter(lambda: cached.read(_STREAM_CHUNK_BYTES), u''):
+                        out(txt)
+                        size += len(txt)
+                if txt and not txt.endswith('\n'):
+                    out('\n')
+            else:
+                writer = _diff_cache.writer(key)
+                def sink(txt):
+                    writer.write(txt)
+                    out(txt)
+                try:
+                    exit_code, size, stderr = git.stream('diff', *(summary + [base, head]), sink=sink)
+                except:
+                    writer.discard()
+                    raise
+                if exit_code:
+                    writer.discard()
+                    return exit_code, None, stderr
+                writer.commit()
+            if not size:
+                return 0, 'No differences from develop.', None
+            if collected:
+                return 0, u''.join(collected).rstrip('\n'), None
+            return 0, None, None
 
     def _flow_help(self, *args):
-        git = gitpython.Git()
-        x = git.flow(*args, as_process=True)
-        stdout, stderr = x.proc.communicate()
+        stdout = gitflow.get_help(_MuxGit(), *args)
         # A few gitflow operations are not supported.
         stdout = _SUPPRESS_GITFLOW_LINE_PAT.sub('', stdout)
         # Tell users to call git flow through git mux.
@@ -265,9 +1149,17 @@ class Engine:
         stdout = stdout.replace('[<name|nameprefix>]', '<name>')
         # On the "pull" operation, we require name as well.
         stdout = stdout.replace('[<name>]', '<name>')
-        print(stdout)
+        ui.printc(stdout)
 
     def flow(self, *args):
+        state = _FlowState()
+        self._flow(state, *args)
+        if state.failed:
+            components = self.get_components()
+            failed = [c['name'] for c in components if c['name'] in state.failed]
+            die('Failed in %d of %d components: %s.' % (len(failed), len(components), ', '.join(failed)))
+
+    def _flow(self, state, *args):
 
         if not args:
             args = ['help']
@@ -278,7 +1170,7 @@ class Engine:
 
         first = args[0]
         if first == 'version':
-            print('unknown')
+            ui.printc('unknown')
             return
         elif first == 'init':
             die("Can't mux an init across components; init is inherently a single-component operation.")
@@ -289,32 +1181,224 @@ class Engine:
             try:
                 func = getattr(self, '_flow_' + verb)
             except:
-                die(ui.CMD_COLOR + 'git mux flow ' + first + ' ' + ui.PARAM_COLOR + verb + ui.ERROR_COLOR + ' is an invalid command.' + ui.NORMTXT)
+                die('"git mux flow %s %s" is an invalid command.' % (first, verb))
 
-            class State:
-                def __init__(self):
-                    self.i = 0
+            force = '--force' in args
+            args = [arg for arg in args if arg != '--force']
+            if verb in _PREFLIGHT_FLOW_VERBS:
+                self._preflight(verb, force, *args)
 
-            state = State()
-            for c in self.get_components():
-                component_name = c['name']
-                line_width = 30 - len(component_name)
-                ui.printc('\n' + ui.PARAM_COLOR + component_name + ui.DELIM_COLOR + ' ' + '-'*line_width + ui.NORMTXT)
-                git = self._get_git_instance_for_component(component_name)
+            state.verb = verb
+            if verb in _CHECKOUT_FREE_FLOW_VERBS or _CHECKOUT_FREE_FLOW_SWITCHES.get(verb) in args:
+                self._flow_in_parallel(func, state, *args)
+            else:
+                names = [c['name'] for c in self.get_components()]
+                deps = graph.get_dependencies(names)
+                if [x for x in deps.values() if x]:
+                    self._flow_in_waves(func, state, deps, *args)
+                    path, seconds = graph.get_critical_path(deps, state.seconds)
+                    _report_critical_path(path, seconds, state.seconds)
+                else:
+                    for component_name in names:
+                        _report_component_start(component_name, verb)
+                        result, seconds = self._flow_component(func, state, component_name, *args)
+                        _report_flow_result(component_name, result, seconds)
+            if lock_metrics.contended:
+                sys.stderr.write('%s\n' % lock_metrics)
+            for line in network.stats.get_report():
+                ui.eprintc(line, ui.WARNING_COLOR)
+            network.stats.save()
+            schedule.history.save()
+            if verb == 'diff':
+                _diff_cache.prune()
+
+    def _preflight(self, verb, force, *args):
+        # Finishing or rebasing stops at the first component that conflicts,
+        # after the ones before it have already merged and pushed. So first
+        # work out every component's merge in memory (git merge-tree writes
+        # objects, but no refs and no working tree), all at once, and stop
+        # before changing anything if any of them conflict. A clean merge
+        # onto develop is our stand-in for a clean rebase; git can't replay
+        # a rebase in memory yet. What we merge onto is origin's copy, as of
+        # a fetch just now, since that's what the result gets pushed onto.
+        named_args = [arg for arg in args if not arg.startswith('-')]
+        if len(named_args) < 3:
+            # Let the handler explain what's missing.
+            return
+        named_args, branch_type, branch_name, full_branch_name = _parse_flow_args(*args)
+        targets = ['develop']
+        if verb == 'finish' and branch_type != 'feature':
+            targets = ['master', 'develop']
+        names = self.get_branches().by_branch_name.get(full_branch_name) or []
+        components = [c for c in self.get_components() if c['name'] in names]
+        def check(c):
+            git = self._get_git_instance_for_component(c['name'])
+            conflicts = []
+            # Only remote-tracking refs and objects change, so don't wait on
+            # a busy writer.
+            with ComponentLock(c['name'], shared=True, wait=False):
+                branch_names = [_get_gitflow_branch(git, which) for which in targets]
+                git.fetch('-q', 'origin', *branch_names)
+                for branch_name in branch_names:
+                    target = 'origin/%s' % branch_name
+                    files = _get_merge_conflicts(git, target, full_branch_name)
+                    if files is None:
+                        return None
+                    if files:
+                        conflicts.append((target, files))
+            return conflicts
+        start = time.time()
+        outcomes = parallel.run_all(check, components)
+        conflicted, unchecked, failed = [], [], []
+        for outcome in outcomes:
+            component_name = outcome.item['name']
+            if outcome.error:
+                if not isinstance(outcome.error, gitpython.GitCommandError):
+                    raise outcome.error
+                # The real run will report whatever's wrong here in full.
+                failed.append('%s (%s)' % (component_name, _get_error_summary(outcome.error)))
+                continue
+            if outcome.result is None:
+                unchecked.append(component_name)
+                continue
+            for target, files in outcome.result:
+                conflicted.append(component_name)
+                if ui.json_mode():
+                    ui.emit('conflict', component=component_name, branch=full_branch_name, target=target, files=files)
+                else:
+                    ui.eprintc('%s: %s conflicts with %s in %s.' % (component_name, full_branch_name, target, ', '.join(files)),
+                               ui.ERROR_COLOR)
+        if unchecked:
+            ui.eprintc('Couldn\'t check %s for conflicts; git merge-tree --write-tree needs git 2.38 or later.' % ', '.join(unchecked),
+                       ui.WARNING_COLOR)
+        if failed:
+            ui.eprintc('Couldn\'t check %s for conflicts.' % ', '.join(failed), ui.WARNING_COLOR)
+        sys.stderr.write('Checked %d components for conflicts in %.1fs.\n' % (len(components), time.time() - start))
+        if not conflicted:
+            return
+        count = len(set(conflicted))
+        if not force:
+            die('%s would conflict in %d of %d components; nothing was changed. Resolve the conflicts, or use --force to %s anyway.'
+                % (full_branch_name, count, len(components), verb))
+        ui.eprintc('Going ahead despite conflicts in %d components (--force).' % count, ui.WARNING_COLOR)
+
+    def _flow_component(self, func, state, component_name, *args):
+        # Run one flow handler in one component. Returns (result, seconds).
+        read_only = args[1] in _READ_ONLY_FLOW_VERBS
+        start = time.time()
+        try:
+            git = self._get_git_instance_for_component(component_name)
+            with ComponentLock(component_name, shared=read_only, wait=not read_only):
                 try:
                     result = func(state, component_name, git, *args)
-                    if result:
-                        exit_code, stdout, stderr = result
-                        if exit_code:
-                            if not stderr:
-                                stderr = 'git flow command failed'
-                            ui.eprintc(stderr, ui.ERROR_COLOR)
-                        elif stdout:
-                            print(stdout)
-                    state.i += 1
+                    with state.lock:
+                        state.i += 1
                 finally:
                     # For safety, always reset to scratch branch.
-                    git.checkout(_SCRATCH_BRANCH_NAME)
+                    if not read_only:
+                        git.checkout(_SCRATCH_BRANCH_NAME)
+        except gitpython.GitCommandError as e:
+            # One unreachable remote shouldn't strand the rest of the
+            # components; report it at the end.
+            result = (1, None, str(e))
+        seconds = time.time() - start
+        state.record(component_name, result, seconds)
+        return result, seconds
+
+    def _flow_in_waves(self, func, state, deps, *args):
+        # Components in a wave don't depend on each other, so they run side by
+        # side; each wave waits for the one before it. Output from each
+        # component is held until the wave is done, and reported in order.
+        # A component whose dependency failed is skipped rather than run
+        # against something that didn't land.
+        waves = graph.get_waves([c['name'] for c in self.get_components()], deps)
+        # Scanning branches parks every component on the scratch branch, so
+        # do it up front, one component at a time.
+        self.get_branches()
+        streaming = ui.json_mode()
+        verb = args[1]
+        expected = schedule.history.predict([c['name'] for c in self.get_components()], verb)
+        start = time.time()
+        def run(component_name):
+            if streaming:
+                _report_component_start(component_name, verb)
+                result, seconds = self._flow_component(func, state, component_name, *args)
+                _report_flow_result(component_name, result, seconds)
+                return None, result, seconds
+            with ui.OutputCapture() as capture:
+                result, seconds = self._flow_component(func, state, component_name, *args)
+            return capture, result, seconds
+        for wave in waves:
+            blocked = [x for x in wave if [d for d in deps[x] if d in state.failed]]
+            for component_name in blocked:
+                result = (1, None, 'Skipped because %s failed.' % ', '.join([d for d in deps[component_name] if d in state.failed]))
+                state.record(component_name, result, 0)
+                _report_component_start(component_name, verb)
+                _report_flow_result(component_name, result, 0)
+            outcomes = parallel.run_all(run, [x for x in wave if x not in blocked], priority=expected.get if expected else None)
+            for outcome in outcomes:
+                if outcome.error:
+                    raise outcome.error
+                capture, result, seconds = outcome.result
+                if capture:
+                    _report_component_start(outcome.item, verb)
+                    capture.replay()
+                    _report_flow_result(outcome.item, result, seconds)
+        _report_schedule(expected, state.seconds, time.time() - start, waves)
+
+    def _flow_in_parallel(self, func, state, *args):
+        # The handler never touches the working tree, so there's no need to
+        # park each component on the scratch branch afterward, and nothing
+        # stops us from visiting every component at once. Results are still
+        # reported in component order. Handlers that write refs still get
+        # exclusive locks, so they don't race other runs' ref and config
+        # updates.
+        components = self.get_components()
+        # Scanning branches parks every component on the scratch branch, so
+        # do it up front, one component at a time.
+        self.get_branches()
+        gits = {}
+        for c in components:
+            gits[c['name']] = self._get_git_instance_for_component(c['name'])
+        # In JSON mode, events stream out as they happen instead.
+        streaming = ui.json_mode()
+        read_only = args[1] in _READ_ONLY_FLOW_VERBS
+        def run(c):
+            if streaming:
+                _report_component_start(c['name'], args[1])
+            start = time.time()
+            def work():
+                with ComponentLock(c['name'], shared=read_only, wait=not read_only):
+                    try:
+                        return func(state, c['name'], gits[c['name']], *args)
+                    except gitpython.GitCommandError as e:
+                        return (1, None, str(e))
+            capture = None
+            if streaming:
+                result = work()
+            else:
+                # Handlers may stream output as they go; hold it until it's
+                # this component's turn to report.
+                with ui.OutputCapture() as capture:
+                    result = work()
+            seconds = time.time() - start
+            state.record(c['name'], result, seconds)
+            if streaming:
+                _report_flow_result(c['name'], result, seconds)
+            return capture, result, seconds
+        expected = schedule.history.predict(gits.keys(), args[1])
+        start = time.time()
+        outcomes = parallel.run_all(run, components, priority=_get_priority(expected))
+        for outcome in outcomes:
+            if not streaming:
+                _report_component_start(outcome.item['name'], args[1])
+            if outcome.error:
+                raise outcome.error
+            capture, result, seconds = outcome.result
+            if not streaming:
+                capture.replay()
+                _report_flow_result(outcome.item['name'], result, seconds)
+        _report_schedule(expected, state.seconds, time.time() - start)
 
     def _update_file(self, fname, object_for_json, msg):
         txt = json.dumps(object_for_json, indent=2, separators=(',', ': '))
@@ -351,6 +1435,551 @@ class Engine:
         with EngineLock():
             self._update_file(_BRANCHES_FILE, self._branches, 'revive %s branch' % branch)
 
+    # The API for programs that embed git mux. These methods print nothing
+    # (what the CLI would have printed is in the result's output) and never
+    # exit; bad requests raise MuxError, and components that fail are
+    # reported in the result rather than raised. The *_async variants return
+    # a Future right away, so one process can run many operations at once.
+
+    def run_flow(self, *args, **kwargs):
+        '''
+        Run a git flow operation, as "git mux flow <args>" would, and return
+        an OperationResult. Pass components=[names] to work on just those.
+        '''
+        return self._run_api(lambda state: self._flow(state, *args), kwargs.get('components'))
+
+    def run_exec(self, argv, components=None):
+        '''
+        Run argv in each component's working tree, as "git mux exec" would,
+        and return an OperationResult.
+        '''
+        return self._run_api(lambda state: self.exec_command(argv, state), components, 'exec')
+
+    def run_sync(self, components=None):
+        '''
+        Fetch and fast-forward, as "git mux sync" would, and return an
+        OperationResult.
+        '''
+        return self._run_api(lambda state: self.sync(state), components, 'sync')
+
+    def run_flow_async(self, *args, **kwargs):
+        return _submit(self.run_flow, *args, **kwargs)
+
+    def run_exec_async(self, argv, components=None):
+        return _submit(self.run_exec, argv, components)
+
+    def run_sync_async(self, components=None):
+        return _submit(self.run_sync, components)
+
+    def _run_api(self, work, component_names=None, verb=None):
+        if component_names is not None:
+            known = [c['name'] for c in self._get_all_components()]
+            unknown = [x for x in component_names if x not in known]
+            if unknown:
+                die('%s %s not muxed.' % (', '.join(unknown), 'is' if len(unknown) == 1 else 'are'))
+        # This thread may have run other operations for other callers;
+        # start from a clean slate, and leave one.
+        previous = get_scope()
+        restore_scope(set(component_names) if component_names is not None else None)
+        state = _FlowState(verb)
+        start = time.time()
+        try:
+            with ui.OutputCapture() as capture:
+                work(state)
+        finally:
+            restore_scope(previous)
+        seconds = time.time() - start
+        names = [c['name'] for c in self._get_all_components() if c['name'] in state.results]
+        def get_shas(component_name):
+            # Every component here was just worked on, so its repo exists;
+            # skip the lookup, which talks to stderr.
+            git = _MuxGit(os.path.join(_REPO_ROOT, component_name), component_name)
+            with ComponentLock(component_name, shared=True, wait=False):
+                return dict((name, tip[0]) for name, tip in _get_branch_tips(git).items() if name != _SCRATCH_BRANCH_NAME)
+        shas = {}
+        for outcome in parallel.run_all(get_shas, names):
+            if outcome.error is None:
+                shas[outcome.item] = outcome.result
+        components = []
+        for name in names:
+            exit_code, stdout, stderr = state.results[name] or (0, None, None)
+            components.append(ComponentResult(name, exit_code, stdout, stderr, state.seconds.get(name, 0), shas.get(name)))
+        return OperationResult(state.verb, components, seconds, capture.text())
+
+# Which components the current thread's command works on (None for all).
+_scope = threading.local()
+parallel.inherit(_scope, 'names')
+
+def get_scope():
+    return getattr(_scope, 'names', None)
+
+def restore_scope(names):
+    '''
+    Put back a scope that get_scope() returned, for the current thread.
+    '''
+    _scope.names = names
+
+def _select_components(terms, everything, groups, seen=None):
+    # Expand group names and globs into a set of component names.
+    if seen is None:
+        seen = set()
+    selected = set()
+    for term in terms:
+        term = term.lower()
+        if term in groups:
+            if term not in seen:
+                seen.add(term)
+                members = [x.strip() for x in groups[term].split(',') if x.strip()]
+                selected |= _select_components(members, everything, groups, seen)
+            continue
+        matches = fnmatch.filter(everything, term)
+        if not matches:
+            die('"%s" doesn\'t match any muxed component or component group.' % term)
+        selected.update(matches)
+    return selected
+
+class _FlowState:
+    # Scratchpad shared by all the components that a single flow command
+    # visits. Handlers initialize it lazily, under the lock, because
+    # checkout-free verbs visit components concurrently.
+    def __init__(self, verb=None):
+        self.i = 0
+        self.verb = verb
+        self.lock = threading.RLock()
+        self.components_with_branch = None
+        self.failed = []
+        self.seconds = {}
+        self.results = {}
+    def record(self, component_name, result, seconds):
+        failed = bool(result and result[0])
+        with self.lock:
+            self.seconds[component_name] = seconds
+            self.results[component_name] = result
+            if failed:
+                self.failed.append(component_name)
+        metrics.observe('gitmux_component_duration_seconds', seconds, verb=self.verb or '', component=component_name)
+        # A failure often comes quickly, and says little about next time.
+        if self.verb and not failed:
+            schedule.history.record(component_name, self.verb, seconds)
+
+class ComponentResult:
+    '''
+    How one component fared in an operation run through the API: its exit
+    code (0 for success), what it said on stdout and stderr, how long it
+    took, and the SHA of each of its local branches afterward (a dict).
+    '''
+    def __init__(self, component_name, exit_code, stdout, stderr, seconds, shas):
+        self.component_name = component_name
+        self.exit_code = exit_code or 0
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+        self.shas = shas or {}
+    @property
+    def ok(self):
+        return not self.exit_code
+    def __repr__(self):
+        return '<ComponentResult %s: exit code %s in %.1fs>' % (self.component_name, self.exit_code, self.seconds)
+
+class OperationResult:
+    '''
+    What an API operation did: a ComponentResult for each component it
+    visited (in component order), how long it took in all, and the text
+    the CLI would have printed.
+    '''
+    def __init__(self, verb, components, seconds, output):
+        self.verb = verb
+        self.components = components
+        self.seconds = seconds
+        self.output = output
+    @property
+    def failed(self):
+        return [c.component_name for c in self.components if not c.ok]
+    @property
+    def ok(self):
+        return not self.failed
+    def __getitem__(self, component_name):
+        for c in self.components:
+            if c.component_name == component_name:
+                return c
+        raise KeyError(component_name)
+    def __repr__(self):
+        return '<OperationResult %s: %d components, %d failed, in %.1fs>' % (
+            self.verb, len(self.components), len(self.failed), self.seconds)
+
+class Future:
+    '''
+    The eventual result of one of the API's *_async calls.
+    '''
+    def __init__(self, async_result):
+        self._async_result = async_result
+    def done(self):
+        return self._async_result.ready()
+    def result(self, timeout=None):
+        # Returns the OperationResult, or raises what the operation raised.
+        # Raises multiprocessing.TimeoutError if timeout runs out first.
+        if timeout is None:
+            return parallel.wait(self._async_result)
+        return self._async_result.get(timeout)
+    def exception(self, timeout=None):
+        try:
+            self.result(timeout)
+        except multiprocessing.TimeoutError:
+            raise
+        except Exception as e:
+            return e
+        return None
+
+# How many API operations may run at once in an embedding process.
+_API_THREAD_COUNT = 8
+_api_pool = None
+_api_pool_lock = threading.Lock()
+
+def _submit(func, *args, **kwargs):
+    global _api_pool
+    with _api_pool_lock:
+        if _api_pool is None:
+            _api_pool = ThreadPool(_API_THREAD_COUNT)
+    return Future(_api_pool.apply_async(func, args, kwargs))
+
+def _get_stdout_sink():
+    # Where handlers that stream stdout should send it. In JSON mode, it
+    # belongs in the component's result event, so they collect it instead.
+    if ui.json_mode():
+        return None
+    return ui.writec
+
+def _report_component_start(component_name, verb):
+    if ui.json_mode():
+        ui.emit('component_started', component=component_name, verb=verb)
+        ui.set_component(component_name)
+        return
+    line_width = 30 - len(component_name)
+    ui.printc('\n' + ui.PARAM_COLOR + component_name + ui.DELIM_COLOR + ' ' + '-'*line_width + ui.NORMTXT)
+
+def _report_flow_result(component_name, result, seconds):
+    if ui.json_mode():
+        exit_code, stdout, stderr = result or (None, None, None)
+        ui.emit('result', component=component_name, exit_code=exit_code,
+                stdout=stdout, stderr=stderr, seconds=round(seconds, 3))
+        ui.set_component(None)
+    elif result:
+        exit_code, stdout, stderr = result
+        if exit_code:
+            if not stderr:
+                stderr = 'git flow command failed'
+            ui.eprintc(stderr, ui.ERROR_COLOR)
+        elif stdout:
+            print(stdout)
+
+def _report_exec_result(component_name, result, seconds):
+    exit_code, stdout, stderr = result
+    if ui.json_mode():
+        ui.emit('result', component=component_name, exit_code=exit_code,
+                stdout=stdout, stderr=stderr, seconds=round(seconds, 3))
+        ui.set_component(None)
+        return
+    # Unlike git flow, arbitrary commands often say useful things on both
+    # streams, so show both.
+    if stdout:
+        print(stdout.rstrip('\n'))
+    if stderr:
+        ui.eprintc(stderr.rstrip('\n'), ui.ERROR_COLOR if exit_code else None)
+    if exit_code:
+        ui.eprintc('Exit code %s.' % exit_code, ui.ERROR_COLOR)
+
+_SLOWEST_COUNT = 3
+
+def _report_slowest(all_seconds):
+    slowest = sorted(all_seconds.items(), key=lambda x: x[1], reverse=True)[0:_SLOWEST_COUNT]
+    if ui.json_mode():
+        ui.emit('slowest', components=[{'component': name, 'seconds': round(seconds, 3)} for name, seconds in slowest])
+    elif len(all_seconds) > 1:
+        sys.stderr.write('Slowest: %s.\n' % ', '.join(['%s (%.1fs)' % x for x in slowest]))
+
+def _get_priority(expected):
+    # For parallel.run_all: components we expect to take longest go first.
+    if not expected:
+        return None
+    return lambda c: expected.get(c['name'], 0)
+
+def _report_schedule(expected, actual, seconds, waves=None):
+    report = schedule.get_report(expected, actual, seconds, parallel.get_job_count(), waves)
+    if not report:
+        return
+    if ui.json_mode():
+        ui.emit('schedule', predicted=round(report['predicted'], 3), actual=round(report['actual'], 3), jobs=report['jobs'],
+                misses=[{'component': name, 'predicted': round(p, 3), 'actual': round(a, 3)} for name, p, a in report['misses']])
+    elif len(actual) > 1:
+        misses = ''
+        if report['misses']:
+            misses = ' Furthest off: %s.' % ', '.join(['%s (expected %.1fs, took %.1fs)' % x for x in report['misses']])
+        sys.stderr.write('Expected %.1fs on %d jobs, longest first; took %.1fs.%s\n' % (
+            report['predicted'], report['jobs'], report['actual'], misses))
+
+def _discard(txt):
+    pass
+
+def _report_critical_path(path, seconds, all_seconds):
+    if ui.json_mode():
+        ui.emit('critical_path', components=path, seconds=round(seconds, 3))
+    elif path:
+        sys.stderr.write('Critical path: %s = %.1fs.\n' % (
+            ' -> '.join(['%s (%.1fs)' % (name, all_seconds[name]) for name in path]), seconds))
+
+def _run_in_component(component_name, git, argv):
+    # Run an arbitrary command in a component's working tree, holding its
+    # exclusive lock. Returns (exit_code, stdout, stderr). Whatever the
+    # command does, the component ends up back on the scratch branch.
+    env = dict(os.environ)
+    env['GMUX_COMPONENT'] = component_name
+    with open(os.devnull) as devnull:
+        try:
+            proc = subprocess.Popen(argv if len(argv) > 1 else argv[0], shell=len(argv) == 1, cwd=git.working_dir,
+                                    env=env, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            return 127, None, 'Can\'t run %s: %s' % (argv[0], e.strerror)
+        stdout, stderr = proc.communicate()
+    result = (proc.returncode, stdout, stderr)
+    exit_code, current, ignored = git.rev_parse('--abbrev-ref', 'HEAD', with_extended_output=True, with_exceptions=False)
+    if exit_code or current != _SCRATCH_BRANCH_NAME:
+        exit_code, ignored, problem = git.checkout('-q', _SCRATCH_BRANCH_NAME, with_extended_output=True, with_exceptions=False)
+        if exit_code:
+            # Don't let the next muxed operation start from wherever the
+            # command left us.
+            return 1, stdout, (stderr or '') + 'The command left the working tree off the %s branch, and it can\'t be put back: %s' % (
+                _SCRATCH_BRANCH_NAME, problem)
+    return result
+
+def _get_gitflow_branch(git, which):
+    # Look up the real name of git-flow's "master" or "develop" branch in
+    # this repo, as recorded by "git flow init".
+    return gitflow.get_config(git)['gitflow.branch.%s' % which] or which
+
+def _get_trunk_branches(git):
+    # develop and master, and origin's copies, by their names in the index.
+    names = [_get_gitflow_branch(git, which) for which in ['develop', 'master']]
+    return names + ['origin/%s' % name for name in names]
+
+def _get_merge_conflicts(git, target, branch):
+    # Merge branch into target in memory. Returns the files that would
+    # conflict (an empty list for a clean merge), or None if this git can't
+    # merge in memory.
+    exit_code, stdout, stderr = git.merge_tree('--write-tree', '--name-only', '--no-messages', target, branch,
+                                               with_extended_output=True, with_exceptions=False)
+    if exit_code == 0:
+        return []
+    if exit_code != 1:
+        if 'write-tree' in stderr or 'usage:' in stderr:
+            return None
+        raise gitpython.GitCommandError(['git', 'merge-tree', target, branch], exit_code, stderr, stdout)
+    files = []
+    # The first line is the id of the merged tree; the rest name the
+    # conflicted files, once per conflicting stage.
+    for fname in stdout.split('\n')[1:]:
+        if fname and fname not in files:
+            files.append(fname)
+    return files
+
+# Split the "selected" value in the "muxed branches" section into terms.
+# Older setups wrote it as a python list, brackets, quotes and all.
+_BRANCH_SELECTION_TERM_PAT = re.compile(r'[^\s,\'"\[\]]+')
+_MISSING_REMOTE_BRANCH_PAT = re.compile(r"couldn't find remote ref refs/heads/(\S+)")
+
+def _get_fetch_refspecs(git, local_branches):
+    # Which of origin's branches a component's fetches should ask for:
+    # master, develop, and the git-flow branches that setup's branch
+    # selection names--"all" of them, or the ones we have locally ("mine")
+    # plus any listed. A whole branch type ("feature/") gets a pattern;
+    # anything else is fetched by its exact name. With protocol v2, origin
+    # only advertises refs these name. Pass git=None for a repo that isn't
+    # there yet, which has git-flow's default names.
+    selected = config.cfg.try_get(config.MUXED_BRANCHES_SECTION, config.SELECTED_BRANCHES_KEY, 'mine')
+    terms = _BRANCH_SELECTION_TERM_PAT.findall(selected)
+    if git is None:
+        names = ['master', 'develop']
+    else:
+        names = [_get_gitflow_branch(git, 'master'), _get_gitflow_branch(git, 'develop')]
+    if 'all' in terms:
+        names += ['%s/' % x for x in gitflow.BRANCH_TYPES]
+    else:
+        names += [x for x in terms if x != 'mine']
+        names += sorted([x for x in local_branches if _VALID_BRANCH_TYPES_PAT.match(x.split('/')[0]) and '/' in x])
+    refspecs = []
+    for name in names:
+        if name.endswith('/'):
+            refspec = '+refs/heads/%s*:refs/remotes/origin/%s*' % (name, name)
+        else:
+            refspec = '+refs/heads/%s:refs/remotes/origin/%s' % (name, name)
+        if refspec not in refspecs:
+            refspecs.append(refspec)
+    return refspecs
+
+def _set_fetch_refspecs(git, refspecs):
+    git.config('--replace-all', 'remote.origin.fetch', refspecs[0])
+    for refspec in refspecs[1:]:
+        git.config('--add', 'remote.origin.fetch', refspec)
+
+def _drop_fetch_refspec(git, branch_name):
+    # Stop fetching a branch that origin no longer has, and forget its
+    # remote-tracking ref, as --prune would have if a refspec still named
+    # it. Returns False if no refspec named it (or it's the last one left).
+    refspec = '+refs/heads/%s:refs/remotes/origin/%s' % (branch_name, branch_name)
+    exit_code, stdout, stderr = git.config('--get-all', 'remote.origin.fetch', with_extended_output=True, with_exceptions=False)
+    refspecs = stdout.strip().split('\n')
+    if exit_code or refspec not in refspecs or len(refspecs) == 1:
+        return False
+    _set_fetch_refspecs(git, [x for x in refspecs if x != refspec])
+    git.update_ref('-d', 'refs/remotes/origin/%s' % branch_name, with_exceptions=False)
+    return True
+
+def _sync_fetch_refspecs(component_name, git, local_branches):
+    # Keep a component's fetch refspecs in step with the branch selection
+    # and the branches we've started or finished since last time.
+    refspecs = _get_fetch_refspecs(git, local_branches)
+    exit_code, stdout, stderr = git.config('--get-all', 'remote.origin.fetch', with_extended_output=True, with_exceptions=False)
+    if stdout.strip().split('\n') != refspecs:
+        with ComponentLock(component_name):
+            _set_fetch_refspecs(git, refspecs)
+
+def _fast_forward_branches(git):
+    # Move each local branch that is strictly behind its upstream up to it.
+    # Returns ((exit_code, stdout, stderr), names of diverged branches).
+    refs = {}
+    upstreams = {}
+    stdout = git.for_each_ref('--format=%(refname) %(objectname) %(upstream)', 'refs/heads/', 'refs/remotes/origin/')
+    for line in stdout.strip().split('\n'):
+        fields = line.split()
+        if len(fields) >= 2:
+            refs[fields[0]] = fields[1]
+        if len(fields) == 3 and fields[0].startswith('refs/heads/'):
+            upstreams[fields[0][11:]] = fields[2]
+    current = git.rev_parse('--abbrev-ref', 'HEAD')
+    moved, diverged, ahead, current_behind, raced = [], [], [], [], []
+    matched = 0
+    for branch_name in sorted(upstreams.keys()):
+        sha, upstream_sha = refs['refs/heads/' + branch_name], refs.get(upstreams[branch_name])
+        if branch_name == _SCRATCH_BRANCH_NAME or upstream_sha is None:
+            continue
+        if sha == upstream_sha:
+            matched += 1
+        elif _is_ancestor(git, sha, upstream_sha):
+            if branch_name == current:
+                # Moving the checked-out branch's ref would leave the
+                # working tree behind; that's what "git pull" is for.
+                current_behind.append(branch_name)
+                continue
+            # Passing the old SHA makes update-ref refuse if the branch
+            # moved since we looked; leave such a branch alone.
+            exit_code, stdout, stderr = git.update_ref('-m', 'git-mux sync: fast-forward', 'refs/heads/%s' % branch_name,
+                                                       upstream_sha, sha, with_extended_output=True, with_exceptions=False)
+            if exit_code:
+                raced.append(branch_name)
+            else:
+                moved.append(branch_name)
+        elif _is_ancestor(git, upstream_sha, sha):
+            ahead.append(branch_name)
+        else:
+            diverged.append(branch_name)
+    lines = ['%d branches already current.' % matched]
+    if moved:
+        lines.append('Fast-forwarded %s.' % ', '.join(moved))
+    if ahead:
+        lines.append('Ahead of upstream (not pushed yet): %s.' % ', '.join(ahead))
+    if current_behind:
+        lines.append('Checked out, so not fast-forwarded: %s.' % ', '.join(current_behind))
+    if raced:
+        lines.append('Moved meanwhile, so skipped: %s.' % ', '.join(raced))
+    if diverged:
+        lines.append('Diverged from upstream: %s.' % ', '.join(diverged))
+    return (0, '\n'.join(lines), None), diverged
+
+def _is_ancestor(git, ancestor, descendant):
+    exit_code, stdout, stderr = git.merge_base('--is-ancestor', ancestor, descendant,
+                                               with_extended_output=True, with_exceptions=False)
+    return not exit_code
+
+def _get_branch_tips(git):
+    # Read every local branch's SHA and commit time in a single git call.
+    # Returns branch name -> (sha, commit time in seconds since epoch).
+    tips = {}
+    stdout = git.for_each_ref('--format=%(refname:short) %(objectname) %(committerdate:raw)', 'refs/heads/')
+    for line in stdout.strip().split('\n'):
+        fields = line.split()
+        if len(fields) >= 3:
+            tips[fields[0]] = (fields[1], int(fields[2]))
+    return tips
+
+# Roomy enough for every branch of a few hundred components, as they move.
+_diff_cache = cache.FileCache('diff', max_bytes=256 * 1024 * 1024)
+_branch_stats_cache = cache.JsonCache('branch-stats', max_entries=20000)
+
+_SNAPSHOT_FOLDER = os.path.join(config.DATA_FOLDER, '.git-mux-snapshots')
+_VALID_SNAPSHOT_NAMES_PAT = re.compile(r'^[-_.a-zA-Z0-9]+$')
+
+def _get_snapshot_path(name):
+    if not _VALID_SNAPSHOT_NAMES_PAT.match(name):
+        die('Snapshot names may only contain letters, digits, ".", "-" and "_".')
+    return os.path.join(_SNAPSHOT_FOLDER, name + '.json')
+
+def _get_error_summary(error):
+    # The gist of a GitCommandError: the first thing git called an error, or
+    # else the last thing it said, or else its exit code.
+    stderr = (error.stderr or '').strip()
+    if stderr.startswith("stderr: '") and stderr.endswith("'"):
+        stderr = stderr[len("stderr: '"):-1]
+    lines = [x.strip() for x in stderr.split('\n') if x.strip()]
+    for line in lines:
+        if line.startswith('fatal:') or line.startswith('error:'):
+            return line
+    if lines:
+        return lines[-1]
+    return 'exit code %s' % error.status
+
+def _has_commit(git, sha):
+    exit_code, stdout, stderr = git.cat_file('-e', '%s^{commit}' % sha, with_extended_output=True, with_exceptions=False)
+    return not exit_code
+
+def _report_outcomes(verb, outcomes, seconds=None):
+    # Report parallel.run_all outcomes whose results are (exit_code, stdout,
+    # stderr) tuples, in component order. Git failures count against one
+    # component; anything else is a bug, and stops us. seconds, if given,
+    # says how long each component took. Returns the number of components
+    # that failed.
+    failed = 0
+    for outcome in outcomes:
+        component_name = outcome.item['name']
+        _report_component_start(component_name, verb)
+        result = outcome.result
+        if outcome.error:
+            if not isinstance(outcome.error, gitpython.GitCommandError):
+                raise outcome.error
+            result = (1, None, str(outcome.error))
+        _report_flow_result(component_name, result, (seconds or {}).get(component_name, 0))
+        if result and result[0]:
+            failed += 1
+    return failed
+
+_BUNDLE_EXTENSION = '.bundle'
+_BUNDLE_MANIFEST_FNAME = 'manifest.json'
+
+def _get_bundle_refs(git):
+    # What a new clone would get from origin: its branches, and the tags.
+    refs = {}
+    stdout = git.for_each_ref('--format=%(refname) %(objectname)', 'refs/remotes/origin/', 'refs/tags/')
+    for line in stdout.strip().split('\n'):
+        fields = line.split()
+        if len(fields) == 2 and fields[0] != 'refs/remotes/origin/HEAD':
+            refs[fields[0]] = fields[1]
+    return refs
+
+def _read_bundle_manifest(folder):
+    path = os.path.join(folder, _BUNDLE_MANIFEST_FNAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
 def _parse_flow_args(*args):
     named_args = [arg for arg in args if not arg.startswith('-')]
     branch_type = named_args[0]
@@ -366,31 +1995,135 @@ def get():
         _engine = Engine()
     return _engine
 
+class LockMetrics:
+    '''
+    Running totals that describe how much our locks got in each other's way.
+    '''
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0
+        self.skipped = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+    def record(self, waited=None):
+        # Pass waited=None for a lock we got right away.
+        with self._lock:
+            self.acquired += 1
+            if waited is not None:
+                self.contended += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        metrics.inc('gitmux_lock_acquisitions', outcome='immediate' if waited is None else 'waited')
+        if waited:
+            metrics.inc('gitmux_lock_wait_seconds', waited)
+    def record_skip(self):
+        with self._lock:
+            self.skipped += 1
+        metrics.inc('gitmux_lock_acquisitions', outcome='skipped')
+    def __str__(self):
+        return 'Waited %.1fs (longest %.1fs) for %d of %d locks; read %d busy components without waiting.' % (
+            self.wait_seconds, self.max_wait_seconds, self.contended, self.acquired, self.skipped)
+
+lock_metrics = LockMetrics()
+
 class _NamedSemaphore:
     # Python's multiprocess.Lock() class ought to be what we want here--
     # something that any number of processes can attempt to acquire
     # independently, but that only one process can hold at a time. However,
     # it's implemented in such a way that you can't pass a name to it,
-    # which sort of defeats the whole purpose. fcntl works.
-    def __init__(self, path):
+    # which sort of defeats the whole purpose. fcntl works. We never delete
+    # the lock file; doing so would let a waiting process lock a file that
+    # the next process can no longer see.
+    def __init__(self, path, shared=False):
         self.path = path
-    def acquire(self):
-        self.handle = open(self.path, 'w')
-        fcntl.flock(self.handle, fcntl.LOCK_EX)
+        self.shared = shared
+    def acquire(self, wait=True):
+        # Return True if we got the lock. If wait is False and someone
+        # else holds a conflicting lock, return False instead of blocking.
+        if isWindows:
+            return True
+        self.handle = open(self.path, 'a')
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.handle, mode | fcntl.LOCK_NB)
+            lock_metrics.record()
+            return True
+        except IOError as e:
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+        if not wait:
+            self.handle.close()
+            lock_metrics.record_skip()
+            return False
+        sys.stderr.write('Waiting for another git-mux run to release %s...\n' % self.path)
+        start = time.time()
+        fcntl.flock(self.handle, mode)
+        lock_metrics.record(time.time() - start)
+        return True
     def release(self):
+        if isWindows:
+            return
         fcntl.flock(self.handle, fcntl.LOCK_UN)
         self.handle.close()
-        time.sleep(0.1)
-        os.remove(self.path)
 
 class EngineLock:
     # Allow _NamedSemaphore to be used in python's "with" block.
-    def __init__(self, path=None):
+    def __init__(self, path=None, shared=False):
         if not path:
             path = os.path.join(config.HOMEDIR, '.git-mux-lock')
-        self.semaphore = _NamedSemaphore(path)
+        self.semaphore = _NamedSemaphore(path, shared)
     def __enter__(self):
         self.semaphore.acquire()
     def __exit__(self, type, value, traceback):
         self.semaphore.release()
 
+# Which component locks each thread holds, so nested "with" blocks for the
+# same component don't deadlock against ourselves.
+_held_locks = threading.local()
+
+class ComponentLock:
+    '''
+    Serialize work on one component across threads and git-mux processes,
+    without getting in the way of work on other components.
+
+    Anything that changes a component's working tree (checkouts, merges,
+    clones) needs the exclusive lock. Operations that only read refs and
+    objects take a shared lock, which any number of readers can hold at
+    once. Readers can pass wait=False to carry on without the lock when a
+    writer is busy; check the acquired attribute to see what happened.
+    '''
+    def __init__(self, component_name, shared=False, wait=True):
+        self.path = os.path.join(_LOCK_FOLDER, component_name + '.lock')
+        self.shared = shared
+        self.wait = wait
+        self.acquired = False
+        self._semaphore = None
+    def __enter__(self):
+        held = getattr(_held_locks, 'modes', None)
+        if held is None:
+            held = _held_locks.modes = {}
+        mode = held.get(self.path)
+        if mode is not None:
+            if mode == 'shared' and not self.shared:
+                raise Exception('Can\'t upgrade shared lock on %s to exclusive.' % self.path)
+            self.acquired = True
+            return self
+        if not os.path.isdir(_LOCK_FOLDER):
+            try:
+                os.makedirs(_LOCK_FOLDER)
+            except OSError:
+                if not os.path.isdir(_LOCK_FOLDER):
+                    raise
+        semaphore = _NamedSemaphore(self.path, self.shared)
+        self.acquired = semaphore.acquire(self.wait)
+        if self.acquired:
+            self._semaphore = semaphore
+            held[self.path] = 'shared' if self.shared else 'exclusive'
+        return self
+    def __exit__(self, type, value, traceback):
+        if self._semaphore:
+            del _held_locks.modes[self.path]
+            self._semaphore.release()
+            self._semaphore = None
+
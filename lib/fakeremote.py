@@ -0,0 +1,362 @@
+'''
+Serve local bare repos as if they were on a slow, flaky git server.
+
+Network behavior dominates how fast git-mux runs, but our real server makes a
+poor benchmark: it's shared, it varies, and we can't make it misbehave on
+purpose. This stands in for ssh. Point GIT_SSH_COMMAND at it, and every
+connection git makes is served from bare repos in a local folder, after
+whatever latency, bandwidth limit, failure or hang we ask for. Random choices
+come from a seed plus a running connection count, so the same seed and the
+same sequence of connections misbehave the same way every time.
+
+Lay out bare repos under a root folder (say /tmp/remotes/alpha.git), and set
+each component's url in config to "fake:alpha.git". Then:
+
+    python fakeremote.py env --root /tmp/remotes --latency 0.2 --fail 0.1
+
+prints the environment variables that route git through the fake server, and
+
+    python fakeremote.py bench --runs 5 --root /tmp/remotes --hang 0.05 -- \\
+        python gitmux.py sync
+
+runs a command several times that way and reports how long each run took and
+what the server did to it. "python fakeremote.py stats --root <folder>"
+summarizes every connection so far; "reset" forgets them.
+
+    python fakeremote.py check
+
+builds a throwaway root of its own, and checks that git mux's fetches come
+through a refused connection (by retrying) and a hung one (by giving up at
+the deadline, then retrying). It needs no options, and exits 1 if either
+check fails.
+
+Options (each takes a value):
+    --root       folder of bare repos (required)
+    --latency    seconds to wait before serving each connection
+    --bandwidth  bytes per second in each direction (0 = unlimited)
+    --fail       chance (0-1) that a connection is refused
+    --hang       chance (0-1) that a connection stalls until killed
+    --seed       seed for the random choices
+    --plan       what happens to the first connections since the last reset,
+                 comma-separated (served, refused or hung); random choices
+                 take over after that
+'''
+
+import os, sys, time, json, random, shlex, shutil, subprocess, tempfile, threading
+
+isWindows = sys.platform=="win32" or sys.platform=="cygwin"
+if not isWindows:
+    import fcntl
+
+_OPTIONS = {'root': None, 'latency': '0', 'bandwidth': '0', 'fail': '0', 'hang': '0', 'seed': '0', 'plan': ''}
+_STATE_FOLDER = '.fakeremote'
+_LOG_FNAME = 'connections.log'
+_CHUNK_BYTES = 16 * 1024
+# What ssh says when it can't connect; git-mux retries on this.
+_REFUSED_MSG = 'ssh: connect to host fake port 22: Connection refused\n'
+_OUTCOMES = ['served', 'refused', 'hung']
+# How long the check lets a hung fetch run before git mux gives up on it.
+_CHECK_TIMEOUT = 2
+
+def parse_options(args):
+    '''
+    Split args into a dict of our options and a list of everything else.
+    '''
+    options = dict(_OPTIONS)
+    rest = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--':
+            rest += args[i + 1:]
+            break
+        if arg.startswith('--') and arg[2:] in _OPTIONS:
+            if i + 1 == len(args):
+                raise Exception('%s needs a value.' % arg)
+            options[arg[2:]] = args[i + 1]
+            i += 2
+            continue
+        rest.append(arg)
+        i += 1
+    if not options['root']:
+        raise Exception('--root is required.')
+    options['root'] = os.path.abspath(options['root'])
+    for key in ['latency', 'bandwidth', 'fail', 'hang']:
+        options[key] = float(options[key])
+    for outcome in _get_plan(options):
+        if outcome not in _OUTCOMES:
+            raise Exception('--plan may only name %s; got "%s".' % (', '.join(_OUTCOMES), outcome))
+    return options, rest
+
+def _get_plan(options):
+    return [x.strip() for x in options['plan'].split(',') if x.strip()]
+
+def get_env(options):
+    '''
+    Return the environment variables that send git's ssh connections
+    through us, with these options.
+    '''
+    words = [sys.executable, os.path.abspath(__file__), 'ssh']
+    for key in sorted(_OPTIONS.keys()):
+        words += ['--%s' % key, str(options[key])]
+    return {
+        'GIT_SSH_COMMAND': ' '.join(_quote(x) for x in words),
+        # Tell git we take ssh's options, so it speaks protocol v2 to us.
+        'GIT_SSH_VARIANT': 'ssh',
+    }
+
+def _quote(word):
+    return "'%s'" % word.replace("'", "'\\''")
+
+class _Log:
+    # Every connection, one JSON object per line, numbered in order. The
+    # count seeds each connection's random choices.
+    def __init__(self, root):
+        self.folder = os.path.join(root, _STATE_FOLDER)
+        self.path = os.path.join(self.folder, _LOG_FNAME)
+    def append(self, entry_func):
+        # Call entry_func(n) for the next connection number n, and log what
+        # it returns. Connections from parallel git processes take turns.
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                if not os.path.isdir(self.folder):
+                    raise
+        with open(self.path, 'a+') as f:
+            if not isWindows:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            n = sum(1 for line in f)
+            entry = entry_func(n)
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+        return entry
+    def read(self):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    def reset(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+def _parse_ssh_args(args):
+    # git calls us like ssh: [-o option] [-p port] [-4|-6] host command.
+    i = 0
+    while i < len(args) and args[i].startswith('-'):
+        i += 2 if args[i] in ['-o', '-p', '-l', '-i'] else 1
+    if len(args) - i != 2:
+        raise Exception('Expected "host command" after ssh options; got %s.' % ' '.join(args))
+    service_and_path = shlex.split(args[i + 1])
+    if len(service_and_path) != 2 or service_and_path[0] not in ['git-upload-pack', 'git-receive-pack', 'git-upload-archive']:
+        raise Exception('Can\'t serve "%s".' % args[i + 1])
+    return service_and_path
+
+def _pump(source, sink, bandwidth, done=None):
+    # Copy bytes from one file descriptor to another, no faster than
+    # bandwidth bytes per second (if set). Call done when the source runs dry.
+    start = time.time()
+    sent = 0
+    try:
+        while True:
+            chunk = os.read(source, _CHUNK_BYTES)
+            if not chunk:
+                break
+            if bandwidth:
+                delay = start + (sent + len(chunk)) / bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            while chunk:
+                written = os.write(sink, chunk)
+                chunk = chunk[written:]
+                sent += written
+    except OSError:
+        # The other side hung up; git will say what went wrong.
+        pass
+    finally:
+        if done:
+            done()
+
+def serve(options, ssh_args):
+    '''
+    Handle one connection the way ssh plus a git server would, but slower
+    and less reliably, as options say. Returns an exit code.
+    '''
+    service, path = _parse_ssh_args(ssh_args)
+    repo = os.path.abspath(os.path.join(options['root'], path.lstrip('/')))
+    if not repo.startswith(options['root'] + os.sep):
+        sys.stderr.write('fatal: %s is outside the fake server\'s root.\n' % path)
+        return 128
+    def decide(n):
+        rnd = random.Random('%s-%d' % (options['seed'], n))
+        draw = rnd.random()
+        outcome = 'served'
+        if draw < options['fail']:
+            outcome = 'refused'
+        elif draw < options['fail'] + options['hang']:
+            outcome = 'hung'
+        plan = _get_plan(options)
+        if n < len(plan):
+            outcome = plan[n]
+        return {'n': n, 'service': service, 'repo': path.lstrip('/'), 'outcome': outcome, 'time': round(time.time(), 3)}
+    entry = _Log(options['root']).append(decide)
+    if options['latency']:
+        time.sleep(options['latency'])
+    if entry['outcome'] == 'refused':
+        sys.stderr.write(_REFUSED_MSG)
+        return 255
+    if entry['outcome'] == 'hung':
+        # Like a dead server behind a live TCP connection: nothing, until
+        # git gives up on us (or is killed) and its end of the pipe closes.
+        while os.read(sys.stdin.fileno(), _CHUNK_BYTES):
+            pass
+        return 255
+    proc = subprocess.Popen(['git', service[4:], repo], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    upstream = threading.Thread(target=_pump, args=(sys.stdin.fileno(), proc.stdin.fileno(), options['bandwidth'], proc.stdin.close))
+    upstream.daemon = True
+    upstream.start()
+    _pump(proc.stdout.fileno(), sys.stdout.fileno(), options['bandwidth'])
+    return proc.wait()
+
+def get_stats(entries):
+    '''
+    Summarize logged connections: counts by outcome, and by service.
+    '''
+    stats = {'connections': len(entries), 'outcomes': {}, 'services': {}}
+    for entry in entries:
+        stats['outcomes'][entry['outcome']] = stats['outcomes'].get(entry['outcome'], 0) + 1
+        stats['services'][entry['service']] = stats['services'].get(entry['service'], 0) + 1
+    return stats
+
+def bench(options, argv, runs):
+    '''
+    Run argv runs times through the fake server, and report each run's wall
+    time and exit code, the spread, and what the server did. Returns 1 if
+    any run failed.
+    '''
+    env = dict(os.environ)
+    env.update(get_env(options))
+    log = _Log(options['root'])
+    times = []
+    failed = 0
+    for i in range(runs):
+        before = len(log.read())
+        start = time.time()
+        exit_code = subprocess.call(argv, env=env)
+        seconds = time.time() - start
+        times.append(seconds)
+        failed += int(bool(exit_code))
+        stats = get_stats(log.read()[before:])
+        print('run %d: %.2fs, exit code %d, %d connections %s' % (
+            i + 1, seconds, exit_code, stats['connections'], json.dumps(stats['outcomes'], sort_keys=True)))
+    times.sort()
+    print('min %.2fs, median %.2fs, max %.2fs over %d runs; %d failed.' % (
+        times[0], times[len(times) // 2], times[-1], runs, failed))
+    return 1 if failed else 0
+
+def _git(cwd, *args):
+    return subprocess.check_output(('git',) + args, cwd=cwd).decode('utf-8').strip()
+
+def _check_fetch(root, work, plan, expect_seconds):
+    # Add a commit to the remote, fetch it the way git mux does while the
+    # server follows plan, and say what went wrong (or None if nothing did).
+    import engine
+    seed = os.path.join(root, 'seed')
+    _git(seed, 'commit', '-q', '--allow-empty', '-m', 'Fetch me (%s).' % plan)
+    _git(seed, 'push', '-q', os.path.join(root, 'alpha.git'), 'master')
+    expected = _git(seed, 'rev-parse', 'HEAD')
+    log = _Log(root)
+    log.reset()
+    options = dict(_OPTIONS, root=root, plan=plan)
+    os.environ.update(get_env(options))
+    start = time.time()
+    try:
+        engine._MuxGit(work, 'alpha').fetch('-q', 'origin')
+    except Exception as e:
+        return 'the fetch failed: %s' % str(e).strip()
+    seconds = time.time() - start
+    outcomes = [entry['outcome'] for entry in log.read()]
+    if outcomes != plan.split(','):
+        return 'the server saw %s' % (', '.join(outcomes) or 'no connections')
+    if _git(work, 'rev-parse', 'origin/master') != expected:
+        return 'origin/master didn\'t get the new commit'
+    if seconds < expect_seconds:
+        return 'it took %.1fs; the deadline is %ds' % (seconds, _CHECK_TIMEOUT)
+    return None
+
+def check():
+    '''
+    Fetch through the fake server while it refuses, then hangs on, the first
+    connection, and make sure git mux's retries and deadlines get the fetch
+    through anyway. Returns 1 if they don't.
+    '''
+    folder = tempfile.mkdtemp(prefix='fakeremote-check-')
+    try:
+        # A root of our own, with a config that keeps the waits short.
+        os.environ['GMUX_ROOT'] = folder
+        os.makedirs(os.path.join(folder, 'etc'))
+        with open(os.path.join(folder, 'etc', 'git-mux.cfg'), 'w') as f:
+            f.write('[misc]\nnetwork retries = 2\nretry backoff = 0.1\n\n'
+                    '[network timeouts]\nfetch = %d\n' % _CHECK_TIMEOUT)
+        root = os.path.join(folder, 'remotes')
+        seed = os.path.join(root, 'seed')
+        work = os.path.join(folder, 'data', 'alpha')
+        os.makedirs(seed)
+        for key in ['GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME']:
+            os.environ.setdefault(key, 'fakeremote')
+        for key in ['GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL']:
+            os.environ.setdefault(key, 'fakeremote@localhost')
+        _git(root, 'init', '-q', '--bare', 'alpha.git')
+        _git(seed, 'init', '-q')
+        _git(seed, 'commit', '-q', '--allow-empty', '-m', 'First.')
+        _git(seed, 'push', '-q', os.path.join(root, 'alpha.git'), 'HEAD:master')
+        _git(root, 'clone', '-q', 'alpha.git', work)
+        _git(work, 'remote', 'set-url', 'origin', 'fake:alpha.git')
+        failed = 0
+        for name, plan, expect_seconds in [('a refused connection is retried', 'refused,served', 0),
+                                           ('a hung connection times out and is retried', 'hung,served', _CHECK_TIMEOUT)]:
+            problem = _check_fetch(root, work, plan, expect_seconds)
+            if problem:
+                failed += 1
+                print('FAILED: %s; %s.' % (name, problem))
+            else:
+                print('ok: %s.' % name)
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def _usage():
+    sys.stderr.write(__doc__)
+    return 1
+
+def main(args):
+    if not args:
+        return _usage()
+    verb, args = args[0], args[1:]
+    if verb == 'check' and not args:
+        return check()
+    if verb == 'ssh':
+        options, rest = parse_options(args)
+        return serve(options, rest)
+    runs = 1
+    if '--runs' in args:
+        i = args.index('--runs')
+        runs = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    options, rest = parse_options(args)
+    if verb == 'env':
+        for key, value in sorted(get_env(options).items()):
+            print('export %s=%s' % (key, _quote(value)))
+        return 0
+    if verb == 'bench' and rest:
+        return bench(options, rest, runs)
+    if verb == 'stats':
+        print(json.dumps(get_stats(_Log(options['root']).read()), indent=2, sort_keys=True))
+        return 0
+    if verb == 'reset':
+        _Log(options['root']).reset()
+        return 0
+    return _usage()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,354 @@
+'''
+Native implementations of the git-flow operations that we mux.
+
+The git-flow (AVH or nvie) shell scripts spawn dozens of git processes per
+operation just to read config, validate state and print messages. Here we
+read the gitflow config keys once and do the work with a handful of direct
+git commands. The scripts remain available as a compatibility backend; set
+"gitflow backend = git-flow" in the misc section of config to use them.
+
+Every operation returns (exit_code, stdout, stderr), the same shape that
+gitpython's with_extended_output mode gives us for git.flow(...), so callers
+can treat the two backends interchangeably.
+'''
+
+import config
+
+NATIVE_BACKEND = 'native'
+SCRIPT_BACKEND = 'git-flow'
+
+BRANCH_TYPES = ['feature', 'release', 'hotfix']
+
+_DEFAULT_CONFIG = {
+    'gitflow.branch.master': 'master',
+    'gitflow.branch.develop': 'develop',
+    'gitflow.prefix.feature': 'feature/',
+    'gitflow.prefix.release': 'release/',
+    'gitflow.prefix.hotfix': 'hotfix/',
+    'gitflow.prefix.support': 'support/',
+    'gitflow.prefix.versiontag': '',
+}
+
+_SUBCOMMAND_HELP = '''usage: git flow <subcommand>
+
+Available subcommands are:
+   init      Initialize a new git repo with support for the branching model.
+   feature   Manage your feature branches.
+   release   Manage your release branches.
+   hotfix    Manage your hotfix branches.
+   version   Shows version information.
+
+Try 'git flow <subcommand> help' for details.'''
+
+_BRANCH_TYPE_HELP = '''usage: git flow %(type)s [list]
+       git flow %(type)s start [-F] <name> [<base>]
+       git flow %(type)s finish [-Fk]%(message)s [<name|nameprefix>]
+       git flow %(type)s publish <name>
+       git flow %(type)s diff [<name|nameprefix>]
+       git flow %(type)s rebase [<name|nameprefix>]
+       git flow %(type)s pull [-r] <remote> [<name>]'''
+
+def get_backend():
+    return config.cfg.try_get(config.MISC_SECTION, config.GITFLOW_BACKEND_KEY, NATIVE_BACKEND)
+
+def run(git, *args, **kwargs):
+    '''
+    Run a git-flow command line (everything after "git flow") in the repo
+    that git points at, using whichever backend is configured.
+
+    The scripts can be chatty. Pass sink (a function that takes text) to
+    have their stdout streamed there as it arrives instead of collected;
+    git must then be the engine's git, which knows how to stream, and the
+    stdout we return is None. The native backend says little enough that
+    it's always collected.
+    '''
+    if get_backend() == SCRIPT_BACKEND:
+        sink = kwargs.get('sink')
+        if sink:
+            exit_code, size, stderr = git.stream('flow', *args, sink=sink)
+            return exit_code, None, stderr
+        return git.flow(*args, with_extended_output=True, with_exceptions=False)
+    return GitFlow(git).run(*args)
+
+def init(git):
+    '''
+    Make sure a freshly cloned repo is set up for git-flow, the way
+    "git flow init -d" would.
+    '''
+    if get_backend() == SCRIPT_BACKEND:
+        git.flow('init', '-d')
+    else:
+        GitFlow(git).init()
+
+def get_help(git, *args):
+    '''
+    Return git-flow's usage text for a command line ending in "help".
+    '''
+    if get_backend() == SCRIPT_BACKEND:
+        x = git.flow(*args, as_process=True)
+        stdout, stderr = x.proc.communicate()
+        return stdout
+    args = [arg for arg in args if arg != 'help']
+    if args and args[0] in BRANCH_TYPES:
+        message = ''
+        if args[0] != 'feature':
+            message = ' [-m <message>]'
+        return _BRANCH_TYPE_HELP % {'type': args[0], 'message': message}
+    return _SUBCOMMAND_HELP
+
+def get_config(git):
+    '''
+    Return a dict of every gitflow.* config key in the repo, with git-flow's
+    defaults filled in. Read once per git instance.
+    '''
+    # gitpython's Git turns unknown attributes into git commands, so look in
+    # the instance dict instead of using getattr().
+    cfg = git.__dict__.get('gitflow_config')
+    if cfg is None:
+        cfg = dict(_DEFAULT_CONFIG)
+        cfg.update(_read_config(git))
+        git.gitflow_config = cfg
+    return cfg
+
+def get_tag_name(git, name):
+    '''
+    Return the tag that finishing release or hotfix name puts on master.
+    '''
+    return get_config(git)['gitflow.prefix.versiontag'] + name
+
+def has_flag(args, flag):
+    '''
+    Tell whether a git-flow command line sets a single-letter flag (k, say).
+    '''
+    named, flags, message = _parse_args(args)
+    return flag in flags
+
+def _read_config(git):
+    exit_code, stdout, stderr = git.config('--get-regexp', r'^gitflow\.',
+                                           with_extended_output=True, with_exceptions=False)
+    found = {}
+    if not exit_code:
+        for line in stdout.strip().split('\n'):
+            pair = line.split(' ', 1)
+            if len(pair) == 2:
+                found[pair[0]] = pair[1].strip()
+            elif pair[0]:
+                found[pair[0]] = ''
+    return found
+
+def _parse_args(args):
+    # Split a git-flow command line into named args, single-letter flags,
+    # and the value of -m (if any).
+    named, flags, message = [], set(), None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ['-m', '--message'] and i + 1 < len(args):
+            message = args[i + 1]
+            i += 1
+        elif arg.startswith('--'):
+            flags.add(arg)
+        elif arg.startswith('-'):
+            flags.update(arg[1:])
+        else:
+            named.append(arg)
+        i += 1
+    return named, flags, message
+
+class GitFlow:
+    '''
+    git-flow's start/finish/rebase/publish/pull/list operations for one repo,
+    done with plain git commands.
+    '''
+    def __init__(self, git):
+        self.git = git
+
+    def branch(self, which):
+        return get_config(self.git)['gitflow.branch.%s' % which]
+
+    def prefix(self, branch_type):
+        return get_config(self.git)['gitflow.prefix.%s' % branch_type]
+
+    def run(self, *args):
+        named, flags, message = _parse_args(args)
+        if len(named) < 2 or named[0] not in BRANCH_TYPES:
+            return 1, None, 'Unsupported git flow command: %s' % ' '.join(args)
+        branch_type, verb = named[0], named[1]
+        if verb == 'list':
+            return self.list(branch_type)
+        if verb == 'pull':
+            if len(named) < 4:
+                return 1, None, 'Expected "git flow %s pull [-r] <remote> <name>".' % branch_type
+            return self.pull(branch_type, named[3], named[2], rebase='r' in flags)
+        if len(named) < 3:
+            return 1, None, 'A branch name is required.'
+        name = named[2]
+        if verb == 'start':
+            base = None
+            if len(named) > 3:
+                base = named[3]
+            return self.start(branch_type, name, base, fetch='F' in flags)
+        if verb == 'finish':
+            return self.finish(branch_type, name, message, keep='k' in flags, fetch='F' in flags)
+        if verb == 'rebase':
+            return self.rebase(branch_type, name)
+        if verb == 'publish':
+            return self.publish(branch_type, name)
+        if verb == 'diff':
+            return self.diff(branch_type, name)
+        return 1, None, 'git flow %s %s is not supported natively.' % (branch_type, verb)
+
+    def _has_ref(self, ref):
+        exit_code, stdout, stderr = self.git.rev_parse('--verify', '-q', ref,
+                                                       with_extended_output=True, with_exceptions=False)
+        return not exit_code
+
+    def _git(self, verb, *args):
+        # Run a git command and hand back (exit_code, stdout, stderr).
+        func = getattr(self.git, verb.replace('-', '_'))
+        return func(*args, with_extended_output=True, with_exceptions=False)
+
+    def init(self):
+        existing = _read_config(self.git)
+        for key in sorted(_DEFAULT_CONFIG.keys()):
+            if key not in existing:
+                self.git.config(key, _DEFAULT_CONFIG[key])
+        self.git.gitflow_config = None
+        master, develop = self.branch('master'), self.branch('develop')
+        if not self._has_ref('refs/heads/%s' % develop):
+            if self._has_ref('refs/remotes/origin/%s' % develop):
+                self.git.branch('--track', develop, 'origin/%s' % develop)
+            else:
+                self.git.branch('--no-track', develop, master)
+        return 0, 'Initialized git flow (%s, %s).' % (master, develop), None
+
+    def list(self, branch_type):
+        prefix = self.prefix(branch_type)
+        stdout = self.git.for_each_ref('--format=%(refname:short)', 'refs/heads/%s' % prefix)
+        names = [x.strip()[len(prefix):] for x in stdout.strip().split('\n') if x.strip()]
+        if not names:
+            return 0, 'No %s branches exist.' % branch_type, None
+        return 0, '\n'.join('  ' + name for name in names), None
+
+    def start(self, branch_type, name, base=None, fetch=False):
+        full_branch_name = self.prefix(branch_type) + name
+        if base is None:
+            base = self.branch('master' if branch_type == 'hotfix' else 'develop')
+        if self._has_ref('refs/heads/%s' % full_branch_name):
+            return 1, None, 'Branch "%s" already exists.' % full_branch_name
+        if fetch:
+            exit_code, stdout, stderr = self._git('fetch', '-q', 'origin')
+            if exit_code:
+                return exit_code, stdout, stderr
+        # Unlike the scripts, we don't check the new branch out; nothing we
+        # do next needs it in the working tree.
+        exit_code, stdout, stderr = self._git('branch', '--no-track', full_branch_name, base)
+        if exit_code:
+            return exit_code, stdout, stderr
+        return 0, 'Created branch %s from %s.' % (full_branch_name, base), None
+
+    def _compare_to_origin(self, target):
+        # How many commits target lacks from origin's copy, and how many it
+        # has that origin's copy lacks. (0, 0) if origin has no copy.
+        if not self._has_ref('refs/remotes/origin/%s' % target):
+            return 0, 0
+        counts = self.git.rev_list('--left-right', '--count', 'origin/%s...%s' % (target, target)).split()
+        return int(counts[0]), int(counts[1])
+
+    def _catch_up_with_origin(self, target):
+        # Fast-forward target to origin's copy.
+        exit_code, stdout, stderr = self._git('symbolic-ref', '-q', 'HEAD')
+        if not exit_code and stdout.strip() == 'refs/heads/%s' % target:
+            return self._git('merge', '-q', '--ff-only', 'origin/%s' % target)
+        old = self.git.rev_parse('refs/heads/%s' % target)
+        return self._git('update-ref', 'refs/heads/%s' % target, 'origin/%s' % target, old)
+
+    def _merge(self, full_branch_name, target, allow_ff):
+        exit_code, stdout, stderr = self._git('checkout', '-q', target)
+        if exit_code:
+            return exit_code, stdout, stderr
+        # Like git-flow, fast-forward a branch that holds a single commit,
+        # and record a merge commit for anything bigger.
+        mode = '--no-ff'
+        if allow_ff:
+            count = self.git.rev_list('--count', '%s..%s' % (target, full_branch_name)).strip()
+            if count == '1':
+                mode = '--ff'
+        exit_code, stdout, stderr = self._git('merge', '-q', mode, '-m',
+                                              "Merge branch '%s' into %s" % (full_branch_name, target),
+                                              full_branch_name)
+        if exit_code:
+            # Don't leave a half-merged working tree behind for the next
+            # muxed operation to trip over.
+            self._git('merge', '--abort')
+        return exit_code, stdout, stderr
+
+    def finish(self, branch_type, name, message=None, keep=False, fetch=False):
+        full_branch_name = self.prefix(branch_type) + name
+        if not self._has_ref('refs/heads/%s' % full_branch_name):
+            return 1, None, 'Branch "%s" does not exist.' % full_branch_name
+        if fetch:
+            exit_code, stdout, stderr = self._git('fetch', '-q', 'origin')
+            if exit_code:
+                return exit_code, stdout, stderr
+        develop, master = self.branch('develop'), self.branch('master')
+        targets = [develop] if branch_type == 'feature' else [master, develop]
+        # Like git-flow's require_branches_equal: merging onto a stale copy
+        # of a branch makes a result that origin won't take.
+        behind = []
+        for target in targets:
+            missing, extra = self._compare_to_origin(target)
+            if missing and extra:
+                return 1, None, 'Branches "%s" and "origin/%s" have diverged.' % (target, target)
+            if missing:
+                behind.append(target)
+        for target in behind:
+            exit_code, stdout, stderr = self._catch_up_with_origin(target)
+            if exit_code:
+                return exit_code, stdout, stderr
+        if branch_type != 'feature':
+            # Releases and hotfixes land on master, get tagged there, and
+            # then flow back into develop.
+            exit_code, stdout, stderr = self._merge(full_branch_name, master, False)
+            if exit_code:
+                return exit_code, stdout, stderr
+            tag = get_tag_name(self.git, name)
+            exit_code, stdout, stderr = self._git('tag', '-a', tag, '-m', message or tag)
+            if exit_code:
+                return exit_code, stdout, stderr
+        exit_code, stdout, stderr = self._merge(full_branch_name, develop, branch_type == 'feature')
+        if exit_code:
+            return exit_code, stdout, stderr
+        if not keep:
+            # We just merged it into develop, so forcing the delete only
+            # skips git's complaint that its upstream hasn't caught up.
+            exit_code, stdout, stderr = self._git('branch', '-D', full_branch_name)
+            if exit_code:
+                return exit_code, stdout, stderr
+        # Leave develop checked out, as git-flow does.
+        return 0, 'Merged %s into %s.' % (full_branch_name, develop if branch_type == 'feature' else '%s and %s' % (master, develop)), None
+
+    def rebase(self, branch_type, name):
+        full_branch_name = self.prefix(branch_type) + name
+        exit_code, stdout, stderr = self._git('rebase', '-q', self.branch('develop'), full_branch_name)
+        if exit_code:
+            self._git('rebase', '--abort')
+        return exit_code, stdout, stderr
+
+    def publish(self, branch_type, name):
+        full_branch_name = self.prefix(branch_type) + name
+        return self._git('push', '--set-upstream', 'origin', full_branch_name)
+
+    def pull(self, branch_type, name, remote, rebase=False):
+        full_branch_name = self.prefix(branch_type) + name
+        exit_code, stdout, stderr = self._git('checkout', '-q', full_branch_name)
+        if exit_code:
+            return exit_code, stdout, stderr
+        args = ['pull']
+        if rebase:
+            args.append('--rebase')
+        return self._git(*(args + [remote, full_branch_name]))
+
+    def diff(self, branch_type, name):
+        full_branch_name = self.prefix(branch_type) + name
+        return self._git('diff', '%s...%s' % (self.branch('develop'), full_branch_name))
@@ -0,0 +1,76 @@
+'''
+Dependencies between components, and the order they imply.
+
+Components can declare what they depend on in a "component dependencies"
+section, either in the shared cfg repo's shared.cfg or in local config:
+
+    [component dependencies]
+    webapp = corelib, auth
+    auth = corelib
+
+Local entries win over shared ones for the same component. When any are
+declared, flow operations visit components in topological waves: everything
+in a wave depends only on components in earlier waves, so a release lands in
+a shared library before it lands in the apps that use it, while components
+that don't depend on each other run at the same time.
+'''
+
+import config
+
+def get_dependencies(component_names):
+    '''
+    Return a dict of component name -> list of the muxed components it
+    depends on. Dependencies on components that aren't muxed are ignored;
+    we can't order work against something we're not doing.
+    '''
+    declared = config.cfg.get_shared_items(config.COMPONENT_DEPENDENCIES_SECTION)
+    deps = {}
+    for name in component_names:
+        value = declared.get(name.lower(), '')
+        deps[name] = [x.strip() for x in value.split(',') if x.strip() in component_names and x.strip() != name]
+    return deps
+
+def get_waves(component_names, deps):
+    '''
+    Group components into waves, in order, so that every component's
+    dependencies are in earlier waves. Components keep their relative order
+    within a wave. Raise an Exception if the dependencies have a cycle.
+    '''
+    waves = []
+    done = set()
+    remaining = [x for x in component_names]
+    while remaining:
+        wave = [x for x in remaining if not [d for d in deps.get(x, []) if d not in done]]
+        if not wave:
+            raise Exception('Component dependencies have a cycle among %s.' % ', '.join(remaining))
+        waves.append(wave)
+        done.update(wave)
+        remaining = [x for x in remaining if x not in done]
+    return waves
+
+def get_critical_path(deps, seconds):
+    '''
+    Given how long each component took, return (path, total): the chain of
+    dependent components whose combined time bounds the whole run, and that
+    combined time. Nothing that runs in waves can finish sooner.
+    '''
+    finish = {}
+    before = {}
+    def visit(name):
+        if name not in finish:
+            previous = None
+            for d in deps.get(name, []):
+                if d in seconds and visit(d) > finish.get(previous, -1):
+                    previous = d
+            before[name] = previous
+            finish[name] = seconds[name] + (finish[previous] if previous else 0)
+        return finish[name]
+    last = None
+    for name in seconds:
+        if visit(name) > finish.get(last, -1):
+            last = name
+    path = []
+    while last:
+        path.insert(0, last)
+        last = before[last]
+    return path, (finish[path[-1]] if path else 0)
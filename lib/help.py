@@ -17,6 +17,15 @@ be abbreviated to any length that remains unambiguous.
 Runs in scripted mode if it receives a logically complete command line.
 Otherwise, it prompts to gather parameters.
 
+Add ''' + PARAM_COLOR + '--json' + NORMTXT + ''' to any command to get one JSON object per event (JSON Lines)
+on stdout instead of colored text.
+
+Add ''' + PARAM_COLOR + '--only' + NORMTXT + ''' or ''' + PARAM_COLOR + '--except' + NORMTXT + ''' (each followed by a comma-separated
+list of component names, globs, or groups from the "component groups" config
+section) to any command to work on just some components. Add ''' + PARAM_COLOR + '--jobs N' + NORMTXT + ''' to
+work on up to N components at a time. Components that took longest last time
+start first.
+
 Examples:
 
     ''' + CMD_COLOR + 'git mux flow feature '
@@ -25,7 +34,26 @@ Examples:
 
     ''' + CMD_COLOR + 'git mux flow feature '
         + PARAM_COLOR + ' coolfeature' + CMD_COLOR + 'finish' + NORMTXT + '''
-        Retire the "coolfeature" branch.
+        Retire the "coolfeature" branch. If it would conflict anywhere, nothing is
+        merged; add ''' + PARAM_COLOR + '--force' + NORMTXT + ''' to merge wherever it can anyway.
+
+    ''' + CMD_COLOR + 'git mux batch ' + PARAM_COLOR + 'nightly.txt' + NORMTXT + '''
+        Run each command in nightly.txt (one per line, without "git mux") in a
+        single process. Lines ending in "&" run alongside their neighbors.
+
+    ''' + CMD_COLOR + 'git mux flow feature ' + PARAM_COLOR + 'coolfeature ' + CMD_COLOR + 'start ' + PARAM_COLOR + '--only billing' + NORMTXT + '''
+        Create the "coolfeature" branch in just the components in the "billing" group.
+
+    ''' + CMD_COLOR + 'git mux exec ' + PARAM_COLOR + '--jobs 4 -- make test' + NORMTXT + '''
+        Run "make test" in every component, 4 at a time.
+
+    ''' + CMD_COLOR + 'git mux find ' + PARAM_COLOR + 'ABC-123' + NORMTXT + '''
+        Show the commits for ticket ABC-123 in every component, and the branches
+        that have them, as of the last sync (--update rescans first).
+
+    ''' + CMD_COLOR + 'git mux shard ' + PARAM_COLOR + 'sync' + NORMTXT + '''
+        Sync, with the components split among the hosts or processes in the
+        "workers" config section.
 ''')
 
 if __name__ == '__main__':
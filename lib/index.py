@@ -0,0 +1,246 @@
+'''
+A local index of every component's commits, for finding work by ticket.
+
+Release managers often ask which components and branches have commits for a
+ticket. Answering with git log --grep in every repo is slow, so we keep a
+SQLite database in the cache folder: each commit's component, SHA, author,
+date, subject and ticket IDs, plus which branches (local and remote-tracking)
+contain it. Each update reads only the branches that moved since the last
+one, and only the commits that none of the previously indexed tips could
+reach. Only the trunk (develop and master, and origin's copies) is indexed
+in full; other branches record just the commits they add to it, so many
+branches don't each cost a copy of the whole history. Which of them hold an
+older commit is worked out when find turns it up on the trunk. "git mux
+sync" updates the index for what it fetched, and "git mux find" answers from
+it (rescanning first with --update).
+
+Ticket IDs look like ABC-123 unless "ticket pattern" in the misc section of
+config says otherwise (a regex; matches are stored in upper case).
+'''
+
+import os, re, sqlite3
+
+import config
+
+DEFAULT_TICKET_PATTERN = r'\b[A-Z][A-Z0-9]+-[0-9]+\b'
+
+_DB_FNAME = 'commit-index.sqlite'
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS commits (component TEXT, sha TEXT, author TEXT, date INTEGER, subject TEXT, '
+    'PRIMARY KEY (component, sha))',
+    'CREATE TABLE IF NOT EXISTS tickets (ticket TEXT, component TEXT, sha TEXT, PRIMARY KEY (ticket, component, sha))',
+    'CREATE TABLE IF NOT EXISTS branch_commits (component TEXT, sha TEXT, branch TEXT, PRIMARY KEY (component, sha, branch))',
+    'CREATE INDEX IF NOT EXISTS branch_commits_by_branch ON branch_commits (component, branch)',
+    'CREATE TABLE IF NOT EXISTS tips (component TEXT, branch TEXT, sha TEXT, PRIMARY KEY (component, branch))',
+]
+# Field and record separators for git log output; neither shows up in text.
+_FIELD_SEP = '\x1f'
+_RECORD_SEP = '\x1e'
+_LOG_FORMAT = '--format=%H%x1f%an%x1f%at%x1f%s%x1f%b%x1e'
+_SHA_PREFIX_PAT = re.compile(r'^[0-9a-fA-F]{7,40}$')
+# How long to wait for another git-mux process that's writing the index.
+_BUSY_SECONDS = 60
+
+def get_ticket_pattern():
+    return re.compile(config.cfg.try_get(config.MISC_SECTION, config.TICKET_PATTERN_KEY, DEFAULT_TICKET_PATTERN))
+
+class Changes:
+    '''
+    What moved in one component since it was last indexed. Built by scan(),
+    which talks to git; applied by CommitIndex.apply(), which talks to the
+    database.
+    '''
+    def __init__(self):
+        # Every branch's tip now: branch name -> SHA.
+        self.tips = {}
+        # Branches that are gone, or that moved somewhere other than ahead;
+        # what they contain has to be worked out afresh.
+        self.reset = []
+        # Branch name -> SHAs that it now contains but didn't before.
+        self.added = {}
+        # (sha, author, date, subject, tickets) for commits new to the index.
+        self.commits = []
+
+def _get_tips(git, exclude):
+    tips = {}
+    stdout = git.for_each_ref('--format=%(refname) %(objectname)', 'refs/heads/', 'refs/remotes/')
+    for line in stdout.strip().split('\n'):
+        fields = line.split()
+        if len(fields) != 2 or fields[0].endswith('/HEAD'):
+            continue
+        ref, sha = fields
+        if ref.startswith('refs/heads/'):
+            name = ref[len('refs/heads/'):]
+        else:
+            name = ref[len('refs/remotes/'):]
+        if name not in exclude:
+            tips[name] = sha
+    return tips
+
+def _rev_list(git, *args):
+    return [x for x in git.rev_list(*args).split('\n') if x]
+
+def _read_commits(git, new_tips, old_tips, ticket_pat):
+    # Read commits reachable from new_tips but not from old_tips, which must
+    # all exist.
+    args = sorted(set(new_tips))
+    if old_tips:
+        args += ['--not'] + sorted(set(old_tips))
+    commits = []
+    for record in git.log(_LOG_FORMAT, *args).split(_RECORD_SEP):
+        fields = record.lstrip('\n').split(_FIELD_SEP)
+        if len(fields) != 5:
+            continue
+        sha, author, date, subject, body = fields
+        tickets = sorted(set(x.upper() for x in ticket_pat.findall(subject + '\n' + body)))
+        commits.append((sha, author, int(date), subject, tickets))
+    return commits
+
+def scan(git, old_tips, exclude=None, ticket_pat=None, trunk=None):
+    '''
+    Work out what changed in a component since its branches had old_tips
+    (branch name -> SHA, as last indexed). Returns a Changes. Only runs git,
+    so components can be scanned side by side. trunk names the branches
+    whose whole history is indexed; for the rest, we keep only the commits
+    that the trunk doesn't have.
+    '''
+    changes = Changes()
+    changes.tips = _get_tips(git, exclude or [])
+    if ticket_pat is None:
+        ticket_pat = get_ticket_pattern()
+    trunk = [name for name in (trunk or []) if name in changes.tips]
+    trunk_tips = sorted(set(changes.tips[name] for name in trunk))
+    # Tips we indexed before that are still in some branch's history;
+    # nothing they reach needs reading again.
+    known = [sha for name, sha in changes.tips.items() if old_tips.get(name) == sha]
+    for name, sha in changes.tips.items():
+        old = old_tips.get(name)
+        if old == sha:
+            continue
+        if trunk_tips and name not in trunk:
+            # Rows from an earlier scan may reach past where the trunk is
+            # now, so start this branch afresh; it's only its own work.
+            if old:
+                changes.reset.append(name)
+            changes.added[name] = _rev_list(git, sha, '--not', *trunk_tips)
+            continue
+        exit_code, stdout, stderr = git.merge_base('--is-ancestor', old, sha, with_extended_output=True,
+                                                   with_exceptions=False) if old else (1, None, None)
+        if not exit_code:
+            changes.added[name] = _rev_list(git, sha, '^' + old)
+            known.append(old)
+        else:
+            if old:
+                changes.reset.append(name)
+            changes.added[name] = _rev_list(git, sha)
+    changes.reset += [name for name in old_tips if name not in changes.tips]
+    if changes.added:
+        changes.commits = _read_commits(git, [changes.tips[x] for x in changes.added], known, ticket_pat)
+    return changes
+
+class Commit:
+    def __init__(self, component_name, sha, author, date, subject, branches):
+        self.component_name = component_name
+        self.sha = sha
+        self.author = author
+        self.date = date
+        self.subject = subject
+        self.branches = branches
+
+class CommitIndex:
+    '''
+    The database. Each call opens its own connection, so any thread can use
+    it, and so can other git-mux processes at the same time.
+    '''
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(config.CACHE_FOLDER, _DB_FNAME)
+        self.path = path
+    def _connect(self):
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        db = sqlite3.connect(self.path, timeout=_BUSY_SECONDS)
+        for statement in _SCHEMA:
+            db.execute(statement)
+        return db
+    def get_tips(self, component_name):
+        db = self._connect()
+        try:
+            return dict(db.execute('SELECT branch, sha FROM tips WHERE component = ?', (component_name,)).fetchall())
+        finally:
+            db.close()
+    def apply(self, component_name, changes):
+        '''
+        Record what scan() found. Returns how many commits were new.
+        '''
+        db = self._connect()
+        try:
+            with db:
+                c = component_name
+                for name in changes.reset:
+                    db.execute('DELETE FROM branch_commits WHERE component = ? AND branch = ?', (c, name))
+                    db.execute('DELETE FROM tips WHERE component = ? AND branch = ?', (c, name))
+                db.executemany('INSERT OR IGNORE INTO commits VALUES (?, ?, ?, ?, ?)',
+                               [(c, sha, author, date, subject) for sha, author, date, subject, tickets in changes.commits])
+                db.executemany('INSERT OR IGNORE INTO tickets VALUES (?, ?, ?)',
+                               [(t, c, commit[0]) for commit in changes.commits for t in commit[4]])
+                for name, shas in changes.added.items():
+                    db.executemany('INSERT OR IGNORE INTO branch_commits VALUES (?, ?, ?)', [(c, sha, name) for sha in shas])
+                    db.execute('INSERT OR REPLACE INTO tips VALUES (?, ?, ?)', (c, name, changes.tips[name]))
+                if changes.reset:
+                    # Forget commits that no branch contains anymore.
+                    db.execute('DELETE FROM commits WHERE component = ? AND sha NOT IN '
+                               '(SELECT sha FROM branch_commits WHERE component = ?)', (c, c))
+                    db.execute('DELETE FROM tickets WHERE component = ? AND sha NOT IN '
+                               '(SELECT sha FROM branch_commits WHERE component = ?)', (c, c))
+            return len(changes.commits)
+        finally:
+            db.close()
+    def find(self, term, component_names, contains=None):
+        '''
+        Return the Commits in these components that mention term: as a ticket
+        ID if it looks like one, else anywhere in the subject, or as the start
+        of a SHA. Newest first. Branches outside the trunk only have rows for
+        their own commits, so if given, contains(component_name, sha,
+        branches) is asked for any others that have a commit; branches are
+        the ones the index knows about.
+        '''
+        if isinstance(term, bytes):
+            # Command-line args under python 2; sqlite wants text.
+            term = term.decode('utf-8', 'replace')
+        db = self._connect()
+        try:
+            marks = ', '.join('?' * len(component_names))
+            ticket = get_ticket_pattern().match(term.upper())
+            if ticket and ticket.group(0) == term.upper():
+                rows = db.execute('SELECT c.component, c.sha, c.author, c.date, c.subject FROM tickets t '
+                                  'JOIN commits c ON c.component = t.component AND c.sha = t.sha '
+                                  'WHERE t.ticket = ? AND c.component IN (%s) ORDER BY c.date DESC' % marks,
+                                  [term.upper()] + component_names).fetchall()
+            else:
+                like = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                # Short hex words are more likely English than SHAs.
+                sha = term.lower() + '%' if _SHA_PREFIX_PAT.match(term) else ''
+                rows = db.execute('SELECT component, sha, author, date, subject FROM commits '
+                                  'WHERE (subject LIKE ? ESCAPE \'\\\' OR sha LIKE ?) AND component IN (%s) '
+                                  'ORDER BY date DESC' % marks,
+                                  [like, sha] + component_names).fetchall()
+            commits = []
+            for component_name, sha, author, date, subject in rows:
+                branches = [x[0] for x in db.execute('SELECT branch FROM branch_commits WHERE component = ? AND sha = ? '
+                                                     'ORDER BY branch', (component_name, sha))]
+                if contains:
+                    branches = sorted(set(branches) | set(contains(component_name, sha, branches)))
+                commits.append(Commit(component_name, sha, author, date, subject, branches))
+            return commits
+        finally:
+            db.close()
+
+_index = None
+
+def get():
+    global _index
+    if _index is None:
+        _index = CommitIndex()
+    return _index
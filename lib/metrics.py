@@ -0,0 +1,254 @@
+'''
+Operation metrics in Prometheus text formats.
+
+Set "metrics file" in the misc section of config to a path--say, git-mux.prom
+in a node-exporter textfile collector's folder--and every run folds what it
+measured into the totals there, so counters only ever go up, the way
+Prometheus expects. The file is in the classic Prometheus (0.0.4) text
+format, which is what that collector reads. The running totals live in the
+cache folder. Set "metrics port" too, and while a batch runs, the same numbers
+(including the batch's own, so far) are served in OpenMetrics format at
+http://127.0.0.1:<port>/metrics.
+
+We measure how long each command and each component took, how many git
+processes we started, bytes fetched and pushed, network retries and
+timeouts, time spent waiting for locks, and how often our caches (including
+the in-memory branch index) had what we asked for.
+'''
+
+import os, sys, io, json, threading, tempfile, errno, BaseHTTPServer
+
+import config
+
+isWindows = sys.platform=="win32" or sys.platform=="cygwin"
+if not isWindows:
+    import fcntl
+
+DURATION_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+# Every metric we know about: name -> (type, unit, help).
+_FAMILIES = {
+    'gitmux_command_duration_seconds': ('histogram', 'seconds', 'How long each git mux command took.'),
+    'gitmux_component_duration_seconds': ('histogram', 'seconds', 'How long a command spent on each component.'),
+    'gitmux_git_commands': ('counter', None, 'git processes started.'),
+    'gitmux_git_retries': ('counter', None, 'Network git commands retried after a transient failure.'),
+    'gitmux_git_timeouts': ('counter', None, 'Network git commands killed for missing their deadline.'),
+    'gitmux_fetched_bytes': ('counter', 'bytes', 'Size of the objects that fetches, pulls and clones brought in.'),
+    'gitmux_pushed_bytes': ('counter', 'bytes', 'Size of the objects that pushes sent.'),
+    'gitmux_lock_acquisitions': ('counter', None, 'Component and engine locks requested, by outcome.'),
+    'gitmux_lock_wait_seconds': ('counter', 'seconds', 'Time spent waiting for locks that another run held.'),
+    'gitmux_cache_requests': ('counter', None, 'Cache lookups, by cache and result (hit or miss).'),
+}
+
+_TOTALS_FNAME = 'metrics-totals.json'
+_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+def get_path():
+    path = config.cfg.try_get(config.MISC_SECTION, config.METRICS_FILE_KEY)
+    if path:
+        return os.path.abspath(os.path.expanduser(path))
+    return None
+
+def get_port():
+    try:
+        return int(config.cfg.try_get(config.MISC_SECTION, config.METRICS_PORT_KEY, 0))
+    except ValueError:
+        return 0
+
+_enabled = None
+def enabled():
+    # Config doesn't change while we run, so look just once.
+    global _enabled
+    if _enabled is None:
+        _enabled = bool(get_path() or get_port())
+    return _enabled
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+class Registry:
+    '''
+    Counters and histograms, keyed by metric name and labels. Safe to share
+    between threads.
+    '''
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = {'buckets': [0] * len(DURATION_BUCKETS), 'count': 0, 'sum': 0.0}
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    sample['buckets'][i] += 1
+            sample['count'] += 1
+            sample['sum'] += value
+    def merge(self, samples):
+        with self._lock:
+            for key, value in samples.items():
+                mine = self.samples.get(key)
+                if mine is None:
+                    self.samples[key] = json.loads(json.dumps(value))
+                elif isinstance(value, dict):
+                    mine['buckets'] = [a + b for a, b in zip(mine['buckets'], value['buckets'])]
+                    mine['count'] += value['count']
+                    mine['sum'] += value['sum']
+                else:
+                    self.samples[key] = mine + value
+    def take(self):
+        # Hand back everything recorded so far, and start afresh.
+        with self._lock:
+            samples, self.samples = self.samples, {}
+        return samples
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.samples))
+
+registry = Registry()
+
+def inc(name, amount=1, **labels):
+    if enabled():
+        registry.inc(name, amount, **labels)
+
+def observe(name, value, **labels):
+    if enabled():
+        registry.observe(name, value, **labels)
+
+def _format_labels(labels, extra=None):
+    pairs = labels + (extra or [])
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in pairs)
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render(samples, openmetrics=True):
+    '''
+    Return samples (as kept by a Registry) in OpenMetrics text format, or
+    if openmetrics is False, in the classic Prometheus text format. The
+    classic format has no UNIT or EOF lines, and names counter families
+    for their samples (with "_total").
+    '''
+    by_family = {}
+    for key, value in samples.items():
+        name, labels = json.loads(key)
+        by_family.setdefault(name, []).append(([tuple(x) for x in labels], value))
+    lines = []
+    for name in sorted(by_family.keys()):
+        kind, unit, descrip = _FAMILIES.get(name, ('unknown', None, ''))
+        family = name
+        if not openmetrics:
+            if kind == 'counter':
+                family = name + '_total'
+            elif kind == 'unknown':
+                kind = 'untyped'
+        lines.append('# TYPE %s %s' % (family, kind))
+        if unit and openmetrics:
+            lines.append('# UNIT %s %s' % (family, unit))
+        lines.append('# HELP %s %s' % (family, descrip))
+        for labels, value in sorted(by_family[name]):
+            if kind == 'histogram':
+                for bound, count in zip(DURATION_BUCKETS, value['buckets']):
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', repr(float(bound)))]), count))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', '+Inf')]), value['count']))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), value['count']))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_number(value['sum'])))
+            else:
+                lines.append('%s_total%s %s' % (name, _format_labels(labels), _format_number(value)))
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def _read_totals():
+    path = os.path.join(config.CACHE_FOLDER, _TOTALS_FNAME)
+    if os.path.isfile(path):
+        try:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            pass
+    return {}
+
+def _write_atomically(path, txt):
+    handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with io.open(handle, 'w', encoding='utf-8') as f:
+            f.write(txt if isinstance(txt, type(u'')) else txt.decode('utf-8'))
+        # Collectors usually run as some other user.
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+def save():
+    '''
+    Fold what this process measured into the running totals, and rewrite
+    the metrics file from them.
+    '''
+    path = get_path()
+    samples = registry.take()
+    if not path or not samples:
+        return
+    if not os.path.isdir(config.CACHE_FOLDER):
+        os.makedirs(config.CACHE_FOLDER)
+    # Runs that finish together mustn't lose each other's numbers.
+    with open(os.path.join(config.CACHE_FOLDER, _TOTALS_FNAME + '.lock'), 'a') as lock:
+        if not isWindows:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        totals = Registry()
+        totals.merge(_read_totals())
+        totals.merge(samples)
+        _write_atomically(os.path.join(config.CACHE_FOLDER, _TOTALS_FNAME), json.dumps(totals.samples, sort_keys=True))
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        _write_atomically(path, render(totals.samples, openmetrics=False))
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        totals = Registry()
+        totals.merge(_read_totals())
+        totals.merge(registry.snapshot())
+        body = render(totals.samples).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', _CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        # Scrapes aren't news.
+        pass
+
+def serve():
+    '''
+    If "metrics port" is configured, serve /metrics on localhost from a
+    background thread for as long as we run. Returns the server, or None.
+    '''
+    port = get_port()
+    if not port:
+        return None
+    try:
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _Handler)
+    except (IOError, OSError) as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        sys.stderr.write('Port %d is busy; not serving metrics.\n' % port)
+        return None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
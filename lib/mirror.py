@@ -0,0 +1,284 @@
+'''
+A host-wide cache of bare mirrors of component remotes.
+
+Build hosts often have several GMUX_ROOTs (one per user or CI executor), and
+each used to clone every component over the network. Set "mirror folder" in
+the misc section of config to a folder that all of them can write, and new
+clones borrow objects from a mirror there (git clone --reference ...
+--dissociate), so only what the mirror lacks crosses the network. Each time a
+mirror is used, a single background fetch (shared by every root on the host)
+brings it up to date if it's gone stale. When the mirrors outgrow "mirror max
+mb", the least recently used ones are evicted.
+
+Run "python mirror.py refresh <path>" to refresh one mirror; that's how the
+background fetch works.
+'''
+
+import os, sys, time, hashlib, shutil, subprocess, threading, errno, signal
+
+import config, network
+
+isWindows = sys.platform=="win32" or sys.platform=="cygwin"
+if not isWindows:
+    import fcntl
+
+DEFAULT_MAX_MB = 10 * 1024
+# Don't fetch into a mirror more often than this.
+REFRESH_SECONDS = 5 * 60
+
+_USED_STAMP = 'git-mux-used'
+_FETCHED_STAMP = 'git-mux-fetched'
+
+def get_folder():
+    '''
+    Return the host-wide mirror folder, or None if mirrors are turned off.
+    '''
+    folder = config.cfg.try_get(config.MISC_SECTION, config.MIRROR_FOLDER_KEY)
+    if folder:
+        return os.path.abspath(os.path.expanduser(folder))
+    return None
+
+def get_max_bytes():
+    try:
+        mb = int(config.cfg.try_get(config.MISC_SECTION, config.MIRROR_MAX_MB_KEY, DEFAULT_MAX_MB))
+    except ValueError:
+        mb = DEFAULT_MAX_MB
+    return mb * 1024 * 1024
+
+def path_for(url):
+    # Readable, but unique per URL, since several remotes may share a name.
+    name = url.rstrip('/').split('/')[-1].split(':')[-1]
+    if name.endswith('.git'):
+        name = name[:-4]
+    return os.path.join(get_folder(), '%s-%s.git' % (name, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]))
+
+# Files that every git-mux user on the host needs to get at.
+_SHARED_MODE = 0o664
+
+def _open_shared(path, flags):
+    # Open path (creating it if need be) and return a file descriptor. Other
+    # users on the host share our mirrors, so whatever we create must be
+    # group-writable, whatever our umask says.
+    fd = os.open(path, flags | os.O_CREAT, _SHARED_MODE)
+    if not isWindows:
+        try:
+            if os.fstat(fd).st_uid == os.getuid():
+                os.fchmod(fd, _SHARED_MODE)
+        except OSError:
+            pass
+    return fd
+
+class _FileLock:
+    # An flock on a file beside a mirror. Any number of git-mux runs may use a
+    # mirror (shared); creating or evicting it needs it to ourselves.
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+    def acquire(self, shared=False, wait=True):
+        if isWindows:
+            return True
+        if self.handle is None:
+            # flock needs no write access, so a lock file that someone else
+            # made without it still works.
+            self.handle = os.fdopen(_open_shared(self.path, os.O_RDONLY), 'r')
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not wait:
+            mode |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.handle, mode)
+            return True
+        except IOError as e:
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+        self.release()
+        return False
+    def release(self):
+        if self.handle is not None:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+
+def _stamp(path, name):
+    with os.fdopen(_open_shared(os.path.join(path, name), os.O_WRONLY | os.O_TRUNC), 'w') as f:
+        f.write(time.strftime('%Y-%m-%d %H:%M:%SZ\n', time.gmtime()))
+
+def _stamp_age(path, name):
+    try:
+        return time.time() - os.path.getmtime(os.path.join(path, name))
+    except OSError:
+        return None
+
+class Mirror:
+    '''
+    Use the mirror of url in a "with" block, creating it first if need be.
+    git is the git instance that runs the clone, so it gets the usual
+    deadlines and retries. While the block runs, the mirror can't be evicted.
+    If the mirror folder isn't ours to use (another user made it, without
+    sharing it with us), "as" gets None, and the caller should do without.
+    '''
+    def __init__(self, url, git):
+        self.url = url
+        self.git = git
+        self.path = path_for(url)
+        self._lock = _FileLock(self.path + '.lock')
+        self._entered = False
+    def __enter__(self):
+        try:
+            created = self._enter()
+        except (IOError, OSError) as e:
+            if e.errno not in [errno.EACCES, errno.EPERM]:
+                raise
+            self._lock.release()
+            sys.stderr.write('Can\'t use the shared mirror in %s (%s); cloning without it.\n' % (self.path, e.strerror))
+            return None
+        self._entered = True
+        if created:
+            evict(keep=self.path)
+        return self
+    def _enter(self):
+        # Lock (and if need be, create) the mirror. Returns True if we
+        # created it.
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        created = False
+        # Most of the time the mirror is there already, and a shared lock is
+        # all we need; only creating it needs the mirror to ourselves.
+        self._lock.acquire(shared=True)
+        try:
+            if not os.path.isdir(self.path):
+                # flock can't upgrade atomically, so someone else may create
+                # it while we wait; look again once it's ours.
+                self._lock.acquire()
+                if not os.path.isdir(self.path):
+                    sys.stderr.write('Creating shared mirror of %s in %s...\n' % (self.url, self.path))
+                    try:
+                        # Other users' roots on this host will fetch into it too.
+                        self.git.clone('--mirror', '--config', 'core.sharedRepository=group', self.url, self.path)
+                    except:
+                        if os.path.isdir(self.path):
+                            shutil.rmtree(self.path)
+                        raise
+                    if not isWindows:
+                        # git shares what it puts inside; share the folder too.
+                        os.chmod(self.path, 0o2775)
+                    _stamp(self.path, _FETCHED_STAMP)
+                    created = True
+                # Trade our exclusive lock back for a shared one, so other
+                # runs can use the mirror alongside us.
+                self._lock.acquire(shared=True)
+            _stamp(self.path, _USED_STAMP)
+        except:
+            self._lock.release()
+            raise
+        return created
+    def __exit__(self, type, value, traceback):
+        if not self._entered:
+            return
+        self._lock.release()
+        refresh_in_background(self.path)
+
+def refresh_in_background(path):
+    '''
+    Start a detached process that fetches into the mirror, unless it was
+    fetched recently. The process outlives us, and only one runs per mirror.
+    '''
+    age = _stamp_age(path, _FETCHED_STAMP)
+    if age is not None and age < REFRESH_SECONDS:
+        return
+    kwargs = {}
+    if not isWindows:
+        kwargs['preexec_fn'] = os.setsid
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'refresh', path],
+                         stdin=devnull, stdout=devnull, stderr=devnull, close_fds=not isWindows, **kwargs)
+
+def refresh(path):
+    # Only one fetch per mirror at a time; anyone else can skip theirs.
+    refresh_lock = _FileLock(path + '.refresh.lock')
+    if not refresh_lock.acquire(wait=False):
+        return 0
+    lock = _FileLock(path + '.lock')
+    try:
+        # Hold off eviction while we fetch, but don't wait on a creator.
+        if not lock.acquire(shared=True, wait=False) or not os.path.isdir(path):
+            return 0
+        # git runs ssh as a grandchild, and a hung ssh would outlive a kill
+        # of git alone; so give the fetch a process group of its own, and
+        # kill the whole group when time runs out.
+        kwargs = {}
+        if not isWindows:
+            kwargs['preexec_fn'] = os.setsid
+        proc = subprocess.Popen(['git', '--git-dir', path, 'fetch', '--prune', '--quiet'], **kwargs)
+        def kill():
+            try:
+                if isWindows:
+                    proc.kill()
+                else:
+                    os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timeout = network.get_timeout(None, 'fetch')
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        exit_code = proc.wait()
+        if timer:
+            timer.cancel()
+        if not exit_code:
+            _stamp(path, _FETCHED_STAMP)
+        return exit_code
+    finally:
+        lock.release()
+        refresh_lock.release()
+
+def _get_size(path):
+    total = 0
+    for folder, subfolders, fnames in os.walk(path):
+        for fname in fnames:
+            try:
+                total += os.path.getsize(os.path.join(folder, fname))
+            except OSError:
+                pass
+    return total
+
+def evict(keep=None):
+    '''
+    Delete the least recently used mirrors until the rest fit in the size
+    limit. Mirrors that anyone is using are left alone.
+    '''
+    folder = get_folder()
+    mirrors = [os.path.join(folder, x) for x in os.listdir(folder) if x.endswith('.git')]
+    sizes = dict((path, _get_size(path)) for path in mirrors)
+    total = sum(sizes.values())
+    limit = get_max_bytes()
+    mirrors.sort(key=lambda path: _stamp_age(path, _USED_STAMP) or 0, reverse=True)
+    for path in mirrors:
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        lock = _FileLock(path + '.lock')
+        refresh_lock = _FileLock(path + '.refresh.lock')
+        if lock.acquire(wait=False):
+            try:
+                if refresh_lock.acquire(wait=False):
+                    try:
+                        sys.stderr.write('Evicting shared mirror %s (%d MB).\n' % (path, sizes[path] / (1024 * 1024)))
+                        shutil.rmtree(path)
+                        total -= sizes[path]
+                    finally:
+                        refresh_lock.release()
+            finally:
+                lock.release()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'refresh':
+        sys.exit(refresh(sys.argv[2]))
+    sys.stderr.write('Usage: python mirror.py refresh <path>\n')
+    sys.exit(1)
@@ -0,0 +1,170 @@
+'''
+Timeouts and retries for the git commands that talk to a remote.
+
+A single hung ssh connection used to stall a whole mux run forever. Now every
+clone, fetch, pull, push and ls-remote gets a deadline, and failures that look
+like network trouble are retried a few times with exponential backoff plus
+jitter. Deadlines come from the "network timeouts" section of config, where
+keys may name a step ("fetch = 60"), a step in one component ("alpha fetch =
+300"), or a fallback for everything ("default = 120"); 0 means no deadline.
+The "network retries" and "retry backoff" keys in the misc section tune the
+retries.
+
+We also remember which components needed retries or timed out, run after run,
+so the slow-component report can point at the remotes that keep misbehaving.
+'''
+
+import re, time, random, threading
+
+import config, cache
+
+NETWORK_VERBS = ['clone', 'fetch', 'pull', 'push', 'ls-remote']
+
+DEFAULT_TIMEOUTS = {
+    'clone': 600,
+    'fetch': 120,
+    'pull': 180,
+    'push': 120,
+    'ls-remote': 30,
+}
+DEFAULT_RETRY_COUNT = 2
+DEFAULT_BACKOFF_SECONDS = 2.0
+_MAX_BACKOFF_SECONDS = 60.0
+
+# What stderr says about a command that we killed for running too long (the
+# same thing gitpython says about the ones it kills).
+_TIMEOUT_PAT = re.compile(r'Timeout: the command .* did not complete')
+_TRANSIENT_PAT = re.compile(r'Timeout: the command|Could not resolve host|Connection (?:timed out|reset|refused|closed)|'
+                            r'Operation timed out|early EOF|remote end hung up|RPC failed|gnutls_handshake|'
+                            r'(?:kex|ssh)_exchange_identification|Temporary failure in name resolution', re.IGNORECASE)
+
+def get_verb(command):
+    '''
+    Return the git subcommand in a gitpython command list, skipping the
+    executable and any "-c name=value" options in front of it.
+    '''
+    i = 1
+    while i < len(command):
+        arg = command[i]
+        if arg == '-c':
+            i += 2
+        elif arg.startswith('-'):
+            i += 1
+        else:
+            return arg
+    return None
+
+def get_timeout(component_name, verb):
+    '''
+    Return how many seconds verb may run in a component, or None for no limit.
+    '''
+    cfg = config.cfg
+    section = config.NETWORK_TIMEOUTS_SECTION
+    value = DEFAULT_TIMEOUTS.get(verb)
+    for key in ['%s %s' % (component_name, verb), verb, 'default']:
+        if cfg.has_option(section, key):
+            value = cfg.get(section, key)
+            break
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = DEFAULT_TIMEOUTS.get(verb)
+    if not value or value <= 0:
+        return None
+    return value
+
+def get_retry_count():
+    try:
+        count = int(config.cfg.try_get(config.MISC_SECTION, config.NETWORK_RETRIES_KEY, DEFAULT_RETRY_COUNT))
+    except ValueError:
+        count = DEFAULT_RETRY_COUNT
+    return max(0, count)
+
+def get_backoff(attempt):
+    '''
+    Return how long to sleep before retry number attempt (1-based). The
+    ceiling doubles each time; the actual delay falls randomly between half
+    the ceiling and all of it, so components that failed together don't all
+    retry in lockstep.
+    '''
+    try:
+        base = float(config.cfg.try_get(config.MISC_SECTION, config.RETRY_BACKOFF_KEY, DEFAULT_BACKOFF_SECONDS))
+    except ValueError:
+        base = DEFAULT_BACKOFF_SECONDS
+    ceiling = min(_MAX_BACKOFF_SECONDS, base * (2 ** (attempt - 1)))
+    return random.uniform(ceiling / 2, ceiling)
+
+def is_timeout(stderr):
+    return bool(stderr) and bool(_TIMEOUT_PAT.search(stderr))
+
+def is_transient(stderr):
+    return bool(stderr) and bool(_TRANSIENT_PAT.search(stderr))
+
+class _ComponentStats:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.slowest = 0.0
+        self.slowest_verb = None
+
+class NetworkStats:
+    '''
+    How the network behaved for each component during this run, plus a
+    persistent history that survives from run to run.
+    '''
+    def __init__(self):
+        self._components = {}
+        self._lock = threading.Lock()
+        self._history = cache.JsonCache('network-history')
+    def record(self, component_name, verb, seconds, timed_out=False, retried=False, failed=False):
+        with self._lock:
+            stats = self._components.get(component_name)
+            if stats is None:
+                stats = self._components[component_name] = _ComponentStats()
+            stats.calls += 1
+            stats.retries += int(retried)
+            stats.timeouts += int(timed_out)
+            stats.failures += int(failed)
+            if seconds > stats.slowest:
+                stats.slowest, stats.slowest_verb = seconds, verb
+    def troubled(self):
+        # Components that needed a retry or hit a deadline during this run.
+        with self._lock:
+            return sorted([name for name, stats in self._components.items() if stats.retries or stats.timeouts])
+    def get_report(self):
+        '''
+        Return lines describing the components that gave us trouble during
+        this run, with their history, or an empty list if all went well.
+        '''
+        lines = []
+        for name in self.troubled():
+            stats = self._components[name]
+            history = self._history.get(name) or {}
+            lines.append('%s: %d timeouts, %d retries, %d failures in %d network calls; slowest was %s (%.1fs). '
+                         'Timed out in %d of %d earlier runs.' % (
+                name, stats.timeouts, stats.retries, stats.failures, stats.calls, stats.slowest_verb,
+                stats.slowest, history.get('runs with timeouts', 0), history.get('runs', 0)))
+        return lines
+    def save(self):
+        '''
+        Fold this run into the persistent history, and start counting afresh.
+        '''
+        with self._lock:
+            components, self._components = self._components, {}
+        if not components:
+            return
+        for name, stats in components.items():
+            history = self._history.get(name) or {}
+            history['runs'] = history.get('runs', 0) + 1
+            history['runs with timeouts'] = history.get('runs with timeouts', 0) + int(bool(stats.timeouts))
+            history['timeouts'] = history.get('timeouts', 0) + stats.timeouts
+            history['retries'] = history.get('retries', 0) + stats.retries
+            history['failures'] = history.get('failures', 0) + stats.failures
+            if stats.timeouts:
+                history['last timeout'] = time.strftime('%Y-%m-%d %H:%M:%SZ', time.gmtime())
+            self._history.put(name, history)
+        self._history.save()
+
+stats = NetworkStats()
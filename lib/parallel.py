@@ -0,0 +1,126 @@
+'''
+Run the same piece of work against many components at once.
+'''
+
+import sys, traceback, threading
+from multiprocessing.pool import ThreadPool
+
+import config
+
+DEFAULT_JOB_COUNT = 8
+
+# ThreadPool's results can't be interrupted with CTRL+C under python 2 unless
+# we wait with a timeout, so we wait for a very long time instead of forever.
+_FOREVER = 60 * 60 * 24 * 365
+
+def get_job_count():
+    '''
+    Return how many components we're willing to work on at the same time.
+    Users can tune this with the "jobs" key in the misc section of config,
+    or for one command with --jobs (see set_job_count()).
+    '''
+    jobs = get_job_override()
+    if jobs:
+        return jobs
+    try:
+        jobs = int(config.cfg.try_get(config.MISC_SECTION, config.JOBS_KEY, DEFAULT_JOB_COUNT))
+    except ValueError:
+        jobs = DEFAULT_JOB_COUNT
+    return max(1, jobs)
+
+class Outcome:
+    '''
+    What happened when we called a function for one item: either the value
+    it returned, or the exception it raised (and the formatted traceback).
+    '''
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.traceback = None
+
+# Thread-local attributes that travel with work handed to run_all's threads.
+_inherited = []
+
+# The current thread's --jobs override, if any.
+_jobs = threading.local()
+
+def inherit(local, name):
+    '''
+    Make run_all copy local.<name> from the calling thread into the threads
+    that do the work, so per-thread settings apply to the whole operation.
+    '''
+    _inherited.append((local, name))
+
+inherit(_jobs, 'count')
+
+def set_job_count(jobs):
+    '''
+    Override the configured job count for the rest of this thread's command
+    (and the threads it hands work to). Pass None to go back to config.
+    '''
+    if jobs is not None:
+        jobs = max(1, int(jobs))
+    _jobs.count = jobs
+
+def get_job_override():
+    '''
+    Return the current thread's --jobs override, or None.
+    '''
+    return getattr(_jobs, 'count', None)
+
+def wait(async_result):
+    '''
+    Return the value of a ThreadPool AsyncResult, blocking until it's ready
+    but still honoring CTRL+C.
+    '''
+    return async_result.get(_FOREVER)
+
+def run_all(func, items, jobs=None, priority=None):
+    '''
+    Call func(item) for every item, using up to jobs threads, and return a
+    list of Outcome objects in the same order as items. Exceptions (even
+    SystemExit) are captured rather than propagated, so one bad component
+    can't strand the others.
+
+    Threads take items one at a time, as they come free. If priority is
+    given, items are started in descending order of priority(item) instead
+    of in order; results still come back in order.
+    '''
+    items = [x for x in items]
+    context = [(local, name, getattr(local, name, None)) for local, name in _inherited]
+
+    def call(item):
+        outcome = Outcome(item)
+        # Pool threads get reused, so put back whatever they had before.
+        previous = [getattr(local, name, None) for local, name, value in context]
+        for local, name, value in context:
+            setattr(local, name, value)
+        try:
+            outcome.result = func(item)
+        except (Exception, SystemExit):
+            outcome.error = sys.exc_info()[1]
+            outcome.traceback = traceback.format_exc()
+        finally:
+            for (local, name, value), old in zip(context, previous):
+                setattr(local, name, old)
+        return outcome
+
+    if jobs is None:
+        jobs = get_job_count()
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return [call(item) for item in items]
+    order = list(range(len(items)))
+    if priority:
+        order.sort(key=lambda i: priority(items[i]), reverse=True)
+    pool = ThreadPool(jobs)
+    try:
+        outcomes = wait(pool.map_async(call, [items[i] for i in order], chunksize=1))
+        ordered = [None] * len(items)
+        for i, outcome in zip(order, outcomes):
+            ordered[i] = outcome
+        return ordered
+    finally:
+        pool.close()
+        pool.join()
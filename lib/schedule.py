@@ -0,0 +1,97 @@
+'''
+Which components to start first, based on how long they took before.
+
+Components are reported alphabetically, and they used to be started that way
+too, so a slow component that sorts last (say, a six-minute monorepo push)
+started after everything else and ran on alone at the end of every parallel
+run. Now we remember how long each component took for each verb, run after
+run, and start the ones we expect to take longest first. With a fixed number
+of workers, each taking the next component as soon as it's free, that keeps
+the run's total time (its makespan) close to the best possible. After a
+parallel run, we say how long we expected it to take and how long it did.
+'''
+
+import heapq, threading
+
+import cache
+
+# How much the newest duration counts, against everything before it.
+_WEIGHT = 0.5
+# How many of the worst guesses to mention, and how far off a guess must be
+# to count as bad.
+_MISSES_COUNT = 3
+_MISS_MIN_SECONDS = 0.5
+_MISS_FRACTION = 0.25
+
+def get_makespan(seconds, jobs):
+    '''
+    Return how long a run takes if jobs workers take durations (a list of
+    seconds) in order, each starting the next one as soon as it's free.
+    '''
+    finish = [0.0] * max(1, min(jobs, len(seconds)))
+    for s in seconds:
+        heapq.heappush(finish, heapq.heappop(finish) + s)
+    return max(finish) if seconds else 0.0
+
+class DurationHistory:
+    '''
+    How long each component took for each verb, as a moving average that
+    favors recent runs. Kept in the cache folder.
+    '''
+    def __init__(self):
+        self._history = cache.JsonCache('duration-history')
+        self._lock = threading.Lock()
+    def record(self, component_name, verb, seconds):
+        with self._lock:
+            entry = self._history.get(component_name) or {}
+            previous = entry.get(verb)
+            if previous:
+                previous['seconds'] = _WEIGHT * seconds + (1 - _WEIGHT) * previous['seconds']
+                previous['runs'] += 1
+            else:
+                entry[verb] = {'seconds': seconds, 'runs': 1}
+            self._history.put(component_name, entry)
+    def predict(self, component_names, verb):
+        '''
+        Return a dict of component name -> expected seconds for verb. A
+        component we've never timed is expected to take as long as the
+        others do on average; if we've timed none, we have no expectations.
+        '''
+        expected = {}
+        for name in component_names:
+            entry = (self._history.get(name) or {}).get(verb)
+            if entry:
+                expected[name] = entry['seconds']
+        if expected:
+            average = sum(expected.values()) / len(expected)
+            for name in component_names:
+                expected.setdefault(name, average)
+        return expected
+    def save(self):
+        self._history.save()
+
+history = DurationHistory()
+
+def get_report(expected, actual, wall_seconds, jobs, waves=None):
+    '''
+    Compare a run against what we expected of it. expected and actual map
+    component name -> seconds; wall_seconds is how long the whole run took.
+    If the run went in waves (lists of component names, each waiting for
+    the one before), pass them too. Returns a dict with the predicted and
+    actual makespan, and the components whose guesses were furthest off (if
+    any were far off), or None if we had no expectations.
+    '''
+    names = [x for x in actual if x in expected]
+    if not names:
+        return None
+    predicted = 0.0
+    for wave in waves or [names]:
+        predicted += get_makespan(sorted([expected[x] for x in wave if x in names], reverse=True), jobs)
+    misses = [x for x in names if abs(actual[x] - expected[x]) > max(_MISS_MIN_SECONDS, _MISS_FRACTION * expected[x])]
+    misses = sorted(misses, key=lambda x: abs(actual[x] - expected[x]), reverse=True)[0:_MISSES_COUNT]
+    return {
+        'predicted': predicted,
+        'actual': wall_seconds,
+        'jobs': jobs,
+        'misses': [(x, expected[x], actual[x]) for x in misses],
+    }
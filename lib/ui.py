@@ -1,9 +1,9 @@
-import sys, re, os
+import sys, re, os, threading, json, time, tempfile, pickle
 isWindows = sys.platform == "win32" or sys.platform == "cygwin"
 if not isWindows:
     import termios, tty
 
-import cmd
+import cmd, parallel
 
 # Define our colors.
 def c(x,y):
@@ -37,6 +37,7 @@ COLOR_NAMES = str('BLACK,RED,GREEN,YELLOW,BLUE,PURPLE,CYAN,LIGHT_GRAY,'
 
 _SEQ = chr(27) + '['
 _COLOR_PAT = re.compile('(' + chr(27) + r'\[([01]);3([0-7])m).*')
+_ANY_SEQ_PAT = re.compile(chr(27) + r'\[[0-9;]*m')
 _LEN_NORMTXT = len(NORMTXT)
 _LEN_SEQ = len(_SEQ)
 
@@ -302,8 +303,10 @@ else:
     def _resetc(handle):
         handle.write(NORMTXT)
 
-def cwrap(txt, begin_color, end_color = NORMTXT, handle=_STDOUT):
+def cwrap(txt, begin_color, end_color = NORMTXT, handle=None):
     # Wrap text in a begin color and end color, if colors are active.
+    if handle is None:
+        handle = _STDOUT
     if _should_colorize(handle):
         if begin_color:
             txt = begin_color + txt
@@ -311,10 +314,58 @@ def cwrap(txt, begin_color, end_color = NORMTXT, handle=_STDOUT):
             txt = txt + end_color
     return txt
 
+_json_mode = False
+_emit_lock = threading.Lock()
+
+def set_json_mode(value=True):
+    '''
+    Switch all output to JSON Lines: one object per event on stdout, with
+    no color processing. Anything written through this module's functions
+    becomes a "message" event.
+    '''
+    global _json_mode
+    _json_mode = value
+
+def json_mode():
+    return _json_mode
+
+# The component whose work the current thread is reporting, if any.
+_component = threading.local()
+
+def set_component(name):
+    '''
+    Say which component the current thread's output is about (None for
+    none), so JSON message events can say so too.
+    '''
+    _component.name = name
+
+def emit(event, **fields):
+    '''
+    Write one JSON object describing an event as a single line on stdout,
+    and flush it, so consumers can process long runs as a stream.
+    '''
+    record = {'event': event, 'time': round(time.time(), 3)}
+    record.update(fields)
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with _emit_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+def _emit_message(stream, txt):
+    txt = _ANY_SEQ_PAT.sub('', txt).rstrip('\n')
+    if txt:
+        component = getattr(_component, 'name', None)
+        if component:
+            emit('message', stream=stream, text=txt, component=component)
+        else:
+            emit('message', stream=stream, text=txt)
+
 def writec(txt, begin_color = None, end_color = NORMTXT):
     # Write text to stdout that contains embedded ANSI escape sequences.
     # If begin_color is set, wrap the text in that color and immediately
     # revert to the end color when finished..
+    if _json_mode:
+        return _emit_message('stdout', txt)
     txt = cwrap(txt, begin_color, end_color)
     _writec(_STDOUT, txt)
 
@@ -322,6 +373,8 @@ def ewritec(txt, begin_color = None, end_color = NORMTXT):
     # Write text to stderr that contains embedded ANSI escape sequences.
     # If begin_color is set, wrap the text in that color and immediately
     # revert to the end color when finished..
+    if _json_mode:
+        return _emit_message('stderr', txt)
     txt = cwrap(txt, begin_color, end_color, _STDERR)
     _writec(_STDERR, txt)
 
@@ -329,6 +382,8 @@ def printc(txt, begin_color = None, end_color = NORMTXT):
     # Print line to stdout that contains embedded ANSI escape sequences.
     # If begin_color is set, wrap the text in that color and immediately
     # revert to the end color when finished..
+    if _json_mode:
+        return _emit_message('stdout', txt)
     txt = cwrap(txt, begin_color, end_color)
     writec(txt + '\n')
 
@@ -336,9 +391,127 @@ def eprintc(txt, begin_color = None, end_color = NORMTXT):
     # Print line to stderr that contains embedded ANSI escape sequences.
     # If begin_color is set, wrap the text in that color and immediately
     # revert to the end color when finished..
+    if _json_mode:
+        return _emit_message('stderr', txt)
     txt = cwrap(txt, begin_color, end_color, _STDERR)
     ewritec(txt + '\n')
 
+# Which threads are capturing their output, and where it's going. Work that
+# a capturing thread hands to other threads is captured along with it.
+_capture = threading.local()
+parallel.inherit(_capture, 'current')
+_install_lock = threading.Lock()
+
+class _ThreadRouter:
+    # Stand-in for sys.stdout or sys.stderr. Text written by a thread that is
+    # capturing output lands in that thread's buffer; everything else passes
+    # straight through to the real stream.
+    def __init__(self, stream, name):
+        self._stream = stream
+        self._name = name
+    def write(self, txt):
+        capture = getattr(_capture, 'current', None)
+        if capture is None:
+            self._stream.write(txt)
+        else:
+            capture.add(self._name, txt)
+    def flush(self):
+        if getattr(_capture, 'current', None) is None:
+            self._stream.flush()
+    def isatty(self):
+        return self._stream.isatty()
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def _install_routers():
+    global _STDOUT, _STDERR
+    with _install_lock:
+        if isinstance(sys.stdout, _ThreadRouter):
+            return
+        sys.stdout = _ThreadRouter(sys.stdout, 'stdout')
+        sys.stderr = _ThreadRouter(sys.stderr, 'stderr')
+        if os.name == 'nt':
+            _STDOUT.file = sys.stdout
+            _STDERR.file = sys.stderr
+        else:
+            _STDOUT = sys.stdout
+            _STDERR = sys.stderr
+
+# How much captured output a thread may hold in memory before the rest waits
+# in a temporary file.
+_MAX_CAPTURED_BYTES = 1024 * 1024
+
+class OutputCapture:
+    '''
+    Hold everything the current thread writes to stdout and stderr (via these
+    functions or plain print) for the duration of a "with" block, so work
+    running on several threads at once can report without interleaving.
+    Call replay() afterward to write the output, in its original order.
+    Beyond _MAX_CAPTURED_BYTES, output is held on disk instead of in memory.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self._size = 0
+        self._spill = None
+        self._outer = None
+        self._lock = threading.Lock()
+    def add(self, name, txt):
+        with self._lock:
+            self.chunks.append((name, txt))
+            self._size += len(txt)
+            if self._size > _MAX_CAPTURED_BYTES:
+                if self._spill is None:
+                    self._spill = tempfile.TemporaryFile()
+                for chunk in self.chunks:
+                    pickle.dump(chunk, self._spill, 2)
+                self.chunks = []
+                self._size = 0
+    def __enter__(self):
+        _install_routers()
+        self._outer = getattr(_capture, 'current', None)
+        _capture.current = self
+        return self
+    def __exit__(self, type, value, traceback):
+        _capture.current = self._outer
+    def replay(self):
+        if self._spill is not None:
+            self._spill.seek(0)
+            while True:
+                try:
+                    name, txt = pickle.load(self._spill)
+                except EOFError:
+                    break
+                _replay_chunk(name, txt)
+            self._spill.close()
+            self._spill = None
+        for name, txt in self.chunks:
+            _replay_chunk(name, txt)
+        self.chunks = []
+        self._size = 0
+
+    def text(self):
+        '''
+        Return everything captured (stdout and stderr, in order) as plain
+        text, without colors, and without using it up.
+        '''
+        chunks = []
+        if self._spill is not None:
+            self._spill.seek(0)
+            while True:
+                try:
+                    chunks.append(pickle.load(self._spill)[1])
+                except EOFError:
+                    break
+            self._spill.seek(0, 2)
+        chunks += [txt for name, txt in self.chunks]
+        return _ANY_SEQ_PAT.sub('', ''.join(chunks))
+
+def _replay_chunk(name, txt):
+    if name == 'stdout':
+        sys.stdout.write(txt)
+    else:
+        sys.stderr.write(txt)
+
 if __name__ == '__main__':
     def disp(color, lbl, explanation = ''):
         printc(color + lbl.rjust(8) + NORMTXT + ' ' + explanation)
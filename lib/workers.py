@@ -0,0 +1,253 @@
+'''
+Spread one command's components across several worker processes or hosts.
+
+With hundreds of components, a single machine's disk and CPU run out long
+before our threads do. List workers in a "workers" section of config, each a
+command that starts git mux in a root of its own, on this host or another:
+
+    [workers]
+    w1 = env GMUX_ROOT=/srv/gmux/w1 python /opt/gmux/bin/gitmux.py
+    w2 = ssh build2 git mux
+
+Then "git mux shard <command>" splits the muxed components among the
+workers. It runs "<worker command> worker" for each one, writes the command
+and that worker's share of the components to its stdin as a line of JSON, and
+reads its results back as JSON Lines (the same events --json prints). Output
+is merged and shown in component order; with --json, events stream through
+as they arrive, each tagged with its worker.
+
+A component stays with the worker it had last time, so workers don't clone
+what another one already has. New components go, longest expected first
+(see schedule.py), to whichever worker has the least expected work; add
+--rebalance to deal everything out afresh. Each worker's root needs a
+config that muxes the components it's sent.
+'''
+
+import sys, json, shlex, subprocess, threading, time
+
+import config, ui, cache, schedule
+
+# Verbs whose work is split by component, and so can be sharded.
+SHARDABLE_VERBS = ['exec', 'sync', 'flow']
+_STDERR_TAIL_BYTES = 16 * 1024
+_SLOWEST_COUNT = 3
+
+_assignments = cache.JsonCache('shards')
+
+def get_workers():
+    '''
+    Return (name, command) pairs for the configured workers, where command
+    is a list of args.
+    '''
+    if not config.cfg.has_section(config.WORKERS_SECTION):
+        return []
+    return [(name, shlex.split(value)) for name, value in sorted(config.cfg.items(config.WORKERS_SECTION))]
+
+def assign(component_names, worker_names, expected, rebalance=False):
+    '''
+    Split components among workers. expected maps component name -> expected
+    seconds (components it lacks count as 1). Returns a dict of worker name
+    -> component names, in order.
+    '''
+    shards = dict((w, []) for w in worker_names)
+    load = dict((w, 0.0) for w in worker_names)
+    unassigned = []
+    for name in component_names:
+        worker_name = None if rebalance else _assignments.get(name)
+        if worker_name in shards:
+            shards[worker_name].append(name)
+            load[worker_name] += expected.get(name, 1.0)
+        else:
+            unassigned.append(name)
+    for name in sorted(unassigned, key=lambda x: expected.get(x, 1.0), reverse=True):
+        worker_name = min(worker_names, key=lambda w: (load[w], len(shards[w])))
+        shards[worker_name].append(name)
+        load[worker_name] += expected.get(name, 1.0)
+        _assignments.put(name, worker_name)
+    _assignments.save()
+    for worker_name in worker_names:
+        shards[worker_name].sort(key=component_names.index)
+    return shards
+
+def get_history_verb(argv):
+    # The verb that schedule.history files this command's durations under.
+    if argv[0] == 'flow':
+        return argv[2] if len(argv) > 2 else None
+    return argv[0]
+
+class Worker:
+    '''
+    One worker process, running one command on its share of components.
+    Everything it reports is kept in events, in order.
+    '''
+    def __init__(self, name, command, component_names):
+        self.name = name
+        self.command = command
+        self.component_names = component_names
+        self.events = []
+        self.exit_code = None
+        self.stderr_tail = ''
+        self.seconds = 0
+        self._threads = []
+    def start(self, argv, on_event):
+        self._start = time.time()
+        try:
+            self.proc = subprocess.Popen(self.command + ['worker'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        except OSError as e:
+            self.proc = None
+            self.stderr_tail = 'Couldn\'t start %s: %s' % (' '.join(self.command), e)
+            return
+        request = json.dumps({'argv': argv, 'components': self.component_names}) + '\n'
+        try:
+            self.proc.stdin.write(request.encode('utf-8'))
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            # It died already; wait() will say how.
+            pass
+        for target in [lambda: self._read_events(on_event), self._read_stderr]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+    def _read_events(self, on_event):
+        for line in iter(self.proc.stdout.readline, b''):
+            line = line.decode('utf-8', 'replace')
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # Not ours (an ssh banner, say); pass it along as text.
+                event = {'event': 'message', 'stream': 'stdout', 'text': line.rstrip('\n')}
+            if not isinstance(event, dict) or 'event' not in event:
+                continue
+            event['worker'] = self.name
+            self.events.append(event)
+            on_event(event)
+    def _read_stderr(self):
+        # Workers talk to stderr as they load config and so on; keep only
+        # the end, in case it explains a failure.
+        while True:
+            chunk = self.proc.stderr.read(4096)
+            if not chunk:
+                break
+            self.stderr_tail = (self.stderr_tail + chunk.decode('utf-8', 'replace'))[-_STDERR_TAIL_BYTES:]
+    def wait(self):
+        for thread in self._threads:
+            thread.join()
+        self.exit_code = self.proc.wait() if self.proc else 127
+        self.seconds = time.time() - self._start
+        return self.exit_code
+
+def run(argv, rebalance=False, component_names=None):
+    '''
+    Run argv (a shardable git mux command) across the configured workers,
+    and report the merged results. component_names are the components to
+    work on, in order. Returns the number of components that failed.
+    '''
+    workers = get_workers()
+    if not workers:
+        raise Exception('No workers; list them in the "%s" section of config.' % config.WORKERS_SECTION)
+    verb = get_history_verb(argv)
+    expected = schedule.history.predict(component_names, verb) if verb else {}
+    shards = assign(component_names, [name for name, command in workers], expected, rebalance)
+    streaming = ui.json_mode()
+    def on_event(event):
+        if streaming and event['event'] != 'exit':
+            fields = dict(event)
+            ui.emit(fields.pop('event'), **fields)
+    running = []
+    for name, command in workers:
+        if shards[name]:
+            if streaming:
+                ui.emit('worker_started', worker=name, components=shards[name])
+            worker = Worker(name, command, shards[name])
+            worker.start(argv, on_event)
+            running.append(worker)
+    for worker in running:
+        worker.wait()
+        if streaming:
+            ui.emit('worker_finished', worker=worker.name, exit_code=worker.exit_code, seconds=round(worker.seconds, 3))
+    results = {}
+    for worker in running:
+        for event in worker.events:
+            if event['event'] == 'result' and event.get('component'):
+                results[event['component']] = event
+    for component_name, result in results.items():
+        # Failures often come quickly, and say little about next time.
+        if verb and not result.get('exit_code') and result.get('seconds'):
+            schedule.history.record(component_name, verb, result['seconds'])
+    schedule.history.save()
+    if not streaming:
+        _render(running, component_names)
+    return _summarize(running, component_names, results)
+
+def _report_component_start(component_name):
+    line_width = 30 - len(component_name)
+    ui.printc('\n' + ui.PARAM_COLOR + component_name + ui.DELIM_COLOR + ' ' + '-'*line_width + ui.NORMTXT)
+
+def _report_message(event, prefix=''):
+    if event.get('stream') == 'stderr':
+        ui.eprintc(prefix + event['text'])
+    else:
+        ui.printc(prefix + event['text'])
+
+def _render(workers, component_names):
+    # Show what the workers said as if one process had done it all: each
+    # component's output, in component order, then anything else.
+    by_component = {}
+    loose = []
+    for worker in workers:
+        for event in worker.events:
+            component_name = event.get('component')
+            if component_name:
+                by_component.setdefault(component_name, []).append(event)
+            elif event['event'] == 'message':
+                loose.append(event)
+    for component_name in component_names:
+        events = by_component.get(component_name)
+        if not events:
+            continue
+        _report_component_start(component_name)
+        for event in events:
+            if event['event'] == 'message':
+                _report_message(event)
+            elif event['event'] == 'conflict':
+                ui.eprintc('%s conflicts with %s in %s.' % (event['branch'], event['target'], ', '.join(event['files'])),
+                           ui.ERROR_COLOR)
+            elif event['event'] == 'result':
+                if event.get('stdout'):
+                    ui.printc(event['stdout'].rstrip('\n'))
+                if event.get('stderr'):
+                    ui.eprintc(event['stderr'].rstrip('\n'), ui.ERROR_COLOR if event.get('exit_code') else None)
+                elif event.get('exit_code'):
+                    ui.eprintc('Exit code %s.' % event['exit_code'], ui.ERROR_COLOR)
+    for event in loose:
+        _report_message(event, '[%s] ' % event['worker'])
+
+def _summarize(workers, component_names, results):
+    lost = []
+    for worker in workers:
+        missing = [x for x in worker.component_names if x not in results]
+        if worker.exit_code and missing:
+            # A worker that died (or couldn't start) may not have reported
+            # on everything it was sent.
+            lost += missing
+            ui.eprintc('Worker %s failed (exit code %s) without reporting on %s.' % (worker.name, worker.exit_code,
+                       ', '.join(missing)), ui.ERROR_COLOR)
+            if worker.stderr_tail.strip() and not ui.json_mode():
+                ui.eprintc(worker.stderr_tail.strip(), ui.ERROR_COLOR)
+    seconds = dict((name, result['seconds']) for name, result in results.items() if result.get('seconds') is not None)
+    slowest = sorted(seconds.items(), key=lambda x: x[1], reverse=True)[0:_SLOWEST_COUNT]
+    failed = [x for x in component_names if x in lost or (x in results and results[x].get('exit_code'))]
+    if ui.json_mode():
+        ui.emit('shard_finished', workers=dict((w.name, w.component_names) for w in workers), failed=failed)
+        return len(failed)
+    sys.stderr.write('Sharded %d components across %d workers: %s.\n' % (
+        sum(len(w.component_names) for w in workers), len(workers),
+        ', '.join(['%s (%d, %.1fs)' % (w.name, len(w.component_names), w.seconds) for w in workers])))
+    if len(seconds) > 1:
+        sys.stderr.write('Slowest: %s.\n' % ', '.join(['%s (%.1fs)' % x for x in slowest]))
+    if failed:
+        ui.eprintc('Failed in %d of %d components: %s.' % (len(failed), len(component_names), ', '.join(failed)),
+                   ui.ERROR_COLOR)
+    return len(failed)
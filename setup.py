@@ -1,6 +1,6 @@
-import os, subprocess, time, traceback, sys, re, ConfigParser, shutil, tempfile
+import os, subprocess, time, traceback, sys, re, ConfigParser, shutil, tempfile, threading, signal
 
-from lib import ui, config
+from lib import ui, config, gitflow, parallel, cache
 
 isWindows = sys.platform=="win32" or sys.platform=="cygwin"
 if isWindows:
@@ -37,24 +37,12 @@ def complain(problem):
     return 1 # return an exit code that implies an error
 
 _owner = None
-def check_ownership(report=False):
-    # This function can be called indirectly (when running as root and needing
-    # to figure out who our non-root user ought to be). Or it can be called
-    # explicitly, when auditing setup. We only want to report it as a discrete
-    # step when we're auditing. Complicating this, we may call the function several
-    # times in a single run of the program, and we need to have different return
-    # values depending on our modes. Sorry to be messy.
+def check_ownership():
+    # When running as root, we figure out who our non-root user ought to be
+    # from who owns GMUX_ROOT. (The audit checks this with audit_ownership().)
     global _owner
     if _owner is None:
-        if report:
-            report_step('owner of %s' % config.GMUX_ROOT)
         _owner = do_or_die('stat -c %%U %s' % config.GMUX_ROOT, explanation='Need to check owner of GMUX_ROOT.').strip()
-        if report:
-            if _non_root_user == 'root':
-                die('%s is owned by root instead of ordinary user' % config.GMUX_ROOT)
-            else:
-                print('%s is owned by %s, as it should be' % (config.GMUX_ROOT, _owner))
-                return 0
     return _owner
 
 _non_root_user = None
@@ -107,7 +95,7 @@ def do_or_die(cmd, as_user=None, explanation=None):
         die(stderr)
     return stdout
 
-def setup_folder_layout(audit_only=False):
+def setup_folder_layout():
     report_step('folder layout')
     if not config.BIN_FOLDER.endswith('/bin'):
         msg = '%s is not a valid location for $GMUX_ROOT/bin.\n' % config.BIN_FOLDER + \
@@ -117,33 +105,27 @@ def setup_folder_layout(audit_only=False):
         msg = msg.replace('$CODE_HOME_REPO', config.CODE_HOME_REPO)
         msg = msg.replace('$MAIN_MODULE', config.MAIN_MODULE)
         msg = msg.strip()
-        if audit_only:
-            return complain(msg)
         die(msg)
     else:
         print('layout is correct')
     return 0
 
-def setup_app_cloned(audit_only=False):
+def setup_app_cloned():
     report_step('app is git clone')
     if not os.path.isdir(os.path.join(config.BIN_FOLDER, '.git')):
         msg = '''
 %s has not been installed with a git clone command. This will prevent it
 from updating itself.
 ''' % config.APP_NAME + config.INSTALLATION_INSTRUCTIONS
-        if audit_only:
-            return complain(msg)
         die(msg)
     else:
         print('%s was cloned correctly' % config.APP_NAME)
     return 0
 
-def setup_git(audit_only=False):
+def setup_git():
     report_step('git')
     exit_code, stdout, stderr = do('git --version', as_user=get_non_root_user())
     if exit_code:
-        if audit_only:
-            return complain('git is not installed')
         print('installing git.')
         do_or_die('%s -y install git' % get_installer(), 'Need git to be installed.')
         print('Try setup again, now that git is installed.')
@@ -152,25 +134,26 @@ def setup_git(audit_only=False):
         print('git is installed')
     return 0
 
-def setup_git_python(audit_only=False):
+def setup_git_python():
     report_step('gitpython')
     try:
         import git as gitpython
         print('gitpython is installed.')
     except:
-        if audit_only:
-            return complain('gitpython is not installed')
         print('installing gitpython')
         do_or_die('easy_install gitpython', explanation='Need gitpython to be installed.')
         ui.printc('Must restart python to be able to use gitpython module.', ui.WARNING_COLOR)
         sys.exit(0)
     return 0
 
-def setup_git_flow(audit_only=False):
+def setup_git_flow():
     report_step('git-flow')
     exit_code, stdout, stderr = do(whichCommand+' git-flow')
-    if exit_code:
-        if audit_only or isWindows:
+    if exit_code and gitflow.get_backend() == gitflow.NATIVE_BACKEND:
+        # The git-flow scripts are only needed as a compatibility backend.
+        print('git-flow is not installed; using native git-flow support')
+    elif exit_code:
+        if isWindows:
             return complain('git-flow is not installed')
         print('installing git-flow')
         installer = get_installer()
@@ -182,12 +165,12 @@ def setup_git_flow(audit_only=False):
         print('git-flow is installed')
     return 0
 
-def setup_stored_credential_helper(audit_only, nru):
+def setup_stored_credential_helper(nru):
     report_step('git credential.helper')
     git_cfg = get_git_config(nru)
     helper = git_cfg.get('credential.helper', '')
     if 'store' not in helper:
-        if helper or audit_only:
+        if helper:
             return complain('Git credential.helper is "%s", which will not work for muxing.\n' % helper +
                             'Setting credential.helper to "store" remembers passwords.\n' +
                             'Run "git config --global credential.helper store".')
@@ -233,9 +216,7 @@ You may also use the keyword "all" to manage all git-flow style branches, or
 "mine" for just ones you create in the future.
 ''' % config.APP_NAME)
     cfg = config.cfg
-    SECTION = 'muxed branches'
-    KEY = 'selected'
-    muxed_branches = cfg.try_get(SECTION, KEY, 'mine')
+    muxed_branches = cfg.try_get(config.MUXED_BRANCHES_SECTION, config.SELECTED_BRANCHES_KEY, 'mine')
     while True:
         # Prompt. Then apply various filters and see if user gave us anything usable.
         selected = ui.prompt('Branches to manage -- "mine", "all", or list?', default=muxed_branches)
@@ -251,9 +232,9 @@ You may also use the keyword "all" to manage all git-flow style branches, or
 
     if 'all' in selected:
         selected = 'all'
-    elif 'mine' in selected and len(selected) == 1:
-        selected = 'mine'
-    cfg.set_all(SECTION, KEY, selected)
+    else:
+        selected = ', '.join(selected)
+    cfg.set_all(config.MUXED_BRANCHES_SECTION, config.SELECTED_BRANCHES_KEY, selected)
     
 def get_git_config(nru=None):
     cfg = {}
@@ -390,26 +371,9 @@ in the form "name=url".
             else:
                 ui.eprintc('You must define some components to mux across.', ui.ERROR_COLOR)
 
-def check_components():
-    report_step('check components')
-    try:
-        items = config.cfg.items('muxed components')
-        if items:
-            print('muxing on %s' % ', '.join([x[0] for x in items]))
-            return 0
-    except:
-        pass
-    return complain('components for muxing are undefined')
-
-def setup_path(audit_only=False):
+def setup_path():
     report_step('%s is in path' % config.APP_NAME)
-    if audit_only or isWindows:
-        # Right now I can't figure out how to test the path of the non-root user.
-        # Every experiment I attempt fails. I've tried os.setuid(), su <user> -c which,
-        # runuser, etc...
-        if not isWindows and os.getegid() != 0:
-            do_or_die('which %s' % config.APP_NAME)
-    else:
+    if not isWindows:
         # We unconditionally remove any old symlink that's laying around,
         # to guarantee that every time we run setup, we end up with the
         # current version of the program being the one that will subsequently
@@ -454,7 +418,7 @@ def update_app(nru):
                 die('%s was out of date; re-run setup with new version.' % config.APP_NAME)
     print('no remote changes to worry about')
     
-def setup_ancillary_tools(audit_only=False):
+def setup_ancillary_tools():
     if isWindows:
         return 0
     report_step('ancillary tools')
@@ -470,10 +434,7 @@ def setup_ancillary_tools(audit_only=False):
     ec, stdout, stderr = do(whichCommand+' make')
     exit_code += ec
     if exit_code:
-        if audit_only:
-            return complain('At least one of the following packages is not installed: %s' % packages)
-        else:
-            do_or_die('%s -y install %s' % (installer, packages), explanation='Ancillary tools needed.')
+        do_or_die('%s -y install %s' % (installer, packages), explanation='Ancillary tools needed.')
     print('required tools are present')
     return 0
 	
@@ -484,55 +445,298 @@ def mkdir_os_specific(path, nru):
         do_or_die('mkdir -p %s' % path, as_user=nru)
     return 0
 
-def run(audit_only=False):
-    exit_code = 0
+AUDIT_TIMEOUT_SECONDS = 20
+DEFAULT_AUDIT_CACHE_TTL = 10 * 60
+
+def probe(args, cwd=None, timeout=None):
+    '''
+    Run a command quietly, without a shell and without any chance of an
+    interactive prompt. Return (exit_code, stdout, stderr); exit_code is None
+    if the command had to be killed because it ran past timeout seconds.
+    '''
+    env = dict(os.environ)
+    env['GIT_TERMINAL_PROMPT'] = '0'
+    env.setdefault('GIT_SSH_COMMAND', 'ssh -o BatchMode=yes')
+    # A hung ssh is git's grandchild, and holds our pipes open after git
+    # dies; so give the command a process group of its own, and kill that.
+    kwargs = {}
+    if not isWindows:
+        kwargs['preexec_fn'] = os.setsid
+    try:
+        proc = subprocess.Popen(args, cwd=cwd, env=env, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    except OSError as e:
+        return 127, '', str(e)
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            if isWindows:
+                proc.kill()
+            else:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        stdout, stderr = proc.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    if killed:
+        return None, stdout, 'no answer after %d seconds' % timeout
+    return proc.returncode, stdout, stderr
+
+def first_line(txt):
+    txt = (txt or '').strip()
+    if not txt:
+        return ''
+    return txt.split('\n')[0].strip()
+
+def which(program):
+    exit_code, stdout, stderr = probe([whichCommand, program])
+    return not exit_code
+
+# Each audit check returns (ok, detail). Unlike the setup_* functions, they
+# never print, prompt, or install anything, so they can run side by side.
+
+def audit_ownership():
+    if isWindows:
+        return True, 'not checked on Windows'
+    import pwd
+    owner = pwd.getpwuid(os.stat(config.GMUX_ROOT).st_uid).pw_name
+    if owner == 'root':
+        return False, '%s is owned by root instead of ordinary user' % config.GMUX_ROOT
+    return True, '%s is owned by %s' % (config.GMUX_ROOT, owner)
+
+def audit_git():
+    exit_code, stdout, stderr = probe(['git', '--version'])
+    if exit_code:
+        return False, 'git is not installed'
+    return True, first_line(stdout)
+
+def audit_ancillary_tools():
+    if isWindows:
+        return True, 'not needed on Windows'
+    missing = [x for x in ['easy_install', 'g++', 'make'] if not which(x)]
+    if missing:
+        return False, 'missing %s' % ', '.join(missing)
+    return True, 'required tools are present'
+
+def audit_git_python():
     try:
-        # Check basic prerequisites, and fix them if appropriate.
+        import git as gitpython
+    except ImportError:
+        return False, 'gitpython is not installed'
+    return True, 'gitpython %s' % getattr(gitpython, '__version__', '')
+
+def audit_git_flow():
+    if which('git-flow'):
+        return True, 'git-flow is installed'
+    if gitflow.get_backend() == gitflow.NATIVE_BACKEND:
+        return True, 'using native git-flow support'
+    return False, 'git-flow is not installed'
+
+def audit_credential_helper():
+    exit_code, stdout, stderr = probe(['git', 'config', '--global', '--get', 'credential.helper'])
+    helper = (stdout or '').strip()
+    if 'store' not in helper:
+        return False, 'credential.helper is "%s"; run "git config --global credential.helper store"' % helper
+    return True, 'credential.helper is %s' % helper
 
-        # Verify correct security context (ignore check on windows)
-        as_root = isWindows or os.getegid() == 0
-        if as_root:
-            # This call will cause us to exit if we have problems.
-            nru = get_non_root_user()
+def audit_folder_layout():
+    if not config.BIN_FOLDER.endswith('/bin'):
+        return False, '%s is not a valid location for $GMUX_ROOT/bin' % config.BIN_FOLDER
+    return True, 'layout is correct'
+
+def audit_app_cloned():
+    if not os.path.isdir(os.path.join(config.BIN_FOLDER, '.git')):
+        return False, '%s was not installed with git clone' % config.APP_NAME
+    return True, '%s was cloned correctly' % config.APP_NAME
+
+def audit_path():
+    if isWindows or os.getegid() == 0:
+        # Right now I can't figure out how to test the path of the non-root user.
+        # Every experiment I attempt fails. I've tried os.setuid(), su <user> -c which,
+        # runuser, etc...
+        return True, 'not checked for this user'
+    if not which(config.APP_NAME):
+        return False, '%s is not in the path' % config.APP_NAME
+    return True, '%s is in the path' % config.APP_NAME
+
+def audit_components():
+    items = get_muxed_components()
+    if not items:
+        return False, 'components for muxing are undefined'
+    return True, 'muxing on %s' % ', '.join([x[0] for x in items])
+
+def audit_remote(name, url):
+    exit_code, stdout, stderr = probe(['git', 'ls-remote', '--heads', url], timeout=AUDIT_TIMEOUT_SECONDS)
+    if exit_code is None:
+        return False, '%s gave %s' % (url, stderr)
+    if exit_code:
+        return False, first_line(stderr) or 'git ls-remote failed'
+    heads = [x for x in stdout.split('\n') if x.strip()]
+    return True, '%d branches at %s' % (len(heads), url)
+
+def audit_clone(name, url):
+    path = os.path.join(config.DATA_FOLDER, name)
+    if not os.path.isdir(path):
+        return True, 'not cloned yet'
+    exit_code, stdout, stderr = probe(['git', 'config', '--get', 'remote.origin.url'], cwd=path)
+    origin = (stdout or '').strip()
+    if exit_code or origin != url:
+        return False, 'origin of %s is "%s", not %s' % (path, origin, url)
+    exit_code, stdout, stderr = probe(['git', 'rev-parse', '--verify', '-q', 'HEAD'], cwd=path)
+    if exit_code:
+        return False, '%s has no valid HEAD' % path
+    return True, 'HEAD is %s' % stdout.strip()[:10]
+
+def get_muxed_components():
+    try:
+        return config.cfg.items(config.MUXED_COMPONENTS_SECTION)
+    except ConfigParser.Error:
+        return []
+
+class AuditCheck:
+    '''
+    One independent thing that the audit verifies.
+    '''
+    def __init__(self, title, func, args=(), cacheable=False):
+        self.title = title
+        self.func = func
+        self.args = args
+        # Only checks that spawn processes or touch the network are worth
+        # caching; the rest are cheaper to redo than to look up.
+        self.cacheable = cacheable
+        self.key = '|'.join([func.__name__] + [x for x in args])
+
+def get_audit_checks():
+    checks = [
+        AuditCheck('owner of GMUX_ROOT', audit_ownership),
+        AuditCheck('git', audit_git, cacheable=True),
+        AuditCheck('ancillary tools', audit_ancillary_tools, cacheable=True),
+        AuditCheck('gitpython', audit_git_python),
+        AuditCheck('git-flow', audit_git_flow, cacheable=True),
+        AuditCheck('git credential.helper', audit_credential_helper, cacheable=True),
+        AuditCheck('folder layout', audit_folder_layout),
+        AuditCheck('app is git clone', audit_app_cloned),
+        AuditCheck('%s is in path' % config.APP_NAME, audit_path, cacheable=True),
+        AuditCheck('components', audit_components),
+    ]
+    for name, url in get_muxed_components():
+        checks.append(AuditCheck('remote %s' % name, audit_remote, (name, url), cacheable=True))
+        checks.append(AuditCheck('clone %s' % name, audit_clone, (name, url), cacheable=True))
+    return checks
+
+def get_audit_cache_ttl():
+    try:
+        return int(config.cfg.try_get(config.MISC_SECTION, config.AUDIT_CACHE_TTL_KEY, DEFAULT_AUDIT_CACHE_TTL))
+    except ValueError:
+        return DEFAULT_AUDIT_CACHE_TTL
+
+def audit(fresh=False):
+    '''
+    Verify setup without changing anything. Checks run in parallel, and
+    successful results are remembered for "audit cache ttl" seconds (see the
+    misc section of config), so repeated audits are nearly free. Pass
+    fresh=True to ignore what's remembered.
+    '''
+    checks = get_audit_checks()
+    ttl = get_audit_cache_ttl()
+    audit_cache = cache.JsonCache('audit', ttl=ttl)
+
+    def run_check(check):
+        start = time.time()
+        if check.cacheable and ttl > 0 and not fresh:
+            detail = audit_cache.get(check.key)
+            if detail is not None:
+                return 'cached', detail, time.time() - start
+        ok, detail = check.func(*check.args)
+        if ok and check.cacheable:
+            audit_cache.put(check.key, detail)
+        return ('ok' if ok else 'FAIL'), detail, time.time() - start
+
+    report_step('audit')
+    start = time.time()
+    outcomes = parallel.run_all(run_check, checks)
+    elapsed = time.time() - start
+
+    exit_code = 0
+    width = max([len(check.title) for check in checks])
+    print('%s  %-6s  %7s  %s' % ('check'.ljust(width), 'result', 'seconds', 'detail'))
+    for outcome in outcomes:
+        if outcome.error:
+            status, detail, seconds = 'FAIL', first_line(str(outcome.error)) or outcome.error.__class__.__name__, 0
+        else:
+            status, detail, seconds = outcome.result
+        color = None
+        if status == 'FAIL':
+            exit_code += 1
+            color = ui.ERROR_COLOR
+        elif status == 'cached':
+            color = ui.SUBTLE_COLOR
+        ui.printc('%s  %-6s  %7.2f  %s' % (outcome.item.title.ljust(width), status, seconds, detail), color)
+    print('%s  %-6s  %7.2f' % ('total'.ljust(width), '', elapsed))
+
+    # Don't leave root-owned files in the data folder for the ordinary user
+    # to trip over.
+    if ttl > 0 and (isWindows or os.getegid() != 0):
+        audit_cache.save()
+    return exit_code
+
+def run(audit_only=False, fresh=False):
+    exit_code = 0
+    try:
+        if audit_only:
+            # Auditing never changes anything, so its checks can run side
+            # by side; see audit().
+            exit_code = audit(fresh)
         else:
-            if audit_only:
-                exit_code += check_ownership(report=True)
+            # Check basic prerequisites, and fix them if appropriate.
+
+            # Verify correct security context (ignore check on windows)
+            as_root = isWindows or os.getegid() == 0
+            if as_root:
+                # This call will cause us to exit if we have problems.
+                nru = get_non_root_user()
             else:
                 die('Must run setup as root user.')
 
-        exit_code += setup_git(audit_only)
-        exit_code += setup_ancillary_tools(audit_only)
+            exit_code += setup_git()
+            exit_code += setup_ancillary_tools()
 
-        # Only check gitpython and git-flow if git's working.
-        if not exit_code:
-            exit_code += setup_git_python(audit_only)
-            exit_code += setup_git_flow(audit_only)
-            exit_code += setup_stored_credential_helper(audit_only, nru)
+            # Only check gitpython and git-flow if git's working.
+            if not exit_code:
+                exit_code += setup_git_python()
+                exit_code += setup_git_flow()
+                exit_code += setup_stored_credential_helper(nru)
 
-        exit_code += setup_folder_layout(audit_only)
-        exit_code += setup_app_cloned(audit_only)
-        exit_code += setup_path(audit_only)
+            exit_code += setup_folder_layout()
+            exit_code += setup_app_cloned()
+            exit_code += setup_path()
 
-        if audit_only:
-            exit_code += check_components()
-        elif not exit_code:
-
-            # We need to do the rest of the setup as the unprivileged user
-            # instead of as root, but my testing with os.setuid() and similar
-            # functions wasn't promising. Instead, just create files as
-            # the unprivileged user, and then edit them as root.
-            if not os.path.isdir(config.CONFIG_FOLDER):
-                mkdir_os_specific(config.CONFIG_FOLDER, nru)
-            if not os.path.isfile(config.CONFIG_FQPATH):
-                do_or_die('touch %s' % config.CONFIG_FQPATH, as_user=nru)
-
-            update_app(nru)
-            define_components(nru)
-            define_branches()
             if not exit_code:
-                config.cfg.set(config.MISC_SECTION, config.SETUP_SUCCESS_DATE_KEY,
-                               time.strftime('%Y-%m-%d %H:%M:%SZ', time.gmtime()))
-            config.cfg.save()
+
+                # We need to do the rest of the setup as the unprivileged user
+                # instead of as root, but my testing with os.setuid() and similar
+                # functions wasn't promising. Instead, just create files as
+                # the unprivileged user, and then edit them as root.
+                if not os.path.isdir(config.CONFIG_FOLDER):
+                    mkdir_os_specific(config.CONFIG_FOLDER, nru)
+                if not os.path.isfile(config.CONFIG_FQPATH):
+                    do_or_die('touch %s' % config.CONFIG_FQPATH, as_user=nru)
+
+                update_app(nru)
+                define_components(nru)
+                define_branches()
+                if not exit_code:
+                    config.cfg.set(config.MISC_SECTION, config.SETUP_SUCCESS_DATE_KEY,
+                                   time.strftime('%Y-%m-%d %H:%M:%SZ', time.gmtime()))
+                config.cfg.save()
 
         # Summarize what happened.
         operation = 'Setup'
@@ -555,22 +759,29 @@ def run(audit_only=False):
 
 if __name__ == '__main__':
     show_help = False
-    audit = False
-    if len(sys.argv) > 2:
+    audit_only = False
+    args = sys.argv[1:]
+    fresh = '--fresh' in args
+    if fresh:
+        args.remove('--fresh')
+    if len(args) > 1:
         show_help = True
     else:
-        if len(sys.argv) == 2:
-            if sys.argv[1].lower().find('audit') > -1:
-                audit = True
+        if len(args) == 1:
+            if args[0].lower().find('audit') > -1:
+                audit_only = True
             else:
                 show_help = True
+    if fresh and not audit_only:
+        show_help = True
 
     # Take care of "help" mode inline.
     if show_help:
         print('''
 sudo python setup.py   -- run setup
 python setup.py audit  -- verify that setup is correct
+  --fresh              -- ignore audit results cached in the last few minutes
 ''')
         sys.exit(0)
 
-    sys.exit(run(audit_only=audit))
+    sys.exit(run(audit_only=audit_only, fresh=fresh))